@@ -51,4 +51,13 @@ def create_app():
     from .setting import settings
     app.register_blueprint(settings)
 
+    from .attachment import attachments
+    app.register_blueprint(attachments)
+
+    from .job import jobs
+    app.register_blueprint(jobs)
+
+    from .batch import batch
+    app.register_blueprint(batch)
+
     return app
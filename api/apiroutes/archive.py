@@ -0,0 +1,201 @@
+"""
+Archival of the done tasks of long-finished sprints to cold tables.
+
+The 'archive_tasks' job moves tasks with status 'done' whose sprint ended more than
+ARCHIVE_AFTER_DAYS days ago from 'tasks' and 'task_labels' to 'archived_tasks' and
+'archived_task_labels', keeping their IDs. It works through a shard in batches of ARCHIVE_BATCH_SIZE
+tasks, one transaction per batch: two INSERT ... SELECT statements copy the rows, tombstones make
+delta-sync clients drop them and the hot rows are deleted. Task counters and the search index
+follow, so listings, counts and searches of the hot tables only see current work.
+
+Tasks still referenced elsewhere stay hot: tasks with attachments, in the task hierarchy or in
+dependencies, tasks with buffered write-behind changes and tasks of projects being moved. Running
+the job again archives only what is left, so it can be retried and scheduled freely, e.g. with
+'manage_db.py archive' from cron.
+
+Archived tasks are read-only. They are listed with '/task/by_project/<project_id>?include_archived=true'
+and included in project exports.
+"""
+import os
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import delete, exists, insert, literal, select
+from sqlalchemy.orm import Session as DBSession
+from sqlalchemy.sql import ColumnElement
+
+from . import searchindex, shards, taskcounters, writebehind
+from .events import publish_event
+from .jobs import ProgressCallback, job, no_progress
+from .sprint.burndown import DONE_STATUS
+from database.engine_utils import MAIN_SHARD
+from database.map_db import (ArchivedTask, ArchivedTaskLabel, Attachment, Label, Sprint, Task, TaskDependencyPath,
+                             TaskLabel, TaskTreePath)
+from database.revisions import record_tombstones
+
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', 90))
+ARCHIVE_BATCH_SIZE = 1000
+ARCHIVED_COLUMNS = ('task_id', 'sprint_id', 'project_id', 'title', 'description', 'status', 'assigned_to',
+                    'parent_id', 'rank', 'revision')
+
+
+def archivable_conditions(cutoff: date) -> List[ColumnElement]:
+    """
+    Build the conditions selecting the tasks to archive.
+
+    :param cutoff: Tasks of sprints that ended before this date are archived.
+    :return: The conditions on tasks, to be combined with AND.
+    """
+    return [
+        Task.status == DONE_STATUS,
+        Task.sprint_id.in_(select(Sprint.sprint_id).where(Sprint.end_date < cutoff)),
+        ~exists().where(Attachment.task_id == Task.task_id),
+        ~exists().where(TaskTreePath.ancestor_id == Task.task_id),
+        ~exists().where(TaskTreePath.descendant_id == Task.task_id),
+        ~exists().where(TaskDependencyPath.task_id == Task.task_id),
+        ~exists().where(TaskDependencyPath.blocker_id == Task.task_id)
+    ]
+
+
+def archive_batch(session: DBSession, cutoff: date, task_ids: List[int]) -> List[Dict[str, Any]]:
+    """
+    Move tasks that are still archivable, with their labels, to the archive tables. The caller commits.
+
+    :param session: A session of the shard holding the tasks.
+    :param cutoff: Tasks of sprints that ended before this date are archived.
+    :param task_ids: IDs of the tasks to archive.
+    :return: The counted states of the archived tasks, see taskcounters.task_state.
+    """
+    tasks = session.execute(
+        select(Task.task_id, Task.project_id, Task.status, Task.sprint_id, Task.assigned_to)
+        .where(Task.task_id.in_(task_ids), *archivable_conditions(cutoff))
+    ).all()
+    if not tasks:
+        return []
+    task_ids = [task.task_id for task in tasks]
+    label_ids: Dict[int, List[int]] = defaultdict(list)
+    for task_id, label_id in session.execute(select(TaskLabel.task_id, TaskLabel.label_id)
+                                             .where(TaskLabel.task_id.in_(task_ids))):
+        label_ids[task_id].append(label_id)
+
+    session.execute(insert(ArchivedTask).from_select(
+        [*ARCHIVED_COLUMNS, 'archived_at'],
+        select(*(getattr(Task, column) for column in ARCHIVED_COLUMNS), literal(datetime.utcnow()))
+        .where(Task.task_id.in_(task_ids))
+    ))
+    task_labels = (select(TaskLabel.task_label_id, Task.project_id)
+                   .join(Task, Task.task_id == TaskLabel.task_id).where(TaskLabel.task_id.in_(task_ids)))
+    session.execute(insert(ArchivedTaskLabel).from_select(
+        ['task_label_id', 'project_id', 'task_id', 'label_id'],
+        task_labels.add_columns(TaskLabel.task_id, TaskLabel.label_id)
+    ))
+
+    revision = record_tombstones(session, TaskLabel.__tablename__, task_labels)
+    record_tombstones(session, Task.__tablename__, select(Task.task_id, Task.project_id)
+                      .where(Task.task_id.in_(task_ids)), revision)
+    session.execute(delete(TaskLabel).where(TaskLabel.task_id.in_(task_ids)))
+    session.execute(delete(Task).where(Task.task_id.in_(task_ids)))
+
+    states = [{'task_id': task.task_id, 'project_id': task.project_id, 'status': task.status,
+               'sprint_id': task.sprint_id, 'assigned_to': task.assigned_to, 'label_ids': label_ids[task.task_id]}
+              for task in tasks]
+    taskcounters.count_changes(session, [(state, None) for state in states])
+    return states
+
+
+@job('archive_tasks')
+def archive_tasks(shard: str = MAIN_SHARD, days: int = ARCHIVE_AFTER_DAYS,
+                  progress: ProgressCallback = no_progress) -> int:
+    """
+    Archive the done tasks of sprints that ended more than the given number of days ago on a shard,
+    committing after each batch.
+
+    :param shard: The name of the shard.
+    :param days: Days since the end of the sprint after which its done tasks are archived.
+    :param progress: Called with the number of archived tasks after each batch.
+    :return: The number of archived tasks.
+    """
+    cutoff = date.today() - timedelta(days=days)
+    archived: Dict[int, List[int]] = defaultdict(list)
+    last_task_id = 0
+    with shards.SHARDS_BY_NAME[shard].session() as session_db:
+        while True:
+            candidates = session_db.execute(
+                select(Task.task_id, Task.project_id)
+                .where(Task.task_id > last_task_id, *archivable_conditions(cutoff))
+                .order_by(Task.task_id).limit(ARCHIVE_BATCH_SIZE)
+            ).all()
+            if not candidates:
+                break
+            last_task_id = candidates[-1].task_id
+
+            frozen = {project_id for project_id in {candidate.project_id for candidate in candidates}
+                      if shards.is_frozen(project_id)}
+            buffered = writebehind.pending_task_changes([candidate.task_id for candidate in candidates])
+            task_ids = [candidate.task_id for candidate in candidates
+                        if candidate.project_id not in frozen and candidate.task_id not in buffered]
+            while True:
+                states = archive_batch(session_db, cutoff, task_ids)
+                # Changes buffered since the check above would be dropped by the flusher; keep their tasks.
+                buffered = writebehind.pending_task_changes([state['task_id'] for state in states])
+                if not buffered:
+                    break
+                session_db.rollback()
+                task_ids = [task_id for task_id in task_ids if task_id not in buffered]
+            session_db.commit()
+
+            for state in states:
+                searchindex.remove_task(state['project_id'], state['task_id'])
+                archived[state['project_id']].append(state['task_id'])
+            progress(sum(len(task_ids) for task_ids in archived.values()))
+
+    for project_id, task_ids in archived.items():
+        publish_event(project_id, 'tasks.archived', task_ids=task_ids)
+    return sum(len(task_ids) for task_ids in archived.values())
+
+
+def archived_tasks(session: DBSession, project_id: int, sprint_id: Optional[int] = None,
+                   label_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Get the archived tasks of a project with their label names, with one query each.
+
+    :param session: The current database session.
+    :param project_id: The ID of the project.
+    :param sprint_id: Only return tasks of this sprint.
+    :param label_id: Only return tasks with this label.
+    :return: The archived tasks, by task ID, as dicts shaped like serialized tasks.
+    """
+    conditions = [ArchivedTask.project_id == project_id]
+    if sprint_id:
+        conditions.append(ArchivedTask.sprint_id == sprint_id)
+    if label_id:
+        conditions.append(exists().where(ArchivedTaskLabel.task_id == ArchivedTask.task_id,
+                                         ArchivedTaskLabel.label_id == label_id))
+    tasks = session.scalars(select(ArchivedTask).where(*conditions).order_by(ArchivedTask.task_id)).all()
+
+    label_names: Dict[int, List[str]] = {task.task_id: [] for task in tasks}
+    if tasks:
+        rows = session.execute(
+            select(ArchivedTaskLabel.task_id, Label.name)
+            .join(Label, Label.label_id == ArchivedTaskLabel.label_id)
+            .where(ArchivedTaskLabel.project_id == project_id, ArchivedTaskLabel.task_id.in_(list(label_names)))
+            .order_by(ArchivedTaskLabel.task_id, Label.name)
+        )
+        for task_id, name in rows:
+            label_names[task_id].append(name)
+
+    return [{
+        'task_id': task.task_id,
+        'title': task.title,
+        'description': task.description,
+        'status': task.status,
+        'sprint_id': task.sprint_id,
+        'assigned_to': task.assigned_to,
+        'project_id': task.project_id,
+        'parent_id': task.parent_id,
+        'rank': task.rank,
+        'label_names': label_names[task.task_id],
+        'archived': True,
+        'archived_at': task.archived_at.isoformat()
+    } for task in tasks]
@@ -0,0 +1,50 @@
+"""
+Task queries over the tasks assigned to a user across all of the user's projects, on every shard.
+
+Every shard runs one query on the (assigned_to, status) access path, restricted to the user's
+projects on the shard, which are read from the result cache. The pages of the shards are merged
+with taskquery.merge_pages.
+"""
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session as DBSession
+
+from . import shards
+from .resultcache import cached
+from .taskquery import TaskQuery, decode_cursor, filter_conditions, keyset_statement, label_names_by_task, merge_pages
+from database.map_db import ProjectMember, Task
+
+
+def query_assigned_tasks(user_id: int, query: TaskQuery, main_session: Optional[DBSession] = None,
+                         read: bool = False) -> Tuple[List[Task], Dict[int, List[str]], Optional[str]]:
+    """
+    Run a task query over the tasks assigned to a user in every project the user is a member of,
+    and return one page of tasks.
+
+    :param user_id: The ID of the user.
+    :param query: The task query, with a limit.
+    :param main_session: Session to use for the main shard, see shards.scatter.
+    :param read: Read with the read engines of the shards.
+    :return: The tasks of the page, the label names of every task and the cursor of the next page,
+             or None on the last page.
+    :raises TaskQueryError: If the cursor is invalid.
+    """
+    conditions = [Task.assigned_to == user_id, *filter_conditions(query)]
+    if query.cursor:
+        decode_cursor(query)  # Fail before querying the shards.
+
+    def load(session_db: DBSession) -> List[Tuple[Task, Any, List[str]]]:
+        project_ids = list(session_db.scalars(
+            cached(select(ProjectMember.project_id).where(ProjectMember.member_id == user_id))))
+        if not project_ids:
+            return []
+        statement = keyset_statement(query, [*conditions, Task.project_id.in_(project_ids)])
+        rows = session_db.execute(statement.limit(query.limit + 1)).all()
+        names = label_names_by_task(session_db, [task.task_id for task, _ in rows])
+        return [(task, sort_value, names[task.task_id]) for task, sort_value in rows]
+
+    rows = shards.scatter(load, main_session, read=read)
+    tasks, next_cursor = merge_pages(query, [(task, sort_value) for task, sort_value, _ in rows])
+    label_names = {task.task_id: names for task, _, names in rows}
+    return tasks, label_names, next_cursor
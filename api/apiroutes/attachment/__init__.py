@@ -0,0 +1,5 @@
+from flask import Blueprint
+
+attachments = Blueprint('attachments', __name__, url_prefix='/task')
+
+from .routes import *
\ No newline at end of file
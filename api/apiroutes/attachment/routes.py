@@ -0,0 +1,139 @@
+import os
+from datetime import datetime
+from typing import Any, Dict, List, Tuple
+
+from flask import Response, request, jsonify, g, send_file
+from werkzeug.utils import secure_filename
+
+from . import attachments
+from .. import blobstore
+from ..commitoperations import add_object, delete_object
+from ..events import publish_event
+from ..utils import require_task_access
+from database.map_db import Attachment
+
+
+def attachment_to_dict(attachment: Attachment) -> Dict[str, Any]:
+    """
+    Serialize an attachment.
+
+    :param attachment: The attachment.
+    :return: A dict with the attachment metadata.
+    """
+    return {
+        'attachment_id': attachment.attachment_id,
+        'task_id': attachment.task_id,
+        'file_name': attachment.file_name,
+        'content_type': attachment.content_type,
+        'size': attachment.size,
+        'file_url': attachment.file_url,
+        'uploaded_at': attachment.uploaded_at.isoformat() if attachment.uploaded_at else None
+    }
+
+
+@attachments.route('/<int:task_id>/attachments', methods=['POST'])
+@require_task_access('task_id')
+def upload_attachment(task_id: int) -> Tuple[Dict[str, Any], int]:
+    """
+    Upload an attachment to a task. The request body is the raw file content, streamed to the
+    blob store in chunks; the file name is given in the 'name' query parameter.
+
+    :param task_id: The ID of the task.
+    :return: A JSON response with the attachment metadata and a 201 status code if successful,
+             otherwise an error message with a 400 or 413 status code.
+    """
+    file_name = secure_filename(request.args.get('name', ''))
+    if not file_name:
+        return jsonify({'error': 'File name cannot be empty'}), 400
+
+    try:
+        digest, size = blobstore.store_stream(request.stream)
+    except blobstore.BlobTooLargeError as e:
+        return jsonify({'error': str(e)}), 413
+
+    attachment = Attachment(
+        task_id=task_id,
+        file_name=file_name,
+        content_type=request.mimetype or 'application/octet-stream',
+        size=size,
+        content_hash=digest,
+        uploaded_at=datetime.utcnow()
+    )
+    g.session.add(attachment)
+    g.session.flush()
+    attachment.file_url = f'{attachments.url_prefix}/{task_id}/attachments/{attachment.attachment_id}'
+    add_object(attachment)
+    publish_event(g.resource.project_id, 'attachment.created', task_id=task_id,
+                  attachment_id=attachment.attachment_id)
+
+    return jsonify(attachment_to_dict(attachment)), 201
+
+
+@attachments.route('/<int:task_id>/attachments', methods=['GET'])
+@require_task_access('task_id')
+def get_attachments(task_id: int) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Retrieve the attachments of a task.
+
+    :param task_id: The ID of the task.
+    :return: A JSON response with a list of attachment metadata and a 200 status code.
+    """
+    task_attachments = g.session.query(Attachment).filter(Attachment.task_id == task_id).all()
+    return jsonify([attachment_to_dict(attachment) for attachment in task_attachments]), 200
+
+
+@attachments.route('/<int:task_id>/attachments/<int:attachment_id>', methods=['GET'])
+@require_task_access('task_id')
+def download_attachment(task_id: int, attachment_id: int) -> Response:
+    """
+    Download an attachment. The file is handed to the server's file wrapper (sendfile where
+    available), and Range, If-Range, If-None-Match and If-Modified-Since requests are honoured.
+
+    :param task_id: The ID of the task.
+    :param attachment_id: The ID of the attachment.
+    :return: The file response, otherwise an error message with a 404 status code.
+    """
+    attachment = g.session.query(Attachment).filter(
+        Attachment.attachment_id == attachment_id,
+        Attachment.task_id == task_id
+    ).first()
+    if not attachment:
+        return jsonify({'error': 'Attachment not found'}), 404
+
+    path = blobstore.blob_path(attachment.content_hash)
+    if not os.path.exists(path):
+        return jsonify({'error': 'Attachment content not found'}), 404
+
+    return send_file(
+        path,
+        mimetype=attachment.content_type,
+        as_attachment=True,
+        download_name=attachment.file_name,
+        conditional=True,
+        etag=attachment.content_hash,
+        max_age=3600
+    )
+
+
+@attachments.route('/<int:task_id>/attachments/<int:attachment_id>', methods=['DELETE'])
+@require_task_access('task_id')
+def delete_attachment(task_id: int, attachment_id: int) -> Tuple[Dict[str, str], int]:
+    """
+    Delete an attachment. The blob is shared by identical files and is removed by
+    'manage_db.py gc' once no attachment references it.
+
+    :param task_id: The ID of the task.
+    :param attachment_id: The ID of the attachment.
+    :return: A JSON response with a success message and a 200 status code if successful,
+             otherwise an error message with a 404 status code.
+    """
+    attachment = g.session.query(Attachment).filter(
+        Attachment.attachment_id == attachment_id,
+        Attachment.task_id == task_id
+    ).first()
+    if not attachment:
+        return jsonify({'error': 'Attachment not found'}), 404
+
+    delete_object(attachment)
+    publish_event(g.resource.project_id, 'attachment.deleted', task_id=task_id, attachment_id=attachment_id)
+    return jsonify({'success': 'Attachment deleted'}), 200
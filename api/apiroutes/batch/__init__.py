@@ -0,0 +1,5 @@
+from flask import Blueprint
+
+batch = Blueprint('batch', __name__, url_prefix='/batch')
+
+from .routes import *
\ No newline at end of file
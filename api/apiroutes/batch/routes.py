@@ -0,0 +1,132 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+from flask import Flask, current_app, g, jsonify, request, session as flask_session
+from flask.ctx import RequestContext
+from flask.sessions import SessionMixin
+from werkzeug.exceptions import HTTPException
+from werkzeug.test import EnvironBuilder
+from . import batch
+from ..session import ReadSession, Session
+from ..utils import BatchScope, recently_wrote, require_user
+from database.map_db import User
+
+MAX_BATCH_REQUESTS = 20
+MAX_PARALLEL_REQUESTS = 4
+BATCH_METHODS = ('GET', 'POST', 'PUT', 'DELETE')
+
+logger = logging.getLogger(__name__)
+
+
+def dispatch_sub_request(app: Flask, environ: Dict[str, Any], session: SessionMixin) -> Dict[str, Any]:
+    """
+    Run one sub-request of a batch through the registered blueprints, using the BatchScope in g.batch.
+
+    :param app: The application.
+    :param environ: The WSGI environment of the sub-request.
+    :param session: The Flask session of the batch request, shared with the sub-request.
+    :return: A dict with the status and the body of the response.
+    """
+    with RequestContext(app, environ, session=session):
+        try:
+            rv = app.preprocess_request()
+            response = app.make_response(rv if rv is not None else app.dispatch_request())
+        except HTTPException as e:
+            return {'status': e.code, 'body': {'error': e.description}}
+        except Exception:
+            logger.exception('Sub-request %s %s failed', environ['REQUEST_METHOD'], environ['PATH_INFO'])
+            g.batch.session.rollback()
+            for session_db in g.batch.shard_sessions.values():
+                session_db.rollback()
+            return {'status': 500, 'body': {'error': 'Internal server error'}}
+
+        if response.is_streamed:
+            response.close()
+            return {'status': 400, 'body': {'error': 'Streaming responses cannot be part of a batch'}}
+
+        body = response.get_json() if response.is_json else response.get_data(as_text=True)
+        return {'status': response.status_code, 'body': body}
+
+
+def _dispatch_in_thread(app: Flask, user: User, environ: Dict[str, Any], session: SessionMixin,
+                        read: bool) -> Dict[str, Any]:
+    with app.app_context(), (ReadSession if read else Session)() as session_db:
+        g.batch = scope = BatchScope(session_db.merge(user, load=False), session_db, {}, {}, read)
+        try:
+            return dispatch_sub_request(app, environ, session)
+        finally:
+            scope.close()
+
+
+def _parse_sub_requests(data: Any) -> Tuple[Optional[List[Dict[str, Any]]], Optional[str]]:
+    sub_requests = data.get('requests') if isinstance(data, dict) else None
+    if not isinstance(sub_requests, list) or not 0 < len(sub_requests) <= MAX_BATCH_REQUESTS:
+        return None, f'requests must be a list of 1 to {MAX_BATCH_REQUESTS} sub-requests'
+
+    for sub_request in sub_requests:
+        if not isinstance(sub_request, dict):
+            return None, 'Every sub-request must be an object'
+        path = sub_request.get('path')
+        method = str(sub_request.get('method', 'GET')).upper()
+        if not isinstance(path, str) or not path.startswith('/') or path.startswith(batch.url_prefix):
+            return None, 'Every sub-request needs a path, which cannot be a batch request'
+        if method not in BATCH_METHODS:
+            return None, f'method must be one of {", ".join(BATCH_METHODS)}'
+        sub_request['method'] = method
+    return sub_requests, None
+
+
+@batch.route('', methods=['POST'])
+@require_user
+def run_batch() -> Tuple[Dict[str, Any], int]:
+    """
+    Execute several API requests in one round trip.
+
+    The body holds 'requests', a list of objects with 'path' (including the query string),
+    'method' (default GET), an optional JSON 'body' and an optional 'id' echoed in the response.
+    Sub-requests run in order with the user, the database session and the access checks of this
+    request. With 'parallel' set and only GET sub-requests, they run concurrently, each with its
+    own database session, using the read engines unless the user wrote recently.
+
+    :return: A JSON response with the status and body of every sub-request, in order, and a 200
+             status code, otherwise an error message with a 400 status code.
+    """
+    data = request.get_json(silent=True)
+    sub_requests, error = _parse_sub_requests(data)
+    if error:
+        return jsonify({'error': error}), 400
+
+    app = current_app._get_current_object()
+    session = flask_session._get_current_object()
+    environs = [EnvironBuilder(
+        path=sub_request['path'],
+        method=sub_request['method'],
+        json=sub_request.get('body'),
+        base_url=request.url_root
+    ).get_environ() for sub_request in sub_requests]
+
+    parallel = data.get('parallel') is True and all(sub_request['method'] == 'GET' for sub_request in sub_requests)
+    if parallel:
+        user = g.user
+        read = not recently_wrote()
+        with ThreadPoolExecutor(max_workers=min(len(environs), MAX_PARALLEL_REQUESTS)) as executor:
+            responses = list(executor.map(
+                lambda environ: _dispatch_in_thread(app, user, environ, session, read), environs))
+    else:
+        g.batch = scope = BatchScope(g.user, g.session, {}, {})
+        responses = []
+        try:
+            for sub_request, environ in zip(sub_requests, environs):
+                responses.append(dispatch_sub_request(app, environ, session))
+                if sub_request['method'] != 'GET':
+                    # Writes may change what the user can access.
+                    scope.access.clear()
+        finally:
+            scope.close()
+            g.pop('batch', None)
+
+    for sub_request, response in zip(sub_requests, responses):
+        if 'id' in sub_request:
+            response['id'] = sub_request['id']
+
+    return jsonify({'responses': responses}), 200
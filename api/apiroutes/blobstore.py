@@ -0,0 +1,104 @@
+"""
+Content-addressed blob store for attachments on the local filesystem.
+
+Blobs are stored under ATTACHMENT_DIR as '<aa>/<bb>/<sha256>', where 'aa' and 'bb' are the first
+two byte pairs of the hash. Uploads are streamed to a temporary file in fixed-size chunks while
+being hashed and then atomically renamed into place, so identical files are stored once and a
+partially written blob is never visible.
+"""
+import hashlib
+import os
+import tempfile
+import time
+from typing import BinaryIO, Iterable, Iterator, Tuple
+
+BLOB_ROOT = os.path.abspath(os.getenv('ATTACHMENT_DIR', 'attachments'))
+CHUNK_SIZE = 64 * 1024
+MAX_BLOB_SIZE = int(os.getenv('MAX_ATTACHMENT_SIZE', 100 * 1024 * 1024))
+_TEMP_DIR = os.path.join(BLOB_ROOT, 'tmp')
+
+
+class BlobTooLargeError(Exception):
+    """Raised when an upload exceeds MAX_BLOB_SIZE."""
+
+
+def blob_path(digest: str) -> str:
+    """
+    Get the path of a blob.
+
+    :param digest: The SHA-256 hex digest of the blob.
+    :return: The absolute path of the blob file.
+    """
+    return os.path.join(BLOB_ROOT, digest[:2], digest[2:4], digest)
+
+
+def store_stream(stream: BinaryIO, max_size: int = MAX_BLOB_SIZE) -> Tuple[str, int]:
+    """
+    Store a stream in fixed-size chunks without buffering it in memory.
+
+    :param stream: A readable binary stream.
+    :param max_size: Maximum number of bytes accepted.
+    :return: A tuple with the SHA-256 hex digest and the size of the stored blob.
+    :raises BlobTooLargeError: If the stream is longer than max_size.
+    """
+    os.makedirs(_TEMP_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=_TEMP_DIR)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            while chunk := stream.read(CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_size:
+                    raise BlobTooLargeError(f'Attachment exceeds {max_size} bytes')
+                digest.update(chunk)
+                temp_file.write(chunk)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+
+        path = blob_path(digest.hexdigest())
+        if os.path.exists(path):
+            os.remove(temp_path)
+            # Refresh the timestamp so garbage collection keeps the blob until the attachment is committed.
+            os.utime(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    return digest.hexdigest(), size
+
+
+def iter_blobs() -> Iterator[Tuple[str, float]]:
+    """
+    Iterate over all stored blobs.
+
+    :return: An iterator of (digest, modification time) tuples.
+    """
+    for directory, _, file_names in os.walk(BLOB_ROOT):
+        if directory.startswith(_TEMP_DIR):
+            continue
+        for file_name in file_names:
+            yield file_name, os.path.getmtime(os.path.join(directory, file_name))
+
+
+def remove_unreferenced(referenced: Iterable[str], grace_seconds: int = 3600) -> int:
+    """
+    Remove blobs that no attachment references. Blobs younger than the grace period are kept,
+    because an upload may have stored its blob without having committed its attachment yet.
+
+    :param referenced: Digests referenced by attachments.
+    :param grace_seconds: Minimum age of a removed blob.
+    :return: The number of removed blobs.
+    """
+    referenced = set(referenced)
+    cutoff = time.time() - grace_seconds
+    removed = 0
+    for digest, modified_at in list(iter_blobs()):
+        if digest not in referenced and modified_at < cutoff:
+            os.remove(blob_path(digest))
+            removed += 1
+    return removed
@@ -0,0 +1,194 @@
+"""
+Set-based cascading deletes for projects and users.
+
+Dependents are removed with a handful of DELETE/UPDATE statements per table instead of ORM
+per-object cascades. Projects with more than ASYNC_DELETE_THRESHOLD tasks are detached in the
+request (membership and project rows are removed, so the project disappears for every user) and
+their remaining rows are purged by the 'purge_project' job in chunks of PURGE_CHUNK_SIZE tasks,
+one transaction per chunk. A user's project data is released on every shard, the user row is
+removed from the main shard last.
+"""
+from typing import List, Tuple
+
+from sqlalchemy import delete, exists, func, literal, or_, select, update
+from sqlalchemy.orm import Session as DBSession
+
+from .jobs import ProgressCallback, job, no_progress
+from .shards import SHARDS_BY_NAME
+from database.engine_utils import MAIN_SHARD
+from database.map_db import (ArchivedTask, ArchivedTaskLabel, Attachment, Label, Project, ProjectMember, Sprint,
+                             Task, TaskCounter, TaskDependency, TaskDependencyPath, TaskLabel, TaskStatusChange,
+                             TaskTreePath, Tombstone, User, UserSettings)
+from database.revisions import next_revision, record_tombstones
+
+ASYNC_DELETE_THRESHOLD = 5000
+PURGE_CHUNK_SIZE = 1000
+
+
+def _delete_task_rows(session: DBSession, task_ids) -> None:
+    """Delete tasks and their task-level dependents; task_ids is a list or a SELECT of task IDs."""
+    session.execute(delete(TaskLabel).where(TaskLabel.task_id.in_(task_ids)))
+    session.execute(delete(Attachment).where(Attachment.task_id.in_(task_ids)))
+    session.execute(delete(TaskDependency).where(or_(TaskDependency.task_id.in_(task_ids),
+                                                     TaskDependency.blocked_by_id.in_(task_ids))))
+    session.execute(delete(TaskDependencyPath).where(or_(TaskDependencyPath.task_id.in_(task_ids),
+                                                         TaskDependencyPath.blocker_id.in_(task_ids))))
+    session.execute(delete(TaskTreePath).where(or_(TaskTreePath.ancestor_id.in_(task_ids),
+                                                   TaskTreePath.descendant_id.in_(task_ids))))
+    session.execute(delete(Task).where(Task.task_id.in_(task_ids)))
+
+
+def _delete_project_level_rows(session: DBSession, project_id: int) -> None:
+    """Delete the rows that hang directly off a project, once its tasks are gone."""
+    label_ids = select(Label.label_id).where(Label.project_id == project_id)
+    session.execute(delete(TaskLabel).where(TaskLabel.label_id.in_(label_ids)))
+    session.execute(delete(Label).where(Label.project_id == project_id))
+    session.execute(delete(Sprint).where(Sprint.project_id == project_id))
+    session.execute(delete(TaskCounter).where(TaskCounter.project_id == project_id))
+    session.execute(delete(TaskStatusChange).where(TaskStatusChange.project_id == project_id))
+    session.execute(delete(ArchivedTaskLabel).where(ArchivedTaskLabel.project_id == project_id))
+    session.execute(delete(ArchivedTask).where(ArchivedTask.project_id == project_id))
+
+
+def _detach_project(session: DBSession, project_id: int) -> None:
+    """Remove the membership and project rows, leaving a single tombstone for the project."""
+    session.execute(delete(Tombstone).where(Tombstone.project_id == project_id))
+    record_tombstones(session, Project.__tablename__,
+                      select(Project.project_id, literal(project_id)).where(Project.project_id == project_id))
+    session.execute(delete(ProjectMember).where(ProjectMember.project_id == project_id))
+    session.execute(delete(Project).where(Project.project_id == project_id))
+
+
+def delete_project(session: DBSession, project_id: int) -> bool:
+    """
+    Delete a project and its dependents within the session's transaction. The caller commits.
+
+    Large projects are only detached; after committing, the caller must enqueue 'purge_project'.
+
+    :param session: The current database session.
+    :param project_id: The ID of the project.
+    :return: True if all rows were deleted, False if the tasks still have to be purged.
+    """
+    task_count = session.query(func.count(Task.task_id)).filter(Task.project_id == project_id).scalar()
+    _detach_project(session, project_id)
+    if task_count > ASYNC_DELETE_THRESHOLD:
+        return False
+
+    _delete_task_rows(session, select(Task.task_id).where(Task.project_id == project_id))
+    _delete_project_level_rows(session, project_id)
+    return True
+
+
+def remove_project_rows(session: DBSession, project_id: int) -> None:
+    """
+    Remove every row of a project without leaving tombstones, within the session's transaction,
+    e.g. from the shard it was moved away from. The caller commits.
+
+    :param session: The current database session.
+    :param project_id: The ID of the project.
+    """
+    _delete_task_rows(session, select(Task.task_id).where(Task.project_id == project_id))
+    _delete_project_level_rows(session, project_id)
+    session.execute(delete(Tombstone).where(Tombstone.project_id == project_id))
+    session.execute(delete(ProjectMember).where(ProjectMember.project_id == project_id))
+    session.execute(delete(Project).where(Project.project_id == project_id))
+
+
+@job('purge_project')
+def purge_project(project_id: int, shard: str = MAIN_SHARD, progress: ProgressCallback = no_progress) -> None:
+    """
+    Purge the rows of a detached project in chunks, committing after each chunk.
+
+    :param project_id: The ID of the detached project.
+    :param shard: The name of the shard the project was detached on.
+    :param progress: Called with the number of purged and total tasks after each chunk.
+    """
+    with SHARDS_BY_NAME[shard].session() as session:
+        total = session.query(func.count(Task.task_id)).filter(Task.project_id == project_id).scalar()
+        done = 0
+        progress(done, total)
+        while True:
+            task_ids: List[int] = session.scalars(
+                select(Task.task_id).where(Task.project_id == project_id).limit(PURGE_CHUNK_SIZE)
+            ).all()
+            if not task_ids:
+                break
+            _delete_task_rows(session, task_ids)
+            session.commit()
+            done += len(task_ids)
+            progress(done, total)
+
+        _delete_project_level_rows(session, project_id)
+        session.commit()
+
+
+def release_user(session: DBSession, user_id: int) -> Tuple[List[int], List[int]]:
+    """
+    Reassign or remove the project data of a shard referencing a user, within the session's
+    transaction. The caller commits.
+
+    Owned projects are handed over to the remaining member with the lowest ID; owned projects without
+    other members are deleted. Assigned tasks become unassigned and memberships are removed.
+
+    :param session: The database session of the shard.
+    :param user_id: The ID of the user.
+    :return: IDs of the deleted projects, and IDs of those whose tasks still have to be purged.
+    """
+    new_owners = (
+        select(ProjectMember.project_id, func.min(ProjectMember.member_id).label('member_id'))
+        .where(ProjectMember.member_id != user_id)
+        .group_by(ProjectMember.project_id)
+        .subquery()
+    )
+    has_other_member = exists().where(ProjectMember.project_id == Project.project_id,
+                                      ProjectMember.member_id != user_id)
+
+    orphaned_project_ids = session.scalars(
+        select(Project.project_id).where(Project.created_by == user_id, ~has_other_member)
+    ).all()
+    pending_purges = [project_id for project_id in orphaned_project_ids if not delete_project(session, project_id)]
+
+    revision = next_revision(session)
+    session.execute(
+        update(Project).where(Project.created_by == user_id, Project.project_id == new_owners.c.project_id)
+        .values(created_by=new_owners.c.member_id, revision=revision)
+        .execution_options(synchronize_session=False)
+    )
+    session.execute(
+        update(Task).where(Task.assigned_to == user_id)
+        .values(assigned_to=None, revision=revision)
+        .execution_options(synchronize_session=False)
+    )
+    session.execute(
+        update(TaskCounter)
+        .where(TaskCounter.dimension == 'assignee', TaskCounter.dimension_key == str(user_id))
+        .values(dimension_key='')
+        .execution_options(synchronize_session=False)
+    )
+    session.execute(
+        update(TaskStatusChange).where(TaskStatusChange.changed_by == user_id)
+        .values(changed_by=None)
+        .execution_options(synchronize_session=False)
+    )
+
+    record_tombstones(session, ProjectMember.__tablename__,
+                      select(ProjectMember.task_label_id, ProjectMember.project_id)
+                      .where(ProjectMember.member_id == user_id), revision)
+    session.execute(delete(ProjectMember).where(ProjectMember.member_id == user_id))
+    return orphaned_project_ids, pending_purges
+
+
+def delete_user(session: DBSession, user_id: int) -> Tuple[List[int], List[int]]:
+    """
+    Delete a user within the session's transaction of the main shard, after releasing the project
+    data of the main shard (see release_user). The caller commits, and releases the user's data
+    on the other shards before.
+
+    :param session: The database session of the main shard.
+    :param user_id: The ID of the user.
+    :return: IDs of the deleted projects, and IDs of those whose tasks still have to be purged.
+    """
+    released = release_user(session, user_id)
+    session.execute(delete(UserSettings).where(UserSettings.user_id == user_id))
+    session.execute(delete(User).where(User.user_id == user_id))
+    return released
@@ -0,0 +1,147 @@
+"""
+Project change events published to Redis and streamed to clients as Server-Sent Events.
+
+Mutating routes publish compact JSON events on the 'project:<project_id>:events' channel.
+Each worker process keeps a single pattern subscription and fans incoming messages out to the
+in-memory queues of its connected clients, so idle streams cost a queue and a waiting thread
+(or greenlet under a gevent server) instead of a Redis connection each.
+"""
+import json
+import logging
+import queue
+import threading
+import time
+from typing import Any, Dict, Iterator, Optional, Set
+
+import redis
+
+from .redisclient import redis_client
+
+CHANNEL_PREFIX = 'project:'
+CHANNEL_SUFFIX = ':events'
+HEARTBEAT_SECONDS = 15
+CLIENT_QUEUE_SIZE = 256
+RECONNECT_DELAY_SECONDS = 1
+CLIENT_RETRY_MILLISECONDS = 3000
+
+# Sent to clients when events may have been lost and they should refetch.
+RESYNC_EVENT = json.dumps({'type': 'resync'})
+
+logger = logging.getLogger(__name__)
+
+
+def channel_for(project_id: int) -> str:
+    """
+    Get the Redis channel of a project.
+
+    :param project_id: The ID of the project.
+    :return: The channel name.
+    """
+    return f'{CHANNEL_PREFIX}{project_id}{CHANNEL_SUFFIX}'
+
+
+def publish_event(project_id: int, event_type: str, **payload: Any) -> None:
+    """
+    Publish a change event to the subscribers of a project.
+
+    :param project_id: The ID of the project the change belongs to.
+    :param event_type: The event type, e.g. 'task.updated'.
+    :param payload: Additional event fields, typically IDs of the changed rows.
+    """
+    redis_client.publish(channel_for(project_id), json.dumps({'type': event_type, **payload}))
+
+
+class EventBroker:
+    """Fans out messages of one Redis pattern subscription to per-client queues."""
+
+    def __init__(self, client: redis.StrictRedis):
+        self._client = client
+        self._clients: Dict[int, Set[queue.Queue]] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def subscribe(self, project_id: int) -> queue.Queue:
+        """
+        Register a client queue for the events of a project.
+
+        :param project_id: The ID of the project.
+        :return: The queue receiving the serialized events.
+        """
+        client_queue: queue.Queue = queue.Queue(maxsize=CLIENT_QUEUE_SIZE)
+        with self._lock:
+            self._clients.setdefault(project_id, set()).add(client_queue)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._listen, name='event-broker', daemon=True)
+                self._thread.start()
+        return client_queue
+
+    def unsubscribe(self, project_id: int, client_queue: queue.Queue) -> None:
+        """
+        Remove a client queue.
+
+        :param project_id: The ID of the project.
+        :param client_queue: The queue returned by subscribe.
+        """
+        with self._lock:
+            queues = self._clients.get(project_id)
+            if queues is not None:
+                queues.discard(client_queue)
+                if not queues:
+                    del self._clients[project_id]
+
+    def _dispatch(self, project_id: Optional[int], data: str) -> None:
+        with self._lock:
+            if project_id is None:
+                targets = [client_queue for queues in self._clients.values() for client_queue in queues]
+            else:
+                targets = list(self._clients.get(project_id, ()))
+        for client_queue in targets:
+            try:
+                client_queue.put_nowait(data)
+            except queue.Full:
+                # A slow client missed events; drop its backlog and ask it to resync.
+                with client_queue.mutex:
+                    client_queue.queue.clear()
+                client_queue.put_nowait(RESYNC_EVENT)
+
+    def _listen(self) -> None:
+        while True:
+            try:
+                pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(f'{CHANNEL_PREFIX}*{CHANNEL_SUFFIX}')
+                for message in pubsub.listen():
+                    channel = message['channel']
+                    project_id = channel[len(CHANNEL_PREFIX):-len(CHANNEL_SUFFIX)]
+                    if project_id.isdigit():
+                        self._dispatch(int(project_id), message['data'])
+            except redis.RedisError:
+                logger.warning('Lost connection to Redis, resubscribing to project events')
+            except Exception:
+                logger.exception('Project event listener failed, resubscribing to project events')
+            # Events may have been missed while resubscribing.
+            self._dispatch(None, RESYNC_EVENT)
+            time.sleep(RECONNECT_DELAY_SECONDS)
+
+
+broker = EventBroker(redis_client)
+
+
+def stream_events(project_id: int) -> Iterator[str]:
+    """
+    Generate the Server-Sent Events stream of a project, with periodic heartbeats.
+
+    :param project_id: The ID of the project.
+    :return: An iterator of SSE-formatted messages.
+    """
+    client_queue = broker.subscribe(project_id)
+    try:
+        yield f'retry: {CLIENT_RETRY_MILLISECONDS}\n\n'
+        while True:
+            try:
+                data = client_queue.get(timeout=HEARTBEAT_SECONDS)
+            except queue.Empty:
+                yield ': heartbeat\n\n'
+                continue
+            yield f'data: {data}\n\n'
+    finally:
+        broker.unsubscribe(project_id, client_queue)
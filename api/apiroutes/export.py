@@ -0,0 +1,195 @@
+"""
+Streaming export of project data.
+
+Rows are read with server-side cursors (yield_per) and encoded in batches of EXPORT_BATCH_SIZE,
+so memory use does not depend on the size of the export. Each generator opens its own database
+sessions, one per shard holding exported projects, because a streamed response outlives the session
+of the request that returned it.
+
+NDJSON exports contain every table, archived tasks included, one '{"table", "project_id", "row"}'
+object per line. CSV and Parquet are tabular and export a single table.
+"""
+import csv
+import io
+import json
+from typing import Any, Dict, Iterator, List
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import Boolean, Date, Integer, TIMESTAMP
+
+from .shards import partition_projects
+from .sync import SYNCED_TABLES, project_rows_query, row_to_dict
+from database.map_db import ArchivedTask, ArchivedTaskLabel, Task, TaskLabel
+
+EXPORT_BATCH_SIZE = 1000
+NDJSON = 'ndjson'
+CSV = 'csv'
+PARQUET = 'parquet'
+EXPORT_FORMATS = (NDJSON, CSV, PARQUET)
+MIMETYPES = {NDJSON: 'application/x-ndjson', CSV: 'text/csv', PARQUET: 'application/vnd.apache.parquet'}
+EXPORTED_TABLES = {**{name: model for name, model in SYNCED_TABLES.items() if name != 'deleted'},
+                   'archived_tasks': ArchivedTask, 'archived_task_labels': ArchivedTaskLabel}
+
+
+def exported_columns(model: Any) -> List[str]:
+    """
+    Get the exported columns of a model, in table order.
+
+    :param model: The model.
+    :return: The attribute names.
+    """
+    return [attribute.key for attribute in model.__mapper__.column_attrs if not attribute.key.startswith('_')]
+
+
+def _iter_rows(model: Any, project_ids: List[int], read: bool) -> Iterator[Any]:
+    for shard, shard_project_ids in partition_projects(project_ids, read):
+        with shard.session_factory(read)() as session:
+            yield from project_rows_query(session, model, shard_project_ids).yield_per(EXPORT_BATCH_SIZE)
+
+
+def export_ndjson(project_ids: List[int], read: bool = False) -> Iterator[str]:
+    """
+    Export every table of the given projects as NDJSON.
+
+    :param project_ids: IDs of the exported projects.
+    :param read: Read the rows with the read engines.
+    :return: An iterator of text chunks.
+    """
+    for shard, shard_project_ids in partition_projects(project_ids, read):
+        with shard.session_factory(read)() as session:
+            for name, model in EXPORTED_TABLES.items():
+                lines = []
+                project_id_column = Task.project_id if model is TaskLabel else model.project_id
+                query = project_rows_query(session, model, shard_project_ids).add_columns(project_id_column)
+                for row, project_id in query.yield_per(EXPORT_BATCH_SIZE):
+                    lines.append(json.dumps({'table': name, 'project_id': project_id, 'row': row_to_dict(row)}) + '\n')
+                    if len(lines) >= EXPORT_BATCH_SIZE:
+                        yield ''.join(lines)
+                        lines = []
+                if lines:
+                    yield ''.join(lines)
+
+
+def export_csv(project_ids: List[int], table: str, read: bool = False) -> Iterator[str]:
+    """
+    Export one table of the given projects as CSV with a header row.
+
+    :param project_ids: IDs of the exported projects.
+    :param table: Name of the table in EXPORTED_TABLES.
+    :param read: Read the rows with the read engines.
+    :return: An iterator of text chunks.
+    """
+    model = EXPORTED_TABLES[table]
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=exported_columns(model))
+    writer.writeheader()
+    rows = 0
+    for row in _iter_rows(model, project_ids, read):
+        writer.writerow(row_to_dict(row))
+        rows += 1
+        if rows % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _arrow_type(column_type: Any) -> pa.DataType:
+    if isinstance(column_type, Boolean):
+        return pa.bool_()
+    if isinstance(column_type, Integer):
+        return pa.int64()
+    if isinstance(column_type, TIMESTAMP):
+        return pa.timestamp('us')
+    if isinstance(column_type, Date):
+        return pa.date32()
+    return pa.string()
+
+
+def arrow_schema(model: Any) -> pa.Schema:
+    """
+    Build the Arrow schema of a model's exported columns.
+
+    :param model: The model.
+    :return: The schema.
+    """
+    mapper = model.__mapper__
+    return pa.schema([(key, _arrow_type(mapper.column_attrs[key].columns[0].type)) for key in exported_columns(model)])
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object collecting the bytes written since the last drain."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Any) -> int:
+        chunk = bytes(data)
+        self._chunks.append(chunk)
+        self._position += len(chunk)
+        return len(chunk)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def export_parquet(project_ids: List[int], table: str, read: bool = False) -> Iterator[bytes]:
+    """
+    Export one table of the given projects as Parquet, one row group per batch.
+
+    :param project_ids: IDs of the exported projects.
+    :param table: Name of the table in EXPORTED_TABLES.
+    :param read: Read the rows with the read engines.
+    :return: An iterator of byte chunks.
+    """
+    model = EXPORTED_TABLES[table]
+    schema = arrow_schema(model)
+    columns = exported_columns(model)
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+
+    def write_batch(batch: List[Any]) -> bytes:
+        data: Dict[str, List[Any]] = {column: [getattr(row, column) for row in batch] for column in columns}
+        writer.write_table(pa.Table.from_pydict(data, schema=schema))
+        return sink.drain()
+
+    batch: List[Any] = []
+    for row in _iter_rows(model, project_ids, read):
+        batch.append(row)
+        if len(batch) >= EXPORT_BATCH_SIZE:
+            yield write_batch(batch)
+            batch = []
+    if batch:
+        yield write_batch(batch)
+
+    writer.close()
+    yield sink.drain()
+
+
+def export_chunks(project_ids: List[int], export_format: str, table: str = 'tasks',
+                  read: bool = False) -> Iterator[Any]:
+    """
+    Export the given projects in a format.
+
+    :param project_ids: IDs of the exported projects.
+    :param export_format: One of EXPORT_FORMATS.
+    :param table: The exported table for CSV and Parquet; ignored for NDJSON.
+    :param read: Read the rows with the read engines, which may lag behind writes.
+    :return: An iterator of text (NDJSON, CSV) or byte (Parquet) chunks.
+    """
+    if export_format == NDJSON:
+        return export_ndjson(project_ids, read)
+    if export_format == CSV:
+        return export_csv(project_ids, table, read)
+    return export_parquet(project_ids, table, read)
@@ -0,0 +1,5 @@
+from flask import Blueprint
+
+jobs = Blueprint('jobs', __name__, url_prefix='/jobs')
+
+from .routes import *
\ No newline at end of file
@@ -0,0 +1,22 @@
+from typing import Any, Dict, Tuple
+from flask import jsonify, g
+from . import jobs
+from .. import jobs as jobqueue
+from ..utils import require_user
+
+
+@jobs.route('/<job_id>', methods=['GET'])
+@require_user
+def get_job(job_id: str) -> Tuple[Dict[str, Any], int]:
+    """
+    Retrieve the status and progress of a background job started by the current user.
+
+    :param job_id: The ID of the job.
+    :return: A JSON response with the job status and a 200 status code if found,
+             otherwise an error message with a 404 status code.
+    """
+    job = jobqueue.get_job(job_id)
+    if not job or job['user_id'] != g.user.user_id:
+        return jsonify({'error': 'Job not found'}), 404
+
+    return jsonify(job), 200
@@ -0,0 +1,234 @@
+"""
+Background jobs queued in Redis and executed by the worker processes started with worker.py.
+
+Keys:
+    jobs:queue                  list of job IDs waiting to run
+    jobs:delayed                sorted set of job IDs waiting for a retry, scored by the due time
+    jobs:processing:<worker>    list of job IDs taken by a worker; requeued when the worker restarts
+    job:<job_id>                hash with the name, arguments, status and progress of a job
+
+Handlers are registered with the 'job' decorator and receive their keyword arguments plus a
+'progress' callback. A job is retried with exponential backoff until it has been attempted
+'max_attempts' times. Jobs are delivered at least once, so handlers must be idempotent.
+"""
+import importlib
+import json
+import logging
+import time
+import traceback
+import uuid
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional
+
+from .redisclient import redis_client
+
+QUEUE_KEY = 'jobs:queue'
+DELAYED_KEY = 'jobs:delayed'
+PROCESSING_PREFIX = 'jobs:processing:'
+JOB_PREFIX = 'job:'
+JOB_TTL_SECONDS = 7 * 24 * 3600
+DEFAULT_MAX_ATTEMPTS = 3
+RETRY_BACKOFF_SECONDS = 5
+POLL_TIMEOUT_SECONDS = 1
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+# Modules registering job handlers, imported by the workers.
+HANDLER_MODULES = ('apiroutes.archive', 'apiroutes.cascade', 'apiroutes.searchindex', 'apiroutes.taskimport',
+                   'apiroutes.taskranks')
+
+ProgressCallback = Callable[..., None]
+
+logger = logging.getLogger(__name__)
+
+_handlers: Dict[str, Callable[..., Any]] = {}
+_max_attempts: Dict[str, int] = {}
+
+# Moves due retries back to the queue atomically.
+_promote_delayed = redis_client.register_script("""
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, 100)
+for _, job_id in ipairs(due) do
+    redis.call('ZREM', KEYS[1], job_id)
+    redis.call('LPUSH', KEYS[2], job_id)
+end
+return #due
+""")
+
+
+def job(name: str, max_attempts: int = DEFAULT_MAX_ATTEMPTS) -> Callable:
+    """
+    Decorator registering a function as the handler of a job.
+
+    :param name: The name the job is enqueued with.
+    :param max_attempts: Number of attempts before the job is marked as failed.
+    :return: The decorator, returning the function unchanged.
+    """
+    def decorator(func: Callable[..., Any]) -> Callable[..., Any]:
+        if name in _handlers:
+            raise ValueError(f'Job {name} is already registered')
+        _handlers[name] = func
+        _max_attempts[name] = max_attempts
+        return func
+    return decorator
+
+
+def no_progress(done: int, total: Optional[int] = None, message: Optional[str] = None) -> None:
+    """Progress callback used when a handler is called directly instead of by a worker."""
+
+
+def load_handlers() -> None:
+    """
+    Import the modules registering job handlers.
+    """
+    for module in HANDLER_MODULES:
+        importlib.import_module(module)
+
+
+def job_key(job_id: str) -> str:
+    """
+    Get the Redis key of a job's hash.
+
+    :param job_id: The ID of the job.
+    :return: The key.
+    """
+    return f'{JOB_PREFIX}{job_id}'
+
+
+def _now() -> str:
+    return datetime.utcnow().isoformat()
+
+
+def enqueue(name: str, user_id: Optional[int] = None, **kwargs: Any) -> str:
+    """
+    Queue a job.
+
+    :param name: The name of the registered handler.
+    :param user_id: The ID of the user the job belongs to.
+    :param kwargs: JSON-serializable arguments passed to the handler.
+    :return: The ID of the job.
+    """
+    job_id = uuid.uuid4().hex
+    key = job_key(job_id)
+    pipeline = redis_client.pipeline()
+    pipeline.hset(key, mapping={
+        'name': name,
+        'kwargs': json.dumps(kwargs),
+        'user_id': '' if user_id is None else user_id,
+        'status': QUEUED,
+        'attempts': 0,
+        'max_attempts': _max_attempts.get(name, DEFAULT_MAX_ATTEMPTS),
+        'done': 0,
+        'total': '',
+        'message': '',
+        'created_at': _now()
+    })
+    pipeline.expire(key, JOB_TTL_SECONDS)
+    pipeline.lpush(QUEUE_KEY, job_id)
+    pipeline.execute()
+    return job_id
+
+
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Get the state of a job.
+
+    :param job_id: The ID of the job.
+    :return: A dict with the job state, or None if the job does not exist or has expired.
+    """
+    data = redis_client.hgetall(job_key(job_id))
+    if not data:
+        return None
+
+    total = int(data['total']) if data.get('total') else None
+    done = int(data.get('done') or 0)
+    return {
+        'job_id': job_id,
+        'name': data['name'],
+        'user_id': int(data['user_id']) if data.get('user_id') else None,
+        'status': data['status'],
+        'attempts': int(data['attempts']),
+        'max_attempts': int(data['max_attempts']),
+        'done': done,
+        'total': total,
+        'progress': min(done / total, 1.0) if total else None,
+        'message': data.get('message') or None,
+        'result': json.loads(data['result']) if data.get('result') else None,
+        'error': data.get('error') or None,
+        'created_at': data.get('created_at'),
+        'started_at': data.get('started_at'),
+        'finished_at': data.get('finished_at')
+    }
+
+
+def _progress_reporter(key: str) -> ProgressCallback:
+    def report(done: int, total: Optional[int] = None, message: Optional[str] = None) -> None:
+        fields: Dict[str, Any] = {'done': done}
+        if total is not None:
+            fields['total'] = total
+        if message is not None:
+            fields['message'] = message
+        redis_client.hset(key, mapping=fields)
+    return report
+
+
+def run_job(job_id: str) -> None:
+    """
+    Execute one job and record its outcome, scheduling a retry when it fails.
+
+    :param job_id: The ID of the job.
+    """
+    key = job_key(job_id)
+    data = redis_client.hgetall(key)
+    if not data:
+        return
+
+    attempts = redis_client.hincrby(key, 'attempts', 1)
+    redis_client.hset(key, mapping={'status': RUNNING, 'started_at': _now(), 'error': ''})
+
+    handler = _handlers.get(data['name'])
+    if handler is None:
+        redis_client.hset(key, mapping={'status': FAILED, 'error': f'Unknown job {data["name"]}',
+                                        'finished_at': _now()})
+        return
+
+    try:
+        result = handler(progress=_progress_reporter(key), **json.loads(data['kwargs']))
+    except Exception:
+        logger.exception('Job %s (%s) failed on attempt %s', job_id, data['name'], attempts)
+        error = traceback.format_exc(limit=5)
+        if attempts < int(data['max_attempts']):
+            redis_client.hset(key, mapping={'status': QUEUED, 'error': error})
+            redis_client.zadd(DELAYED_KEY, {job_id: time.time() + RETRY_BACKOFF_SECONDS * 2 ** (attempts - 1)})
+        else:
+            redis_client.hset(key, mapping={'status': FAILED, 'error': error, 'finished_at': _now()})
+        return
+
+    redis_client.hset(key, mapping={'status': SUCCEEDED, 'result': json.dumps(result), 'finished_at': _now()})
+
+
+def run_worker(worker_id: str, should_stop: Callable[[], bool]) -> None:
+    """
+    Take jobs from the queue and run them until should_stop returns True.
+
+    Jobs a previous run of the same worker left unfinished are requeued first, so worker IDs
+    should be stable across restarts.
+
+    :param worker_id: A stable identifier of the worker.
+    :param should_stop: Called between jobs; the worker returns once it is True.
+    """
+    processing_key = f'{PROCESSING_PREFIX}{worker_id}'
+    while redis_client.lmove(processing_key, QUEUE_KEY, 'RIGHT', 'RIGHT'):
+        pass
+
+    while not should_stop():
+        _promote_delayed(keys=[DELAYED_KEY, QUEUE_KEY], args=[time.time()])
+        job_id = redis_client.blmove(QUEUE_KEY, processing_key, POLL_TIMEOUT_SECONDS, 'RIGHT', 'LEFT')
+        if job_id is None:
+            continue
+        try:
+            run_job(job_id)
+        finally:
+            redis_client.lrem(processing_key, 1, job_id)
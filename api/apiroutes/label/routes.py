@@ -1,9 +1,14 @@
 from typing import Dict, List, Tuple, Any
 from flask import request, jsonify, g
+from sqlalchemy import and_, delete, select
 from . import labels
-from ..commitoperations import delete_object, add_object
-from ..utils import require_project_access, require_label_access
-from database.map_db import Label
+from ..commitoperations import add_object
+from ..utils import authorized_delete, is_project_member, require_project_access, require_user, shard_session
+from .. import searchindex, shards, taskcounters
+from ..events import publish_event
+from ..refcache import LABELS, get_reference_data, invalidate_reference_data
+from database.map_db import Label, TaskCounter, TaskLabel
+from database.revisions import next_revision, record_tombstones
 
 
 @labels.route('', methods=['POST'])
@@ -24,21 +29,58 @@ def add_label() -> Tuple[Dict[str, Any], int]:
         project_id=data['project_id']
     )
     add_object(label)
+    invalidate_reference_data(label.project_id, LABELS)
+    publish_event(label.project_id, 'label.created', label_id=label.label_id)
 
     return jsonify({'success': 'Label added', 'label_id': label.label_id}), 201
 
 
 @labels.route('/<int:label_id>', methods=['DELETE'])
-@require_label_access('label_id')
+@require_user
 def delete_label(label_id: int) -> Tuple[Dict[str, str], int]:
     """
-    Delete a specific label.
+    Delete a specific label together with its task assignments and counters. The membership is
+    checked by the statements themselves: each only applies to a label of a project the user is a member of.
 
     :param label_id: The ID of the label to be deleted.
-    :return: A JSON response with a success message and a 200 status code.
+    :return: A JSON response with a success message and a 200 status code if successful,
+             otherwise an error message with a 403 or 503 status code.
     """
-    delete_object(g.resource)
-    return jsonify({'success': 'Label deleted'}), 200
+    authorized = and_(Label.label_id == label_id, is_project_member(Label.project_id, g.user.user_id))
+    for shard in shards.candidate_shards(Label.__tablename__, label_id):
+        with shard_session(shard) as session_db:
+            revision = next_revision(session_db)
+            session_db.execute(
+                delete(TaskCounter).where(
+                    TaskCounter.project_id.in_(select(Label.project_id).where(authorized)),
+                    TaskCounter.dimension == taskcounters.LABEL,
+                    TaskCounter.dimension_key == str(label_id)),
+                execution_options={'synchronize_session': False}
+            )
+            record_tombstones(session_db, TaskLabel.__tablename__,
+                              select(TaskLabel.task_label_id, Label.project_id)
+                              .join(Label, TaskLabel.label_id == Label.label_id).where(authorized), revision)
+            session_db.execute(
+                delete(TaskLabel).where(TaskLabel.label_id.in_(select(Label.label_id).where(authorized))),
+                execution_options={'synchronize_session': False}
+            )
+            project_id = authorized_delete(session_db, Label, label_id,
+                                           is_project_member(Label.project_id, g.user.user_id), revision)
+            if project_id is None:
+                session_db.rollback()
+                continue
+            if shards.is_frozen(project_id):
+                session_db.rollback()
+                return jsonify({'error': 'Project is being moved, try again later'}), 503
+            session_db.commit()
+            shards.remember_location(Label.__tablename__, label_id, shard)
+
+        invalidate_reference_data(project_id, LABELS)
+        searchindex.remove_label(project_id, label_id)
+        publish_event(project_id, 'label.deleted', label_id=label_id)
+        return jsonify({'success': 'Label deleted'}), 200
+
+    return jsonify({'error': 'User does not have access to this label operation'}), 403
 
 
 @labels.route('/by_project/<int:project_id>', methods=['GET'])
@@ -50,5 +92,4 @@ def get_labels_by_project(project_id: int) -> Tuple[List[Dict[str, Any]], int]:
     :param project_id: The ID of the project.
     :return: A JSON response with a list of labels for the specified project and a 200 status code.
     """
-    labels = g.session.query(Label).filter(Label.project_id == project_id).all()
-    return jsonify([{'label_id': label.label_id, 'name': label.name, 'project_id': label.project_id} for label in labels]), 200
+    return jsonify(get_reference_data(g.session, project_id, LABELS)), 200
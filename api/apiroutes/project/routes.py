@@ -1,9 +1,16 @@
-from typing import Dict, Tuple, Any
-from flask import request, jsonify, g
+from typing import Dict, List, Tuple, Any
+from flask import Response, request, jsonify, g
+from sqlalchemy.orm import Session as DBSession
 from . import projects
-from ..session import Session
 from ..commitoperations import add_object
-from ..utils import require_user, require_project_owner_access, require_project_access
+from .. import cascade, export, jobs, searchindex, shards, taskcounters, taskimport
+from ..events import publish_event, stream_events
+from ..refcache import invalidate_reference_data
+from ..resultcache import cached
+from ..singleflight import single_flight
+from ..sync import MAX_CHANGES_PER_TABLE, collect_changes
+from ..utils import (authorized_update, require_user, require_project_owner_access, require_project_access, shard_session,
+                     use_read_engines)
 from database.map_db import Project, ProjectMember
 
 
@@ -11,7 +18,7 @@ from database.map_db import Project, ProjectMember
 @require_user
 def add_project() -> Tuple[Dict[str, str], int]:
     """
-    Add a new project and assign the user to it.
+    Add a new project, on one of the shards receiving new projects, and assign the user to it.
 
     :return: A JSON response with a success message and a 201 status code if successful,
              otherwise an error message with a 400 status code.
@@ -24,33 +31,37 @@ def add_project() -> Tuple[Dict[str, str], int]:
     if not name or not description:
         return jsonify({'error': 'Name and description cannot be empty'}), 400
 
-    project = Project(
-        name=name,
-        description=description,
-        created_by=g.user.user_id
-    )
+    with shard_session(shards.placement_shard()) as session_db:
+        # add_object commits g.session, which require_user pops after the request.
+        g.session = session_db
+        project = Project(
+            name=name,
+            description=description,
+            created_by=g.user.user_id
+        )
 
-    add_object(project)
-    project_id = project.project_id
+        add_object(project)
+        project_id = project.project_id
 
-    project_member = ProjectMember(
-        project_id=project_id,
-        member_id=g.user.user_id
-    )
-    add_object(project_member)
+        project_member = ProjectMember(
+            project_id=project_id,
+            member_id=g.user.user_id
+        )
+        taskcounters.initialize_project_counters(g.session, project_id)
+        add_object(project_member)
 
     return jsonify({'success': 'Project added and user assigned'}), 201
 
 
 @projects.route('/<int:project_id>', methods=['PUT'])
-@require_project_owner_access('project_id')
+@require_user
 def update_project(project_id: int) -> Tuple[Dict[str, str], int]:
     """
-    Update an existing project.
+    Update an existing project. Only the owner may update it; the ownership is checked by the UPDATE itself.
 
     :param project_id: The ID of the project to be updated.
     :return: A JSON response with a success message and a 200 status code if successful,
-             otherwise an error message with a 400 status code.
+             otherwise an error message with a 400 or 403 status code.
     """
     data = request.get_json()
 
@@ -60,30 +71,57 @@ def update_project(project_id: int) -> Tuple[Dict[str, str], int]:
     if not name or not description:
         return jsonify({'error': 'Name and description cannot be empty'}), 400
 
-    g.resource.name = name
-    g.resource.description = description
-    g.session.commit()
+    if shards.is_frozen(project_id):
+        return jsonify({'error': 'Project is being moved, try again later'}), 503
 
-    return jsonify({'success': 'Project updated'}), 200
+    for shard in shards.candidate_shards(Project.__tablename__, project_id):
+        with shard_session(shard) as session_db:
+            if authorized_update(session_db, Project, project_id, Project.created_by == g.user.user_id,
+                                 name=name, description=description):
+                session_db.commit()
+                shards.remember_location(Project.__tablename__, project_id, shard)
+                return jsonify({'success': 'Project updated'}), 200
+
+    return jsonify({'error': 'User does not have access to this project operation'}), 403
 
 
 @projects.route('/<int:project_id>', methods=['DELETE'])
 @require_project_owner_access('project_id')
 def delete_project(project_id: int) -> Tuple[Dict[str, str], int]:
     """
-    Delete an existing project.
+    Delete an existing project together with its tasks, sprints, labels and memberships.
 
     :param project_id: The ID of the project to be deleted.
-    :return: A JSON response with a success message and a 200 status code if successful.
+    :return: A JSON response with a success message and a 200 status code if successful,
+             or a 202 status code and the ID of the purge job if the tasks of a large project are
+             still being deleted.
     """
-    # TODO: Delete all references
-    with Session() as session:
-        session.delete(g.resource)
-        session.commit()
+    finished = cascade.delete_project(g.session, project_id)
+    g.session.commit()
+    searchindex.drop_project_index(project_id)
+    invalidate_reference_data(project_id)
+    publish_event(project_id, 'project.deleted')
+
+    if not finished:
+        job_id = jobs.enqueue('purge_project', user_id=g.user.user_id, project_id=project_id, shard=g.shard.name)
+        return jsonify({'success': 'Project deletion started', 'job_id': job_id}), 202
 
     return jsonify({'success': 'Project deleted'}), 200
 
 
+@projects.route('/<int:project_id>/reindex', methods=['POST'])
+@require_project_owner_access('project_id')
+def reindex_project(project_id: int) -> Tuple[Dict[str, str], int]:
+    """
+    Rebuild the task search index of a project in the background.
+
+    :param project_id: The ID of the project.
+    :return: A JSON response with the ID of the job and a 202 status code.
+    """
+    job_id = jobs.enqueue('reindex_project', user_id=g.user.user_id, project_id=project_id)
+    return jsonify({'success': 'Reindexing started', 'job_id': job_id}), 202
+
+
 @projects.route('/<int:project_id>', methods=['GET'])
 @require_project_access('project_id')
 def get_project(project_id: int) -> Tuple[Dict[str, Any], int]:
@@ -108,19 +146,138 @@ def get_project(project_id: int) -> Tuple[Dict[str, Any], int]:
 @require_user
 def get_user_projects() -> Tuple[Any, int]:
     """
-    Retrieve all projects associated with the current user.
+    Retrieve all projects associated with the current user, gathered from every shard.
+    With 'include_counts=true', every project also carries its task counts.
 
     :return: A JSON response with a list of projects and a 200 status code.
     """
-    user_projects = g.session.query(Project).join(
-        ProjectMember).filter(ProjectMember.member_id == g.user.user_id).all()
+    user_id = g.user.user_id
+    include_counts = request.args.get('include_counts', 'false').lower() == 'true'
+
+    def load_projects(session_db: DBSession) -> List[Dict[str, Any]]:
+        user_projects = cached(session_db.query(Project).join(
+            ProjectMember).filter(ProjectMember.member_id == user_id)).all()
+
+        projects_list = [{
+            'project_id': project.project_id,
+            'name': project.name,
+            'description': project.description,
+            'created_by': project.created_by,
+            'is_owner': project.created_by == user_id
+        } for project in user_projects]
+
+        if include_counts:
+            counts = taskcounters.get_project_counts(session_db, [project['project_id'] for project in projects_list])
+            for project in projects_list:
+                project['task_counts'] = counts[project['project_id']]
+        return projects_list
+
+    return jsonify(shards.scatter(load_projects, g.session, read=use_read_engines())), 200
+
+
+@projects.route('/<int:project_id>/counts', methods=['GET'])
+@require_project_access('project_id')
+@single_flight()
+def get_project_counts(project_id: int) -> Tuple[Dict[str, Any], int]:
+    """
+    Retrieve task counts of a project per status, sprint, assignee and label.
+
+    :param project_id: The ID of the project.
+    :return: A JSON response with the task counts and a 200 status code.
+    """
+    return jsonify(taskcounters.get_project_counts(g.session, [project_id])[project_id]), 200
+
+
+@projects.route('/<int:project_id>/events', methods=['GET'])
+@require_project_access('project_id')
+def get_project_events(project_id: int) -> Response:
+    """
+    Stream change events of a project (tasks, labels and sprints) as Server-Sent Events.
+
+    :param project_id: The ID of the project.
+    :return: A streaming 'text/event-stream' response.
+    """
+    return Response(stream_events(project_id), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+@projects.route('/<int:project_id>/changes', methods=['GET'])
+@require_project_access('project_id')
+def get_project_changes(project_id: int) -> Tuple[Dict[str, Any], int]:
+    """
+    Retrieve the project rows changed or deleted after the revision given in 'since'.
+    Clients pass the returned 'revision' as the next 'since' and repeat while 'has_more' is set.
+    Changes are read through the write engine, see collect_changes.
+
+    :param project_id: The ID of the project.
+    :return: A JSON response with the changed rows per table and a 200 status code,
+             otherwise an error message with a 400 status code.
+    """
+    since = request.args.get('since', 0, type=int)
+    limit = request.args.get('limit', MAX_CHANGES_PER_TABLE, type=int)
+    if since < 0 or not 0 < limit <= MAX_CHANGES_PER_TABLE:
+        return jsonify({'error': f'since must be non-negative and limit between 1 and {MAX_CHANGES_PER_TABLE}'}), 400
+
+    with g.shard.session() as session_db:
+        return jsonify(collect_changes(session_db, project_id, since, limit)), 200
+
+
+@projects.route('/<int:project_id>/export', methods=['GET'])
+@require_project_access('project_id')
+def export_project(project_id: int) -> Response:
+    """
+    Stream an export of a project. 'format' is ndjson (default, every table), csv or parquet;
+    csv and parquet export the table given in 'table' (default tasks).
+
+    :param project_id: The ID of the project.
+    :return: A streaming response with the export as an attachment,
+             otherwise an error message with a 400 status code.
+    """
+    export_format = request.args.get('format', export.NDJSON)
+    table = request.args.get('table', 'tasks')
+    if export_format not in export.EXPORT_FORMATS:
+        return jsonify({'error': f'format must be one of {", ".join(export.EXPORT_FORMATS)}'}), 400
+    if table not in export.EXPORTED_TABLES:
+        return jsonify({'error': f'table must be one of {", ".join(export.EXPORTED_TABLES)}'}), 400
+
+    file_name = f'project-{project_id}.{export_format}' if export_format == export.NDJSON \
+        else f'project-{project_id}-{table}.{export_format}'
+    return Response(export.export_chunks([project_id], export_format, table, read=use_read_engines()),
+                    mimetype=export.MIMETYPES[export_format],
+                    headers={'Content-Disposition': f'attachment; filename={file_name}',
+                             'X-Accel-Buffering': 'no'})
+
+
+@projects.route('/<int:project_id>/import', methods=['POST'])
+@require_project_access('project_id')
+def import_project_tasks(project_id: int) -> Tuple[Dict[str, Any], int]:
+    """
+    Import tasks from the request body, given as CSV with a header row or as NDJSON ('format', by
+    default derived from the content type). Small uploads are imported in the request; uploads
+    larger than 1 MiB, of unknown length or with 'async=true' are imported by a background job.
+
+    :param project_id: The ID of the project.
+    :return: A JSON response with the imported and failed row counts and per-row errors and a 200
+             status code, a 202 status code and the ID of the import job,
+             otherwise an error message with a 400 or 413 status code.
+    """
+    default_format = taskimport.CSV if request.mimetype == 'text/csv' else taskimport.NDJSON
+    import_format = request.args.get('format', default_format)
+    if import_format not in taskimport.IMPORT_FORMATS:
+        return jsonify({'error': f'format must be one of {", ".join(taskimport.IMPORT_FORMATS)}'}), 400
 
-    projects_list = [{
-        'project_id': project.project_id,
-        'name': project.name,
-        'description': project.description,
-        'created_by': project.created_by,
-        'is_owner': project.created_by == g.user.user_id
-    } for project in user_projects]
+    run_async = (request.args.get('async', 'false').lower() == 'true' or request.content_length is None
+                 or request.content_length > taskimport.SYNC_IMPORT_MAX_BYTES)
+    if run_async:
+        try:
+            import_id = taskimport.save_upload(request.stream)
+        except taskimport.ImportTooLargeError as e:
+            return jsonify({'error': str(e)}), 413
+        job_id = jobs.enqueue('import_tasks', user_id=g.user.user_id, import_id=import_id, project_id=project_id,
+                              import_format=import_format, imported_by=g.user.user_id)
+        return jsonify({'success': 'Import started', 'job_id': job_id}), 202
 
-    return jsonify(projects_list), 200
+    records = taskimport.iter_records(request.stream, import_format)
+    return jsonify(taskimport.import_records(g.session, project_id, g.user.user_id, records)), 200
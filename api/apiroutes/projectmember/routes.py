@@ -2,8 +2,11 @@ from typing import Dict, Tuple, Any
 from flask import request, jsonify, g
 from . import projectmembers
 from database.map_db import ProjectMember, User
+from ..session import Session
 from ..utils import require_project_access
 from ..commitoperations import delete_object, add_object
+from .. import userindex
+from ..refcache import MEMBERS, get_reference_data, invalidate_reference_data
 
 
 def remove_user_relation(project_id: int, user_id: int) -> Tuple[Dict[str, str], int]:
@@ -24,6 +27,7 @@ def remove_user_relation(project_id: int, user_id: int) -> Tuple[Dict[str, str],
         return jsonify({'error': 'Project member relation not found'}), 404
 
     delete_object(project_member)
+    invalidate_reference_data(project_id, MEMBERS)
     return jsonify({'message': 'Project relation deleted successfully'}), 200
 
 
@@ -58,35 +62,40 @@ def delete_specific_user_project_relation(project_id: int, user_id: int) -> Tupl
 @require_project_access('project_id')
 def assign_project_to_user() -> Tuple[Dict[str, Any], int]:
     """
-    Assign a user to a project based on their email.
+    Assign a user to a project based on their email or, as returned by the user search, their ID.
 
     :return: A JSON response with a success message and the user ID, and a 200 status code if successful,
              otherwise an error message with a 400 or 404 status code.
     """
     data = request.get_json()
     user_email = data.get('email')
+    user_id = data.get('user_id')
     project_id = data.get('project_id')
 
-    if not user_email or not project_id:
-        return jsonify({'error': 'Email and project_id are required'}), 400
+    if not (user_email or user_id) or not project_id:
+        return jsonify({'error': 'Email or user_id and project_id are required'}), 400
 
-    user = g.session.query(User).filter(User.email == user_email).first()
+    # Users live on the main shard, g.session belongs to the shard of the project.
+    with Session() as users_session:
+        user_filter = User.user_id == user_id if user_id else User.email == user_email
+        found_user_id = users_session.query(User.user_id).filter(user_filter).limit(1).scalar()
 
-    if not user:
+    if not found_user_id:
         return jsonify({'error': 'User not found'}), 404
 
     existing_relation = g.session.query(ProjectMember).filter(
-        ProjectMember.member_id == user.user_id,
+        ProjectMember.member_id == found_user_id,
         ProjectMember.project_id == project_id
     ).first()
 
     if existing_relation:
         return jsonify({'error': 'User already assigned to this project'}), 400
 
-    new_relation = ProjectMember(member_id=user.user_id, project_id=project_id)
+    new_relation = ProjectMember(member_id=found_user_id, project_id=project_id)
     add_object(new_relation)
+    invalidate_reference_data(project_id, MEMBERS)
 
-    return jsonify({'message': 'Project assigned to user successfully', 'user_id': user.user_id}), 200
+    return jsonify({'message': 'Project assigned to user successfully', 'user_id': found_user_id}), 200
 
 
 @projectmembers.route('/<int:project_id>', methods=['GET'])
@@ -98,8 +107,23 @@ def get_project_members(project_id: int) -> Tuple[Dict[str, Any], int]:
     :param project_id: The ID of the project.
     :return: A JSON response with a list of project members and a 200 status code.
     """
-    members = g.session.query(User).join(ProjectMember, User.user_id == ProjectMember.member_id).filter(
-        ProjectMember.project_id == project_id).all()
-    members_data = [{'user_id': member.user_id, 'email': member.email} for member in members]
+    return jsonify({'members': get_reference_data(g.session, project_id, MEMBERS)}), 200
 
-    return jsonify({'members': members_data}), 200
+
+@projectmembers.route('/<int:project_id>/search', methods=['GET'])
+@require_project_access('project_id')
+def search_project_members(project_id: int) -> Tuple[Dict[str, Any], int]:
+    """
+    Find members of a project whose username or email starts with 'q', for assignee pickers.
+    'limit' sets the number of results (default 10, at most 50).
+
+    :param project_id: The ID of the project.
+    :return: A JSON response with a list of matching members and a 200 status code,
+             otherwise an error message with a 400 status code.
+    """
+    limit = request.args.get('limit', userindex.DEFAULT_SEARCH_LIMIT, type=int)
+    if not 0 < limit <= userindex.MAX_SEARCH_LIMIT:
+        return jsonify({'error': f'limit must be between 1 and {userindex.MAX_SEARCH_LIMIT}'}), 400
+
+    members = get_reference_data(g.session, project_id, MEMBERS)
+    return jsonify({'members': userindex.match_prefix(members, request.args.get('q', ''), limit)}), 200
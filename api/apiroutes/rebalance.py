@@ -0,0 +1,139 @@
+"""
+Moving projects between shards, used by 'manage_db.py rebalance'.
+
+A project is moved by freezing it, so requests refuse to write to it, waiting FREEZE_GRACE_SECONDS
+for writes in flight, copying its rows with their IDs to the target shard in batches of
+MOVE_BATCH_SIZE, committing, and removing them from the source shard. Reads are served by the
+source shard until its rows are removed, then by the target shard. Rows left on the target shard
+by an interrupted move are removed before copying, so a failed move can simply be repeated.
+
+Revisions are drawn per shard and are not comparable across shards. Copied rows get a new revision
+of the target shard and a 'project.moved' event is published; delta-sync clients resync the project
+from revision 0 when they receive it.
+
+plan_rebalance proposes moves that even out the number of tasks on the shards receiving new projects.
+"""
+import time
+from typing import Dict, List, NamedTuple, Tuple
+
+from sqlalchemy import Table, exists, func, insert, select
+from sqlalchemy.sql import ColumnElement
+
+from .cascade import remove_project_rows
+from .events import publish_event
+from .refcache import invalidate_reference_data
+from .shards import SHARDS_BY_NAME, Shard, freeze_project, project_shard, remember_location, thaw_project
+from database.engine_utils import new_project_shards
+from database.map_db import Project, Task, mapper_registry
+from database.revisions import next_revision
+
+MOVE_BATCH_SIZE = 1000
+FREEZE_GRACE_SECONDS = 5
+
+
+class Move(NamedTuple):
+    """A project to move from one shard to another, with its number of tasks."""
+    project_id: int
+    source: Shard
+    target: Shard
+    tasks: int
+
+
+def project_tables(project_id: int) -> List[Tuple[Table, ColumnElement]]:
+    """
+    Get the tables holding rows of a project, parents first, with the condition selecting its rows:
+    tables with a project_id column, and tables with a task_id column for the rows of its tasks.
+
+    :param project_id: The ID of the project.
+    :return: Pairs of a table and a condition.
+    """
+    task_ids = select(Task.task_id).where(Task.project_id == project_id)
+    tables = []
+    for table in mapper_registry.metadata.sorted_tables:
+        if 'project_id' in table.c:
+            tables.append((table, table.c.project_id == project_id))
+        elif 'task_id' in table.c:
+            tables.append((table, table.c.task_id.in_(task_ids)))
+    return tables
+
+
+def move_project(project_id: int, target: Shard) -> int:
+    """
+    Move a project with all its rows to another shard.
+
+    :param project_id: The ID of the project.
+    :param target: The shard receiving the project.
+    :return: The number of copied rows.
+    :raises ValueError: If no shard holds the project or it already is on the target shard.
+    """
+    source = project_shard(project_id)
+    if source == target:
+        raise ValueError(f'Project {project_id} already is on shard {target.name}')
+
+    freeze_project(project_id)
+    try:
+        time.sleep(FREEZE_GRACE_SECONDS)
+        with source.session() as source_db, target.session() as target_db:
+            if not source_db.query(exists().where(Project.project_id == project_id)).scalar():
+                raise ValueError(f'Project {project_id} not found')
+
+            remove_project_rows(target_db, project_id)
+            revision = next_revision(target_db)
+            copied = 0
+            for table, condition in project_tables(project_id):
+                result = source_db.execute(select(table).where(condition).execution_options(yield_per=MOVE_BATCH_SIZE))
+                for rows in result.partitions():
+                    values = [dict(row._mapping) for row in rows]
+                    if 'revision' in table.c:
+                        for row in values:
+                            row['revision'] = revision
+                    target_db.execute(insert(table), values)
+                    copied += len(values)
+            target_db.commit()
+
+            remove_project_rows(source_db, project_id)
+            source_db.commit()
+    finally:
+        thaw_project(project_id)
+
+    remember_location(Project.__tablename__, project_id, target)
+    invalidate_reference_data(project_id)
+    publish_event(project_id, 'project.moved', shard=target.name)
+    return copied
+
+
+def plan_rebalance() -> List[Move]:
+    """
+    Propose moves evening out the number of tasks on the shards receiving new projects: while
+    possible, move the largest project of the fullest shard that fits into half the difference
+    to the emptiest shard.
+
+    :return: The moves, in order.
+    """
+    shards = [SHARDS_BY_NAME[name] for name in new_project_shards]
+    tasks: Dict[str, Dict[int, int]] = {}
+    for shard in shards:
+        with shard.session() as session_db:
+            counts = session_db.execute(
+                select(Project.project_id, func.count(Task.task_id))
+                .outerjoin(Task, Task.project_id == Project.project_id)
+                .group_by(Project.project_id)
+            )
+            tasks[shard.name] = dict(counts.all())
+
+    loads = {shard.name: sum(tasks[shard.name].values()) for shard in shards}
+    moves = []
+    while len(shards) > 1:
+        fullest = max(shards, key=lambda shard: loads[shard.name])
+        emptiest = min(shards, key=lambda shard: loads[shard.name])
+        limit = (loads[fullest.name] - loads[emptiest.name]) // 2
+        fitting = [(count, project_id) for project_id, count in tasks[fullest.name].items() if 0 < count <= limit]
+        if not fitting:
+            break
+        count, project_id = max(fitting)
+        del tasks[fullest.name][project_id]
+        tasks[emptiest.name][project_id] = count
+        loads[fullest.name] -= count
+        loads[emptiest.name] += count
+        moves.append(Move(project_id, fullest, emptiest, count))
+    return moves
@@ -0,0 +1,11 @@
+import os
+import redis
+
+# Shared Redis connection for application data (indexes, counters, queues).
+# Flask sessions use their own connection configured in create_app.
+redis_client = redis.StrictRedis(
+    host=os.getenv('REDIS_HOST', 'localhost'),
+    port=int(os.getenv('REDIS_PORT', 6379)),
+    db=int(os.getenv('REDIS_DATA_DB', 1)),
+    decode_responses=True
+)
@@ -0,0 +1,275 @@
+"""
+Two-tier cache of per-project reference data: labels, sprints and members.
+
+L1 is an in-process LRU of L1_CACHE_SIZE entries; L2 is Redis:
+    refdata:<project_id>:<kind>        JSON list of rows, expiring after L2_TTL_SECONDS
+    refdata:<project_id>:<kind>:gen    generation, bumped by every invalidation
+    refdata:<project_id>:<kind>:lock   held by the process loading the data from the database
+
+Mutating routes call invalidate after committing. It bumps the generation, deletes the L2 value and
+broadcasts the key on INVALIDATION_CHANNEL, so every process drops its L1 entry. A loader only
+writes L2 if the generation it read before querying is still current, and only writes L1 if no
+invalidation arrived meanwhile, so a load racing an invalidation never caches stale rows. L1 is only
+used while the process is subscribed; after a lost connection it is cleared.
+
+On a miss, one thread per process and one process per key load from the database; the others wait
+up to LOCK_WAIT_SECONDS for the loader to fill L2 before querying themselves. Rows loaded through a
+session of a read engine, which may lag behind writes, are cached for at most the session's
+MAX_STALENESS_INFO seconds in either tier, as in the result cache.
+"""
+import json
+import logging
+import math
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import redis
+from sqlalchemy.orm import Session as DBSession
+
+from .redisclient import redis_client
+from .resultcache import MAX_STALENESS_INFO
+from .session import Session
+from database.map_db import Label, ProjectMember, Sprint, User
+
+LABELS = 'labels'
+SPRINTS = 'sprints'
+MEMBERS = 'members'
+KINDS = (LABELS, SPRINTS, MEMBERS)
+
+KEY_PREFIX = 'refdata:'
+INVALIDATION_CHANNEL = 'refdata:invalidate'
+L1_CACHE_SIZE = 4096
+L1_TTL_SECONDS = 300
+L2_TTL_SECONDS = 3600
+LOCK_TTL_MILLISECONDS = 5000
+LOCK_WAIT_SECONDS = 2
+LOCK_POLL_SECONDS = 0.02
+RECONNECT_DELAY_SECONDS = 1
+LOAD_LOCK_STRIPES = 64
+
+logger = logging.getLogger(__name__)
+
+Rows = List[Dict[str, Any]]
+
+_set_if_current = redis_client.register_script("""
+if (redis.call('GET', KEYS[2]) or '') == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+end
+""")
+
+_release_lock = redis_client.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+""")
+
+
+def load_labels(session: DBSession, project_id: int) -> Rows:
+    labels = session.query(Label).filter(Label.project_id == project_id).order_by(Label.label_id)
+    return [{'label_id': label.label_id, 'name': label.name, 'project_id': label.project_id} for label in labels]
+
+
+def load_sprints(session: DBSession, project_id: int) -> Rows:
+    sprints = session.query(Sprint).filter(Sprint.project_id == project_id).order_by(Sprint.sprint_id)
+    return [{
+        'sprint_id': sprint.sprint_id,
+        'name': sprint.name,
+        'start_date': sprint.start_date.isoformat() if sprint.start_date else None,
+        'end_date': sprint.end_date.isoformat() if sprint.end_date else None,
+        'project_id': sprint.project_id
+    } for sprint in sprints]
+
+
+def load_members(session: DBSession, project_id: int) -> Rows:
+    # Members live on the shard of the project, users on the main shard.
+    member_ids = [member_id for member_id, in session.query(ProjectMember.member_id).filter(
+        ProjectMember.project_id == project_id)]
+    if not member_ids:
+        return []
+    with Session() as users_session:
+        members = users_session.query(User.user_id, User.email, User.username).filter(
+            User.user_id.in_(member_ids)).order_by(User.user_id).all()
+    return [{'user_id': user_id, 'email': email, 'username': username} for user_id, email, username in members]
+
+
+LOADERS: Dict[str, Callable[[DBSession, int], Rows]] = {
+    LABELS: load_labels,
+    SPRINTS: load_sprints,
+    MEMBERS: load_members
+}
+
+
+def _key(project_id: int, kind: str) -> str:
+    return f'{KEY_PREFIX}{project_id}:{kind}'
+
+
+class ReferenceCache:
+    """In-process LRU in front of Redis, invalidated through pub/sub."""
+
+    def __init__(self, client: redis.StrictRedis, max_entries: int = L1_CACHE_SIZE):
+        self._client = client
+        self._max_entries = max_entries
+        self._entries: 'OrderedDict[str, Tuple[Rows, float]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks = [threading.Lock() for _ in range(LOAD_LOCK_STRIPES)]
+        # Bumped by every invalidation; loads that saw another value do not fill L1.
+        self._epoch = 0
+        self._subscribed = False
+        self._thread: Optional[threading.Thread] = None
+
+    def get(self, session: DBSession, project_id: int, kind: str) -> Rows:
+        """
+        Get reference data of a project.
+
+        :param session: The database session used on a miss.
+        :param project_id: The ID of the project.
+        :param kind: One of KINDS.
+        :return: The rows.
+        """
+        self._ensure_listener()
+        key = _key(project_id, kind)
+        rows = self._l1_get(key)
+        if rows is not None:
+            return rows
+
+        with self._load_locks[hash(key) % LOAD_LOCK_STRIPES]:
+            rows = self._l1_get(key)
+            if rows is not None:
+                return rows
+            epoch = self._epoch
+            l1_ttl, l2_ttl = L1_TTL_SECONDS, L2_TTL_SECONDS
+            max_staleness = session.info.get(MAX_STALENESS_INFO)
+            if max_staleness is not None:
+                l1_ttl, l2_ttl = min(l1_ttl, max_staleness), min(l2_ttl, math.ceil(max_staleness))
+            rows = self._l2_get_or_load(session, project_id, kind, key, l2_ttl)
+            self._l1_put(key, rows, epoch, l1_ttl)
+            return rows
+
+    def invalidate(self, project_id: int, *kinds: str) -> None:
+        """
+        Invalidate reference data of a project in every process. Call after committing.
+
+        :param project_id: The ID of the project.
+        :param kinds: The changed kinds; all kinds if omitted.
+        """
+        keys = [_key(project_id, kind) for kind in kinds or KINDS]
+        self._evict(keys)
+        pipe = self._client.pipeline()
+        for key in keys:
+            pipe.incr(f'{key}:gen')
+            pipe.delete(key)
+        pipe.publish(INVALIDATION_CHANNEL, json.dumps(keys))
+        pipe.execute()
+
+    def _l1_get(self, key: str) -> Optional[Rows]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            rows, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return rows
+
+    def _l1_put(self, key: str, rows: Rows, epoch: int, ttl: float) -> None:
+        with self._lock:
+            if not self._subscribed or epoch != self._epoch:
+                return
+            self._entries[key] = (rows, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def _evict(self, keys: Optional[List[str]]) -> None:
+        with self._lock:
+            self._epoch += 1
+            if keys is None:
+                self._entries.clear()
+            for key in keys or ():
+                self._entries.pop(key, None)
+
+    def _l2_get_or_load(self, session: DBSession, project_id: int, kind: str, key: str, ttl: int) -> Rows:
+        cached = self._client.get(key)
+        if cached is not None:
+            return json.loads(cached)
+
+        token = uuid.uuid4().hex
+        lock_key = f'{key}:lock'
+        if not self._client.set(lock_key, token, nx=True, px=LOCK_TTL_MILLISECONDS):
+            deadline = time.monotonic() + LOCK_WAIT_SECONDS
+            while time.monotonic() < deadline:
+                time.sleep(LOCK_POLL_SECONDS)
+                cached = self._client.get(key)
+                if cached is not None:
+                    return json.loads(cached)
+            return LOADERS[kind](session, project_id)
+
+        try:
+            generation = self._client.get(f'{key}:gen') or ''
+            rows = LOADERS[kind](session, project_id)
+            _set_if_current(keys=[key, f'{key}:gen'], args=[generation, json.dumps(rows), ttl])
+            return rows
+        finally:
+            _release_lock(keys=[lock_key], args=[token])
+
+    def _ensure_listener(self) -> None:
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._listen, name='refcache-invalidation', daemon=True)
+                    self._thread.start()
+
+    def _listen(self) -> None:
+        while True:
+            try:
+                pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                # Entries cached before the subscription may have missed invalidations.
+                self._evict(None)
+                self._subscribed = True
+                for message in pubsub.listen():
+                    self._evict(json.loads(message['data']))
+            except redis.RedisError:
+                logger.warning('Lost connection to Redis, clearing the reference data cache')
+            except Exception:
+                logger.exception('Reference data invalidation listener failed, clearing the reference data cache')
+            # Invalidations may have been missed while resubscribing.
+            self._subscribed = False
+            self._evict(None)
+            time.sleep(RECONNECT_DELAY_SECONDS)
+
+
+refcache = ReferenceCache(redis_client)
+
+
+def get_reference_data(session: DBSession, project_id: int, kind: str) -> Rows:
+    """
+    Get the labels, sprints or members of a project from the reference data cache.
+
+    :param session: The database session used on a miss.
+    :param project_id: The ID of the project.
+    :param kind: LABELS, SPRINTS or MEMBERS.
+    :return: The rows, as returned by the corresponding list route.
+    """
+    try:
+        return refcache.get(session, project_id, kind)
+    except redis.RedisError:
+        return LOADERS[kind](session, project_id)
+
+
+def invalidate_reference_data(project_id: int, *kinds: str) -> None:
+    """
+    Invalidate cached reference data of a project after a committed change.
+
+    :param project_id: The ID of the project.
+    :param kinds: The changed kinds; all kinds if omitted.
+    """
+    try:
+        refcache.invalidate(project_id, *kinds)
+    except redis.RedisError:
+        logger.exception('Could not invalidate reference data of project %s', project_id)
@@ -0,0 +1,227 @@
+"""
+Opt-in cache of query results, shared by the sessions of a process.
+
+Queries opt in with cached(query, project_id). Their results are kept in a per-process LRU of
+RESULT_CACHE_SIZE entries, keyed by the database, the compiled SQL and its parameters, together with
+the versions of the tags the query depends on. An entry is only used while those versions are unchanged.
+
+Tags are versioned in Redis, so a commit in one process invalidates the entries of every process:
+    cache:tag:<table>               bumped by bulk statements and rows without a project
+    cache:tag:<table>:<project_id>  bumped by rows of the project
+    cache:tag:<table>:*             bumped by rows of any project
+
+A query scoped to a project depends on '<table>' and '<table>:<project_id>' of every table it reads,
+an unscoped query on '<table>' and '<table>:*'. Tags are collected on flush and bulk execution and
+bumped after commit. A session that has written to a table bypasses the cache for that table until
+it commits, so it always reads its own writes.
+
+Sessions of engines whose reads may lag behind writes, such as replicas, may cache rows older than
+the current tag versions. Their entries expire after the session's MAX_STALENESS_INFO seconds.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+import redis
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import FrozenResult
+from sqlalchemy.orm import ORMExecuteState, Session as DBSession, sessionmaker
+from sqlalchemy.orm.loading import merge_frozen_result
+from sqlalchemy.sql.util import find_tables
+
+from .redisclient import redis_client
+
+RESULT_CACHE_SIZE = int(os.getenv('RESULT_CACHE_SIZE', 1024))
+MAX_CACHED_ROWS = 1000
+TAG_PREFIX = 'cache:tag:'
+CACHE_OPTION = 'result_cache'
+PROJECT_OPTION = 'result_cache_project_id'
+PENDING_TAGS = 'result_cache_pending_tags'
+MAX_STALENESS_INFO = 'result_cache_max_staleness'
+
+logger = logging.getLogger(__name__)
+
+
+class CacheEntry(NamedTuple):
+    result: FrozenResult
+    versions: Tuple[Optional[str], ...]
+    expires_at: Optional[float] = None
+
+
+class ResultCache:
+    """Thread-safe LRU mapping cache keys to frozen results."""
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[str, CacheEntry]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, entry: CacheEntry) -> None:
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+result_cache = ResultCache(RESULT_CACHE_SIZE)
+
+
+def cached(query: Any, project_id: Optional[int] = None) -> Any:
+    """
+    Opt a query into the result cache.
+
+    :param query: An ORM Query or a SELECT statement.
+    :param project_id: The project all rows read by the query belong to, if any; scoped entries are
+                       only invalidated by changes to that project.
+    :return: The query with the caching execution options.
+    """
+    options = {CACHE_OPTION: True}
+    if project_id is not None:
+        options[PROJECT_OPTION] = project_id
+    return query.execution_options(**options)
+
+
+def _read_tags(tables: Iterable[str], project_id: Optional[int]) -> List[str]:
+    scope = '*' if project_id is None else project_id
+    return [tag for table in sorted(tables) for tag in (table, f'{table}:{scope}')]
+
+
+def _tag_versions(tags: List[str]) -> Tuple[Optional[str], ...]:
+    keys = [f'{TAG_PREFIX}{tag}' for tag in tags]
+    versions = redis_client.mget(keys)
+    missing = [key for key, version in zip(keys, versions) if version is None]
+    if missing:
+        # Start lost or new tags at a fresh value, so entries cached under earlier values never match again.
+        pipe = redis_client.pipeline()
+        for key in missing:
+            pipe.set(key, time.time_ns(), nx=True)
+        pipe.execute()
+        versions = redis_client.mget(keys)
+    return tuple(versions)
+
+
+def _cache_key(state: ORMExecuteState) -> str:
+    bind = state.session.get_bind()
+    compiled = state.statement.compile(dialect=bind.dialect)
+    params = {**compiled.params, **(state.parameters or {})}
+    # The same query returns different rows on different shards.
+    return ' '.join([str(bind.url), str(compiled)] + [f'{name}={params[name]!r}' for name in sorted(params)])
+
+
+def _pending_tags(session: DBSession) -> Set[str]:
+    return session.info.setdefault(PENDING_TAGS, set())
+
+
+def _execute_cached(state: ORMExecuteState) -> Optional[Any]:
+    """'do_orm_execute' listener serving opted-in SELECTs from the cache and collecting bulk write tags."""
+    if state.is_insert or state.is_update or state.is_delete:
+        _pending_tags(state.session).add(state.statement.table.name)
+        return None
+    if not state.is_select or not state.execution_options.get(CACHE_OPTION):
+        return None
+
+    tables = {table.name for table in find_tables(state.statement, check_columns=True, include_joins=True)}
+    written_tables = {tag.split(':')[0] for tag in _pending_tags(state.session)}
+    if not tables or tables & written_tables:
+        return None
+
+    try:
+        versions = _tag_versions(_read_tags(tables, state.execution_options.get(PROJECT_OPTION)))
+    except redis.RedisError:
+        return None
+
+    key = _cache_key(state)
+    entry = result_cache.get(key)
+    now = time.monotonic()
+    if entry is not None and entry.versions == versions and (entry.expires_at is None or now < entry.expires_at):
+        frozen = entry.result
+    else:
+        frozen = state.invoke_statement().freeze()
+        if len(frozen.data) <= MAX_CACHED_ROWS:
+            max_staleness = state.session.info.get(MAX_STALENESS_INFO)
+            expires_at = None if max_staleness is None else now + max_staleness
+            result_cache.put(key, CacheEntry(frozen, versions, expires_at))
+
+    return merge_frozen_result(state.session, state.statement, frozen, load=False)()
+
+
+def tag_rows(session: DBSession, table: str, project_ids: Iterable[int]) -> None:
+    """
+    Collect the tags of rows of projects written by a statement run on the session's connection,
+    bypassing the ORM, so only cached results of these projects are invalidated on commit.
+
+    :param session: The current database session.
+    :param table: The name of the written table.
+    :param project_ids: The projects of the written rows.
+    """
+    tags = _pending_tags(session)
+    for project_id in project_ids:
+        tags.update([f'{table}:{project_id}', f'{table}:*'])
+
+
+def _project_ids_of(obj: Any) -> Set[Optional[int]]:
+    if not hasattr(obj, 'project_id'):
+        return {None}
+    history = inspect(obj).attrs.project_id.history
+    return {obj.project_id, *history.deleted}
+
+
+def collect_flush_tags(session: DBSession, flush_context: Any) -> None:
+    """'after_flush' listener collecting the tags of flushed rows."""
+    tags = _pending_tags(session)
+    dirty = [obj for obj in session.dirty if session.is_modified(obj, include_collections=False)]
+    for obj in (*session.new, *dirty, *session.deleted):
+        table = obj.__tablename__
+        for project_id in _project_ids_of(obj):
+            tags.update([table] if project_id is None else [f'{table}:{project_id}', f'{table}:*'])
+
+
+def bump_tags(session: DBSession) -> None:
+    """'after_commit' listener bumping the versions of the collected tags."""
+    tags = session.info.pop(PENDING_TAGS, None)
+    if not tags:
+        return
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for tag in tags:
+            pipe.incr(f'{TAG_PREFIX}{tag}')
+        pipe.execute()
+    except redis.RedisError:
+        # The transaction is committed; other processes may serve stale entries until their tags change.
+        logger.exception('Could not invalidate cached results for %s', sorted(tags))
+        result_cache.clear()
+
+
+def discard_tags(session: DBSession, *args: Any) -> None:
+    """'after_rollback' listener dropping the tags of rolled back changes."""
+    session.info.pop(PENDING_TAGS, None)
+
+
+def register_result_cache(session_factory: sessionmaker) -> None:
+    """
+    Enable the result cache for every session created by a factory.
+
+    :param session_factory: The sessionmaker to instrument.
+    """
+    event.listen(session_factory, 'do_orm_execute', _execute_cached)
+    event.listen(session_factory, 'after_flush', collect_flush_tags)
+    event.listen(session_factory, 'after_commit', bump_tags)
+    event.listen(session_factory, 'after_rollback', discard_tags)
@@ -0,0 +1,269 @@
+"""
+Per-project inverted index over task titles and descriptions, kept in Redis.
+
+Keys (all prefixed with 'search:<project_id>:'):
+    term:<token>      sorted set of task IDs scored by the token weight in the task
+    terms             sorted set of all tokens (score 0) used for prefix expansion
+    doc:<task_id>     hash with the indexed tokens, status and label IDs of a task
+    status:<status>   set of task IDs with the given status
+    label:<label_id>  set of task IDs carrying the given label
+"""
+import re
+import uuid
+from collections import Counter
+from itertools import islice
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy.orm import Session as DBSession
+
+from .jobs import ProgressCallback, job, no_progress
+from .redisclient import redis_client
+from .shards import project_shard
+from database.map_db import Task, TaskLabel
+
+TOKEN_PATTERN = re.compile(r'\w+')
+TITLE_WEIGHT = 3
+DESCRIPTION_WEIGHT = 1
+PREFIX_WEIGHT = 0.5
+MAX_PREFIX_EXPANSION = 50
+TEMP_KEY_TTL = 30
+
+# Moves an indexed task from one status set to another; tasks without a doc are left out of the index.
+_move_status = redis_client.register_script("""
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('SREM', KEYS[2], ARGV[1])
+if ARGV[2] ~= '' then
+    redis.call('SADD', KEYS[3], ARGV[1])
+end
+redis.call('HSET', KEYS[1], 'status', ARGV[2])
+return 1
+""")
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    """
+    Split text into lowercase word tokens.
+
+    :param text: The text to tokenize.
+    :return: A list of tokens.
+    """
+    return TOKEN_PATTERN.findall(text.lower()) if text else []
+
+
+def _key(project_id: int, *parts: object) -> str:
+    return ':'.join(['search', str(project_id), *map(str, parts)])
+
+
+def _term_weights(title: Optional[str], description: Optional[str]) -> Dict[str, int]:
+    weights = Counter()
+    for token in tokenize(title):
+        weights[token] += TITLE_WEIGHT
+    for token in tokenize(description):
+        weights[token] += DESCRIPTION_WEIGHT
+    return weights
+
+
+def _queue_removal(pipe, project_id: int, task_id: int, doc: Dict[str, str]) -> None:
+    for term in doc.get('terms', '').split():
+        pipe.zrem(_key(project_id, 'term', term), task_id)
+    if doc.get('status'):
+        pipe.srem(_key(project_id, 'status', doc['status']), task_id)
+    for label_id in doc.get('labels', '').split():
+        pipe.srem(_key(project_id, 'label', label_id), task_id)
+    pipe.delete(_key(project_id, 'doc', task_id))
+
+
+def _queue_index(pipe, task: Task, label_ids: Iterable[int]) -> None:
+    project_id, task_id = task.project_id, task.task_id
+    weights = _term_weights(task.title, task.description)
+    label_ids = sorted({int(label_id) for label_id in label_ids})
+
+    for term, weight in weights.items():
+        pipe.zadd(_key(project_id, 'term', term), {task_id: weight})
+    if weights:
+        pipe.zadd(_key(project_id, 'terms'), {term: 0 for term in weights})
+    if task.status:
+        pipe.sadd(_key(project_id, 'status', task.status), task_id)
+    for label_id in label_ids:
+        pipe.sadd(_key(project_id, 'label', label_id), task_id)
+    pipe.hset(_key(project_id, 'doc', task_id), mapping={
+        'terms': ' '.join(weights),
+        'status': task.status or '',
+        'labels': ' '.join(map(str, label_ids))
+    })
+
+
+def index_task(task: Task, label_ids: Iterable[int]) -> None:
+    """
+    Add or replace a task in its project's index.
+
+    :param task: The task to index.
+    :param label_ids: IDs of the labels currently attached to the task.
+    """
+    doc = redis_client.hgetall(_key(task.project_id, 'doc', task.task_id))
+
+    pipe = redis_client.pipeline()
+    _queue_removal(pipe, task.project_id, task.task_id, doc)
+    _queue_index(pipe, task, label_ids)
+    pipe.execute()
+
+
+def index_new_tasks(entries: Iterable[Tuple[Task, Iterable[int]]]) -> None:
+    """
+    Add many tasks that are not indexed yet, in one round trip.
+
+    :param entries: Pairs of a task and the IDs of its labels.
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    for task, label_ids in entries:
+        _queue_index(pipe, task, label_ids)
+    pipe.execute()
+
+
+def update_statuses(changes: Iterable[Tuple[int, int, Optional[str], Optional[str]]]) -> None:
+    """
+    Move many tasks between status sets without reindexing their text, in one round trip.
+    Tasks that are not indexed are skipped.
+
+    :param changes: Tuples of the project ID, the task ID, the old and the new status.
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    for project_id, task_id, old_status, new_status in changes:
+        _move_status(keys=[_key(project_id, 'doc', task_id), _key(project_id, 'status', old_status or ''),
+                           _key(project_id, 'status', new_status or '')],
+                     args=[task_id, new_status or ''], client=pipe)
+    pipe.execute()
+
+
+def remove_task(project_id: int, task_id: int) -> None:
+    """
+    Remove a task from a project's index.
+
+    :param project_id: The ID of the project the task was indexed under.
+    :param task_id: The ID of the task.
+    """
+    doc = redis_client.hgetall(_key(project_id, 'doc', task_id))
+    if not doc:
+        return
+    pipe = redis_client.pipeline()
+    _queue_removal(pipe, project_id, task_id, doc)
+    pipe.execute()
+
+
+def remove_label(project_id: int, label_id: int) -> None:
+    """
+    Drop the filter set of a deleted label.
+
+    :param project_id: The ID of the project the label belonged to.
+    :param label_id: The ID of the label.
+    """
+    redis_client.delete(_key(project_id, 'label', label_id))
+
+
+def drop_project_index(project_id: int) -> None:
+    """
+    Delete every index key of a project.
+
+    :param project_id: The ID of the project.
+    """
+    keys = list(redis_client.scan_iter(match=_key(project_id, '*'), count=1000))
+    for start in range(0, len(keys), 1000):
+        redis_client.delete(*keys[start:start + 1000])
+
+
+def rebuild_project_index(session: DBSession, project_id: int, batch_size: int = 1000) -> int:
+    """
+    Rebuild a project's index from the database.
+
+    :param session: The database session to read tasks from.
+    :param project_id: The ID of the project.
+    :param batch_size: Number of tasks fetched from the database and written to Redis per round trip.
+    :return: The number of indexed tasks.
+    """
+    drop_project_index(project_id)
+
+    labels_by_task: Dict[int, List[int]] = {}
+    task_labels = session.query(TaskLabel.task_id, TaskLabel.label_id).join(Task).filter(Task.project_id == project_id)
+    for task_id, label_id in task_labels:
+        labels_by_task.setdefault(task_id, []).append(label_id)
+
+    count = 0
+    tasks = iter(session.query(Task).filter(Task.project_id == project_id).yield_per(batch_size))
+    while True:
+        batch = list(islice(tasks, batch_size))
+        if not batch:
+            return count
+        index_new_tasks((task, labels_by_task.get(task.task_id, [])) for task in batch)
+        count += len(batch)
+
+
+@job('reindex_project')
+def reindex_project(project_id: int, progress: ProgressCallback = no_progress) -> int:
+    """
+    Rebuild a project's index in a session of its own.
+
+    :param project_id: The ID of the project.
+    :param progress: Called with the number of indexed tasks when done.
+    :return: The number of indexed tasks.
+    """
+    with project_shard(project_id).session() as session:
+        count = rebuild_project_index(session, project_id)
+    progress(count, count)
+    return count
+
+
+def _prefix_upper_bound(prefix: str) -> str:
+    return '(' + prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def search_tasks(project_id: int, query: str, status: Optional[str] = None,
+                 label_id: Optional[int] = None, limit: int = 20) -> List[Tuple[int, float]]:
+    """
+    Search a project's tasks. Every query token must match a task token exactly or as a prefix;
+    exact matches rank higher than prefix matches and title matches higher than description matches.
+
+    :param project_id: The ID of the project.
+    :param query: The free-text query.
+    :param status: Optional status the tasks must have.
+    :param label_id: Optional label the tasks must carry.
+    :param limit: Maximum number of results.
+    :return: A list of (task_id, score) tuples, best match first.
+    """
+    tokens = list(dict.fromkeys(tokenize(query)))
+    if not tokens:
+        return []
+
+    pipe = redis_client.pipeline()
+    for token in tokens:
+        pipe.zrangebylex(_key(project_id, 'terms'), '[' + token, _prefix_upper_bound(token),
+                         start=0, num=MAX_PREFIX_EXPANSION)
+    expansions = pipe.execute()
+
+    temp_prefix = _key(project_id, 'tmp', uuid.uuid4().hex)
+    token_keys = []
+    pipe = redis_client.pipeline()
+    for i, (token, terms) in enumerate(zip(tokens, expansions)):
+        if not terms:
+            return []
+        weights = {_key(project_id, 'term', term): 1 if term == token else PREFIX_WEIGHT for term in terms}
+        token_key = f'{temp_prefix}:{i}'
+        pipe.zunionstore(token_key, weights, aggregate='MAX')
+        pipe.expire(token_key, TEMP_KEY_TTL)
+        token_keys.append(token_key)
+
+    filters = {key: 1 for key in token_keys}
+    if status:
+        filters[_key(project_id, 'status', status)] = 0
+    if label_id:
+        filters[_key(project_id, 'label', label_id)] = 0
+
+    result_key = f'{temp_prefix}:result'
+    pipe.zinterstore(result_key, filters, aggregate='SUM')
+    pipe.expire(result_key, TEMP_KEY_TTL)
+    pipe.zrevrange(result_key, 0, limit - 1, withscores=True)
+    pipe.delete(result_key, *token_keys)
+    results = pipe.execute()[-2]
+
+    return [(int(task_id), score) for task_id, score in results]
@@ -1,5 +1,85 @@
-from database.engine_utils import create_user_engine
+import os
+from typing import Any, Optional
 
-from sqlalchemy.orm import sessionmaker
+from flask import g, has_app_context
 
-Session = sessionmaker(bind=create_user_engine())
+from database.engine_utils import MAIN_SHARD, create_read_engine, create_user_engine
+from database.revisions import BEFORE_DRAW_INFO, register_revision_events
+from .resultcache import MAX_STALENESS_INFO, register_result_cache
+from .syncwatermark import register_revision_reservations, reserve_revisions
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import ORMExecuteState, Session as DBSession, sessionmaker
+
+# How long reads may lag behind writes on the read engines; users read through the write engines
+# for this long after their own writes.
+READ_YOUR_WRITES_SECONDS = float(os.getenv('READ_YOUR_WRITES_SECONDS', 10))
+WROTE_INFO = 'wrote'
+
+
+def _note_flush(session: DBSession, flush_context: Any) -> None:
+    session.info[WROTE_INFO] = True
+
+
+def _note_execute(state: ORMExecuteState) -> None:
+    if state.is_insert or state.is_update or state.is_delete:
+        state.session.info[WROTE_INFO] = True
+
+
+def _note_commit(session: DBSession) -> None:
+    if session.info.pop(WROTE_INFO, False) and has_app_context():
+        g.committed_write = True
+
+
+def _discard_writes(session: DBSession, *args: Any) -> None:
+    session.info.pop(WROTE_INFO, None)
+
+
+def committed_write() -> bool:
+    """
+    Check whether a session committed a write in the current request, including the sub-requests of a batch.
+
+    :return: True if a write was committed.
+    """
+    return g.get('committed_write', False)
+
+
+def make_sessionmaker(engine: Engine, max_staleness: Optional[float] = None) -> sessionmaker:
+    """
+    Create a session factory with revision stamping, revision reservations for sync and the result
+    cache enabled, recording committed writes for committed_write.
+
+    :param engine: The engine the sessions are bound to.
+    :param max_staleness: For engines serving reads that may lag behind writes, how many seconds
+                          the results they cache may be used.
+    :return: The session factory.
+    """
+    session_factory = sessionmaker(bind=engine, info={MAX_STALENESS_INFO: max_staleness,
+                                                      BEFORE_DRAW_INFO: reserve_revisions})
+    register_revision_events(session_factory)
+    register_revision_reservations(session_factory)
+    register_result_cache(session_factory)
+    event.listen(session_factory, 'after_flush', _note_flush)
+    event.listen(session_factory, 'do_orm_execute', _note_execute)
+    event.listen(session_factory, 'after_commit', _note_commit)
+    event.listen(session_factory, 'after_rollback', _discard_writes)
+    return session_factory
+
+
+def make_read_sessionmaker(shard_name: str, write_sessionmaker: sessionmaker) -> sessionmaker:
+    """
+    Create the session factory serving the reads of a shard.
+
+    :param shard_name: The name of the shard.
+    :param write_sessionmaker: The session factory of the shard, used if it has no read engine.
+    :return: The session factory.
+    """
+    engine = create_read_engine(shard_name)
+    if engine is None:
+        return write_sessionmaker
+    return make_sessionmaker(engine, READ_YOUR_WRITES_SECONDS)
+
+
+Session = make_sessionmaker(create_user_engine())
+ReadSession = make_read_sessionmaker(MAIN_SHARD, Session)
@@ -0,0 +1,239 @@
+"""
+Routing of project data to shards.
+
+Users and their settings live on the main shard, the database configured in the [database] section
+of setup.cfg. Every project lives on one shard together with its sprints, tasks, labels, members,
+attachments, counters, status history and tombstones: the main shard or one of the shards listed
+in the [shards] section (see database/engine_utils.py).
+
+Every shard draws primary keys from its own 'id_seq', which manage_db.py creates starting at the
+shard's index times SHARD_ID_SPAN, so IDs are unique across shards and the ID of a row names the
+shard it was created on, its home shard. Rows are looked up on their home shard first. The rows of
+a project moved by 'manage_db.py rebalance' are found by trying the other shards, and where they
+were found is remembered in a per-process LRU of LOCATION_CACHE_SIZE entries.
+
+Every shard may have a read engine (see database/engine_utils.py), whose sessions serve GET
+requests through read_session; without one, read_session is the shard's write session factory.
+
+New projects are placed on a random shard among 'new_projects'. While a project is being moved,
+its key is set in Redis and requests that would write to it are refused:
+    shards:frozen:<project_id>    set while the rows of the project are copied to another shard
+"""
+import random
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, TypeVar
+
+from sqlalchemy import exists, select
+from sqlalchemy.orm import Session as DBSession, sessionmaker
+
+from .redisclient import redis_client
+from .session import ReadSession, Session, make_read_sessionmaker, make_sessionmaker
+from database.engine_utils import MAIN_SHARD, create_shard_engine, new_project_shards, shard_names
+from database.ids import shard_index_of
+from database.map_db import Project
+
+LOCATION_CACHE_SIZE = 65536
+FROZEN_PREFIX = 'shards:frozen:'
+FROZEN_TTL_SECONDS = 3600
+
+T = TypeVar('T')
+
+
+class Shard(NamedTuple):
+    """A shard: its name, its position in the configuration and its session factories for writes and reads."""
+    name: str
+    index: int
+    session: sessionmaker
+    read_session: sessionmaker
+
+    def session_factory(self, read: bool = False) -> sessionmaker:
+        """
+        Get the session factory of the shard for writes or reads.
+
+        :param read: Whether the sessions only read and may lag behind writes.
+        :return: The session factory.
+        """
+        return self.read_session if read else self.session
+
+
+def _make_shard(index: int, name: str) -> Shard:
+    session_factory = make_sessionmaker(create_shard_engine(name))
+    return Shard(name, index, session_factory, make_read_sessionmaker(name, session_factory))
+
+
+SHARDS: List[Shard] = [Shard(MAIN_SHARD, 0, Session, ReadSession)] + [
+    _make_shard(index, name) for index, name in enumerate(shard_names) if name != MAIN_SHARD
+]
+SHARDS_BY_NAME: Dict[str, Shard] = {shard.name: shard for shard in SHARDS}
+MAIN = SHARDS[0]
+SHARDED = len(SHARDS) > 1
+
+
+class _LocationCache:
+    """Thread-safe LRU mapping (table, row ID) to the shard of rows found outside their home shard."""
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[Tuple[str, Any], Shard]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple[str, Any]) -> Optional[Shard]:
+        with self._lock:
+            shard = self._entries.get(key)
+            if shard is not None:
+                self._entries.move_to_end(key)
+            return shard
+
+    def put(self, key: Tuple[str, Any], shard: Optional[Shard]) -> None:
+        with self._lock:
+            if shard is None:
+                self._entries.pop(key, None)
+                return
+            self._entries[key] = shard
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+_locations = _LocationCache(LOCATION_CACHE_SIZE)
+
+
+def home_shard(row_id: Any) -> Shard:
+    """
+    Get the shard a row was created on, derived from its ID.
+
+    :param row_id: The primary key of the row.
+    :return: The shard; the main shard for IDs outside the configured ranges.
+    """
+    try:
+        index = shard_index_of(int(row_id))
+    except (TypeError, ValueError):
+        return MAIN
+    return SHARDS[index] if 0 <= index < len(SHARDS) else MAIN
+
+
+def candidate_shards(table: str, row_id: Any) -> List[Shard]:
+    """
+    Get the shards that may hold a row, in the order they should be tried: where the row was last
+    found, its home shard, then the others.
+
+    :param table: The name of the table.
+    :param row_id: The primary key of the row.
+    :return: Every shard, most likely first.
+    """
+    if not SHARDED:
+        return SHARDS
+    first = [_locations.get((table, row_id)), home_shard(row_id)]
+    first = list(dict.fromkeys(shard for shard in first if shard is not None))
+    return first + [shard for shard in SHARDS if shard not in first]
+
+
+def remember_location(table: str, row_id: Any, shard: Shard) -> None:
+    """
+    Remember the shard a row was found on, if it is not its home shard.
+
+    :param table: The name of the table.
+    :param row_id: The primary key of the row.
+    :param shard: The shard holding the row.
+    """
+    if SHARDED:
+        _locations.put((table, row_id), None if shard == home_shard(row_id) else shard)
+
+
+def project_shard(project_id: int) -> Shard:
+    """
+    Find the shard holding a project, for work outside of requests such as jobs.
+
+    :param project_id: The ID of the project.
+    :return: The shard holding the project, or its home shard if no shard holds it.
+    """
+    if not SHARDED:
+        return MAIN
+    for shard in candidate_shards(Project.__tablename__, project_id):
+        with shard.session() as session_db:
+            if session_db.query(exists().where(Project.project_id == project_id)).scalar():
+                remember_location(Project.__tablename__, project_id, shard)
+                return shard
+    return home_shard(project_id)
+
+
+def partition_projects(project_ids: List[int], read: bool = False) -> List[Tuple[Shard, List[int]]]:
+    """
+    Group projects by the shard holding them.
+
+    :param project_ids: IDs of the projects.
+    :param read: Look the projects up with the read engines.
+    :return: Pairs of a shard and the IDs of its projects, for the shards holding any; projects
+             no shard holds are left out.
+    """
+    if not SHARDED:
+        return [(MAIN, list(project_ids))]
+
+    def load(session_db: DBSession) -> List[int]:
+        return list(session_db.scalars(select(Project.project_id).where(Project.project_id.in_(project_ids))))
+
+    return [(shard, ids) for shard, ids in zip(SHARDS, scatter(load, per_shard=True, read=read)) if ids]
+
+
+def placement_shard() -> Shard:
+    """
+    Choose the shard of a new project.
+
+    :return: A random shard among those receiving new projects.
+    """
+    return SHARDS_BY_NAME[random.choice(new_project_shards)]
+
+
+def scatter(load: Callable[[DBSession], List[T]], main_session: Optional[DBSession] = None,
+            per_shard: bool = False, read: bool = False) -> List[Any]:
+    """
+    Run a query on every shard, concurrently, each in a session of its own.
+
+    :param load: Called with the session of a shard, returns a list of results.
+    :param main_session: Session to use for the main shard instead of opening one, e.g. g.session.
+    :param per_shard: Return one list per shard, in shard order, instead of concatenating them.
+    :param read: Open the sessions with the read engines of the shards.
+    :return: The results of every shard, in shard order.
+    """
+    def run(shard: Shard) -> List[T]:
+        if shard is MAIN and main_session is not None:
+            return load(main_session)
+        with shard.session_factory(read)() as session_db:
+            return load(session_db)
+
+    if SHARDED:
+        with ThreadPoolExecutor(max_workers=len(SHARDS)) as executor:
+            results = list(executor.map(run, SHARDS))
+    else:
+        results = [run(MAIN)]
+    return results if per_shard else [item for result in results for item in result]
+
+
+def is_frozen(project_id: int) -> bool:
+    """
+    Check whether a project is being moved to another shard, so it must not be written to.
+
+    :param project_id: The ID of the project.
+    :return: True while the project is being moved.
+    """
+    return SHARDED and redis_client.exists(f'{FROZEN_PREFIX}{project_id}') > 0
+
+
+def freeze_project(project_id: int) -> None:
+    """
+    Refuse writes to a project until thaw_project is called or FROZEN_TTL_SECONDS have passed.
+
+    :param project_id: The ID of the project.
+    """
+    redis_client.set(f'{FROZEN_PREFIX}{project_id}', 1, ex=FROZEN_TTL_SECONDS)
+
+
+def thaw_project(project_id: int) -> None:
+    """
+    Accept writes to a project again.
+
+    :param project_id: The ID of the project.
+    """
+    redis_client.delete(f'{FROZEN_PREFIX}{project_id}')
@@ -0,0 +1,189 @@
+"""
+Coalescing of identical concurrent read requests.
+
+Read routes decorated with single_flight share one execution between identical requests in flight
+at the same time: the first request runs the view, the others wait for it and answer with a copy
+of its response. Requests are identical if they have the same endpoint, view and query arguments
+and authorization scope. The scope is the resource the access decorators checked (g.resource), so
+every member of a project shares the result, or the user for routes without a resource or with
+per_user set. Users who wrote recently run the view themselves: they read through the write
+engines, while an identical request in flight may read a lagging read engine.
+
+Within a worker, waiting requests block on the in-flight call. With SINGLE_FLIGHT_ACROSS_WORKERS,
+the first worker also takes a Redis lock for the request:
+    singleflight:<key>:lock     token of the worker running the request
+    singleflight:<token>        response of that worker, kept for RESULT_TTL_SECONDS
+Workers finding the lock taken poll for the response of its holder. A response is only shared if
+it is a 200 JSON response; otherwise, and after WAIT_SECONDS, waiting requests run the view
+themselves.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from functools import wraps
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import redis
+from flask import Response, current_app, g, make_response, request
+from sqlalchemy import inspect
+
+from .redisclient import redis_client
+from .utils import recently_wrote
+
+ACROSS_WORKERS = os.getenv('SINGLE_FLIGHT_ACROSS_WORKERS', 'false').lower() == 'true'
+KEY_PREFIX = 'singleflight:'
+LOCK_TTL_MILLISECONDS = 10000
+RESULT_TTL_SECONDS = 5
+WAIT_SECONDS = 10
+POLL_SECONDS = 0.02
+
+logger = logging.getLogger(__name__)
+
+# Stores the response under the token and releases the lock if this worker still holds it.
+_finish = redis_client.register_script("""
+if ARGV[2] ~= '' then
+    redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+end
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+""")
+
+
+class SharedResponse(NamedTuple):
+    body: str
+    status: int
+    mimetype: str
+
+
+class _Call:
+    """A request in flight in this worker."""
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.response: Optional[SharedResponse] = None
+
+
+_in_flight: Dict[str, _Call] = {}
+_in_flight_lock = threading.Lock()
+
+
+def _scope(per_user: bool) -> List[Any]:
+    scope = []
+    resource = g.get('resource')
+    if resource is not None:
+        scope.append([resource.__tablename__, *inspect(resource).identity])
+    if per_user or resource is None:
+        scope.append(['user', g.user.user_id])
+    return scope
+
+
+def _request_key(per_user: bool) -> str:
+    raw = json.dumps([
+        request.endpoint,
+        sorted(request.view_args.items()),
+        sorted(request.args.items(multi=True)),
+        _scope(per_user)
+    ], default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def _shareable(response: Response) -> Optional[SharedResponse]:
+    if response.status_code != 200 or response.mimetype != 'application/json' or response.is_streamed:
+        return None
+    return SharedResponse(response.get_data(as_text=True), response.status_code, response.mimetype)
+
+
+def _to_response(shared: SharedResponse) -> Response:
+    return current_app.response_class(shared.body, status=shared.status, mimetype=shared.mimetype)
+
+
+def _run(view: Callable[[], Any]) -> Tuple[Response, Optional[SharedResponse]]:
+    response = make_response(view())
+    return response, _shareable(response)
+
+
+def _wait_for_worker(key: str, token: str) -> Optional[SharedResponse]:
+    lock_key = f'{KEY_PREFIX}{key}:lock'
+    deadline = time.monotonic() + WAIT_SECONDS
+    while time.monotonic() < deadline:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.get(f'{KEY_PREFIX}{token}')
+        pipe.get(lock_key)
+        result, holder = pipe.execute()
+        if result is not None:
+            return SharedResponse(*json.loads(result))
+        if holder != token:
+            return None
+        time.sleep(POLL_SECONDS)
+    return None
+
+
+def _run_across_workers(key: str, view: Callable[[], Any]) -> Tuple[Response, Optional[SharedResponse]]:
+    lock_key = f'{KEY_PREFIX}{key}:lock'
+    token = uuid.uuid4().hex
+    try:
+        if not redis_client.set(lock_key, token, nx=True, px=LOCK_TTL_MILLISECONDS):
+            holder = redis_client.get(lock_key)
+            shared = _wait_for_worker(key, holder) if holder else None
+            if shared is not None:
+                return _to_response(shared), shared
+            return _run(view)
+    except redis.RedisError:
+        return _run(view)
+
+    shared = None
+    try:
+        response, shared = _run(view)
+        return response, shared
+    finally:
+        try:
+            _finish(keys=[lock_key, f'{KEY_PREFIX}{token}'],
+                    args=[token, json.dumps(shared) if shared else '', RESULT_TTL_SECONDS])
+        except redis.RedisError:
+            logger.exception('Could not publish the response of a coalesced request')
+
+
+def single_flight(per_user: bool = False) -> Callable:
+    """
+    Decorator coalescing identical concurrent requests to a read-only view.
+    Apply it below the access decorators, so only authorized requests share a result.
+
+    :param per_user: Whether the response depends on the user, not only on the checked resource.
+    :return: The decorator.
+    """
+    def decorator(func: Callable[..., Any]) -> Callable[..., Any]:
+        @wraps(func)
+        def decorated_view(*args: Any, **kwargs: Any) -> Response:
+            def view() -> Any:
+                return func(*args, **kwargs)
+
+            if recently_wrote():
+                return make_response(view())
+
+            key = _request_key(per_user)
+            with _in_flight_lock:
+                call = _in_flight.get(key)
+                leader = call is None
+                if leader:
+                    call = _in_flight[key] = _Call()
+
+            if not leader:
+                if call.done.wait(WAIT_SECONDS) and call.response is not None:
+                    return _to_response(call.response)
+                return view()
+
+            try:
+                response, call.response = _run_across_workers(key, view) if ACROSS_WORKERS else _run(view)
+                return response
+            finally:
+                with _in_flight_lock:
+                    _in_flight.pop(key, None)
+                call.done.set()
+
+        return decorated_view
+    return decorator
@@ -0,0 +1,135 @@
+"""
+Vectorized sprint analytics over the task status history.
+
+Every history row is an event that moves a task into a state: one of the statuses when the task
+belongs to the sprint afterwards, or the 'outside' state when it left the sprint or was deleted.
+Each event adds 1 to its new state and removes 1 from the task's previous state on the event day,
+so a cumulative sum over days yields the number of tasks per state for every day of the sprint.
+"""
+from datetime import date, datetime, time, timedelta
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import or_
+from sqlalchemy.orm import Session as DBSession
+
+from database.map_db import Sprint, Task, TaskStatusChange
+
+DONE_STATUS = 'done'
+TODO_STATUS = 'todo'
+CYCLE_TIME_PERCENTILES = (50, 85, 95)
+
+Event = Tuple[int, Any, Optional[int], Optional[str]]
+
+
+def _load_events(session: DBSession, sprint: Sprint) -> List[Event]:
+    """
+    Load the (task_id, changed_at, sprint_id, to_status) events of every task that was ever in the sprint.
+    Tasks without history get a synthetic event at the sprint start with their current state.
+    """
+    task_ids = session.query(TaskStatusChange.task_id).filter(TaskStatusChange.sprint_id == sprint.sprint_id)
+    current_tasks = session.query(Task.task_id, Task.status).filter(Task.sprint_id == sprint.sprint_id).all()
+
+    events = (
+        session.query(TaskStatusChange.task_id, TaskStatusChange.changed_at,
+                      TaskStatusChange.sprint_id, TaskStatusChange.to_status)
+        .filter(or_(TaskStatusChange.task_id.in_(task_ids),
+                    TaskStatusChange.task_id.in_([task_id for task_id, _ in current_tasks])))
+        .all()
+    )
+
+    with_history = {event[0] for event in events}
+    start = datetime.combine(sprint.start_date, time.min)
+    events.extend((task_id, start, sprint.sprint_id, status)
+                  for task_id, status in current_tasks if task_id not in with_history)
+    return events
+
+
+def _percentiles(values: np.ndarray) -> Dict[str, Optional[float]]:
+    result: Dict[str, Optional[float]] = {'count': int(values.size)}
+    for percentile in CYCLE_TIME_PERCENTILES:
+        result[f'p{percentile}'] = float(np.percentile(values, percentile)) if values.size else None
+    return result
+
+
+def compute_burndown(events: Sequence[Event], sprint_id: int, start_date: date, end_date: date) -> Dict[str, Any]:
+    """
+    Compute daily remaining work, cumulative flow and cycle-time percentiles for a sprint.
+
+    :param events: (task_id, changed_at, sprint_id, to_status) tuples.
+    :param sprint_id: The ID of the sprint.
+    :param start_date: First day of the sprint.
+    :param end_date: Last day of the sprint.
+    :return: A dict with 'days', 'scope', 'remaining', 'cumulative_flow' and 'cycle_time' entries.
+    """
+    num_days = (end_date - start_date).days + 1
+    days = [(start_date + timedelta(days=offset)).isoformat() for offset in range(num_days)]
+    empty_cycle_time = _percentiles(np.empty(0))
+    if not events:
+        return {'days': days, 'scope': [0] * num_days, 'remaining': [0] * num_days,
+                'cumulative_flow': {}, 'cycle_time': empty_cycle_time}
+
+    task_ids = np.fromiter((event[0] for event in events), dtype=np.int64, count=len(events))
+    times = np.array([event[1] for event in events], dtype='datetime64[s]')
+    in_sprint = np.fromiter((event[2] == sprint_id and event[3] is not None for event in events),
+                            dtype=bool, count=len(events))
+    raw_status = np.array([event[3] or '' for event in events], dtype=object)
+
+    order = np.lexsort((times, task_ids))
+    task_ids, times, in_sprint, raw_status = task_ids[order], times[order], in_sprint[order], raw_status[order]
+
+    statuses, status_codes = np.unique(raw_status[in_sprint], return_inverse=True)
+    outside = len(statuses)
+    states = np.full(len(events), outside, dtype=np.int64)
+    states[in_sprint] = status_codes
+
+    first_of_task = np.r_[True, task_ids[1:] != task_ids[:-1]]
+    last_of_task = np.r_[task_ids[1:] != task_ids[:-1], True]
+    previous_states = np.where(first_of_task, outside, np.r_[outside, states[:-1]])
+
+    start = np.datetime64(start_date, 'D')
+    day_index = np.clip((times.astype('datetime64[D]') - start).astype(np.int64), 0, None)
+    visible = day_index < num_days
+
+    delta = np.zeros((num_days, outside + 1), dtype=np.int64)
+    np.add.at(delta, (day_index[visible], states[visible]), 1)
+    np.add.at(delta, (day_index[visible], previous_states[visible]), -1)
+    flow = np.cumsum(delta, axis=0)[:, :outside]
+
+    scope = flow.sum(axis=1)
+    done_codes = np.flatnonzero(statuses == DONE_STATUS)
+    done = flow[:, done_codes].sum(axis=1) if done_codes.size else np.zeros(num_days, dtype=np.int64)
+
+    # Cycle time: first move out of 'todo' until the last move to 'done', for tasks that ended done.
+    _, task_index = np.unique(task_ids, return_inverse=True)
+    num_tasks = task_index.max() + 1
+    seconds = times.astype(np.int64).astype(np.float64)
+    started = np.full(num_tasks, np.inf)
+    finished = np.full(num_tasks, -np.inf)
+    is_done = in_sprint & (raw_status == DONE_STATUS)
+    is_started = in_sprint & (raw_status != TODO_STATUS)
+    np.minimum.at(started, task_index[is_started], seconds[is_started])
+    np.maximum.at(finished, task_index[is_done], seconds[is_done])
+    ended_done = np.zeros(num_tasks, dtype=bool)
+    ended_done[task_index[last_of_task]] = is_done[last_of_task]
+    completed = ended_done & np.isfinite(started) & (finished >= started)
+    cycle_days = (finished[completed] - started[completed]) / 86400.0
+
+    return {
+        'days': days,
+        'scope': scope.tolist(),
+        'remaining': (scope - done).tolist(),
+        'cumulative_flow': {status: flow[:, code].tolist() for code, status in enumerate(statuses)},
+        'cycle_time': _percentiles(cycle_days)
+    }
+
+
+def sprint_burndown(session: DBSession, sprint: Sprint) -> Dict[str, Any]:
+    """
+    Load a sprint's history and compute its burndown.
+
+    :param session: The current database session.
+    :param sprint: The sprint, which must have start and end dates.
+    :return: The burndown data, see compute_burndown.
+    """
+    return compute_burndown(_load_events(session, sprint), sprint.sprint_id, sprint.start_date, sprint.end_date)
@@ -0,0 +1,101 @@
+"""
+Critical path over the dependencies between the tasks of a sprint.
+
+The tasks of a sprint and the dependencies among them form a directed acyclic graph. Every
+unfinished task counts as one unit of work and finished tasks as none, so the critical path is the
+longest chain of unfinished tasks that have to be done one after another: the sprint cannot finish
+its remaining work in fewer steps, however many people work on it. A forward pass in topological
+order (Kahn's algorithm) gives every task its earliest start and finish, a backward pass its latest
+finish; the difference is the task's slack. Both passes are O(V + E). Dependencies on tasks outside
+the sprint are ignored.
+"""
+from collections import deque
+from typing import Any, Dict, List, Sequence, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session as DBSession
+
+from database.map_db import Task, TaskDependency
+from .burndown import DONE_STATUS
+
+
+def compute_critical_path(durations: Dict[int, int], dependencies: Sequence[Tuple[int, int]]) -> Dict[str, Any]:
+    """
+    Compute the critical path of a dependency graph.
+
+    :param durations: The work of every task, by task ID.
+    :param dependencies: (task_id, blocked_by_id) pairs between tasks of durations.
+    :return: A dict with the 'length' of the critical path, the task IDs on the 'path' in order,
+             and the 'tasks' in topological order with their earliest start, earliest finish and slack.
+    :raises ValueError: If the dependencies contain a cycle.
+    """
+    successors: Dict[int, List[int]] = {task_id: [] for task_id in durations}
+    blockers = dict.fromkeys(durations, 0)
+    for task_id, blocked_by_id in dependencies:
+        successors[blocked_by_id].append(task_id)
+        blockers[task_id] += 1
+
+    ready = deque(task_id for task_id, count in blockers.items() if count == 0)
+    order: List[int] = []
+    earliest_start = dict.fromkeys(durations, 0)
+    earliest_finish: Dict[int, int] = {}
+    critical_blocker: Dict[int, int] = {}
+    while ready:
+        task_id = ready.popleft()
+        order.append(task_id)
+        finish = earliest_finish[task_id] = earliest_start[task_id] + durations[task_id]
+        for successor in successors[task_id]:
+            if successor not in critical_blocker or finish > earliest_start[successor]:
+                earliest_start[successor] = finish
+                critical_blocker[successor] = task_id
+            blockers[successor] -= 1
+            if blockers[successor] == 0:
+                ready.append(successor)
+    if len(order) != len(durations):
+        raise ValueError('The dependencies contain a cycle')
+
+    length = max(earliest_finish.values(), default=0)
+    latest_finish: Dict[int, int] = {}
+    for task_id in reversed(order):
+        latest_finish[task_id] = min((latest_finish[successor] - durations[successor]
+                                      for successor in successors[task_id]), default=length)
+
+    path: List[int] = []
+    if length:
+        task_id = next(task_id for task_id in order if earliest_finish[task_id] == length)
+        while task_id is not None:
+            if durations[task_id]:
+                path.append(task_id)
+            task_id = critical_blocker.get(task_id)
+        path.reverse()
+
+    return {
+        'length': length,
+        'path': path,
+        'tasks': [{
+            'task_id': task_id,
+            'earliest_start': earliest_start[task_id],
+            'earliest_finish': earliest_finish[task_id],
+            'slack': latest_finish[task_id] - earliest_finish[task_id]
+        } for task_id in order]
+    }
+
+
+def sprint_critical_path(session: DBSession, sprint_id: int) -> Dict[str, Any]:
+    """
+    Compute the critical path of a sprint's remaining work, with one query for its tasks and one
+    for the dependencies among them.
+
+    :param session: The current database session.
+    :param sprint_id: The ID of the sprint.
+    :return: The critical path, see compute_critical_path.
+    :raises ValueError: If the dependencies contain a cycle.
+    """
+    sprint_task_ids = select(Task.task_id).where(Task.sprint_id == sprint_id)
+    durations = {task_id: 0 if status == DONE_STATUS else 1
+                 for task_id, status in session.execute(select(Task.task_id, Task.status).where(Task.sprint_id == sprint_id))}
+    dependencies = session.execute(
+        select(TaskDependency.task_id, TaskDependency.blocked_by_id)
+        .where(TaskDependency.task_id.in_(sprint_task_ids), TaskDependency.blocked_by_id.in_(sprint_task_ids))
+    ).all()
+    return compute_critical_path(durations, dependencies)
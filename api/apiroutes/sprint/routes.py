@@ -1,9 +1,18 @@
-from typing import Dict, Tuple
+from typing import Any, Dict, Tuple
 from flask import request, jsonify, g
-from database.map_db import Sprint
-from ..utils import require_sprint_access, require_project_access
+from sqlalchemy import and_, delete, select, update
+from sqlalchemy.orm import aliased
+from database.map_db import Sprint, Task, TaskCounter
+from database.revisions import next_revision
+from ..utils import (authorized_delete, is_project_member, require_sprint_access, require_project_access, require_user,
+                     shard_session)
+from .. import shards, taskcounters
 from . import sprints
-from ..commitoperations import delete_object, add_object
+from ..commitoperations import add_object
+from .burndown import sprint_burndown
+from .criticalpath import sprint_critical_path
+from ..events import publish_event
+from ..refcache import SPRINTS, get_reference_data, invalidate_reference_data
 
 
 @sprints.route('', methods=['POST'])
@@ -27,24 +36,69 @@ def add_sprint() -> Tuple[Dict[str, str], int]:
         project_id=data['project_id']
     )
     add_object(sprint)
+    invalidate_reference_data(sprint.project_id, SPRINTS)
+    publish_event(sprint.project_id, 'sprint.created', sprint_id=sprint.sprint_id)
     return jsonify({'success': 'Sprint added'}), 201
 
 
 @sprints.route('/<int:sprint_id>', methods=['DELETE'])
-@require_sprint_access('sprint_id')
+@require_user
 def delete_sprint(sprint_id: int) -> Tuple[Dict[str, str], int]:
     """
-    Delete a specific sprint.
+    Delete a specific sprint, moving its tasks and their counts out of the sprint. The membership is
+    checked by the statements themselves: each only applies to a sprint of a project the user is a member of.
 
     :param sprint_id: The ID of the sprint to be deleted.
     :return: A JSON response with a success message if the sprint is deleted,
-             otherwise an error message with a 404 status code.
+             otherwise an error message with a 403 or 503 status code.
     """
-    sprint = g.session.query(Sprint).filter(Sprint.sprint_id == sprint_id).first()
-    if sprint:
-        delete_object(sprint)
+    authorized = and_(Sprint.sprint_id == sprint_id, is_project_member(Sprint.project_id, g.user.user_id))
+    sprint_projects = select(Sprint.project_id).where(authorized)
+    sprint_counter = aliased(TaskCounter)
+    for shard in shards.candidate_shards(Sprint.__tablename__, sprint_id):
+        with shard_session(shard) as session_db:
+            revision = next_revision(session_db)
+            session_db.execute(
+                update(Task).where(Task.sprint_id == sprint_id, Task.project_id.in_(sprint_projects))
+                .values(sprint_id=None, revision=revision),
+                execution_options={'synchronize_session': False}
+            )
+            # Add the sprint's count to the tasks without a sprint, or rekey it if there is no such counter.
+            merged = session_db.execute(
+                update(TaskCounter).where(
+                    TaskCounter.project_id.in_(sprint_projects),
+                    TaskCounter.dimension == taskcounters.SPRINT,
+                    TaskCounter.dimension_key == '',
+                    sprint_counter.project_id == TaskCounter.project_id,
+                    sprint_counter.dimension == taskcounters.SPRINT,
+                    sprint_counter.dimension_key == str(sprint_id))
+                .values(task_count=TaskCounter.task_count + sprint_counter.task_count),
+                execution_options={'synchronize_session': False}
+            ).rowcount
+            sprint_counters = and_(TaskCounter.project_id.in_(sprint_projects),
+                                   TaskCounter.dimension == taskcounters.SPRINT,
+                                   TaskCounter.dimension_key == str(sprint_id))
+            session_db.execute(
+                delete(TaskCounter).where(sprint_counters) if merged
+                else update(TaskCounter).where(sprint_counters).values(dimension_key=''),
+                execution_options={'synchronize_session': False}
+            )
+            project_id = authorized_delete(session_db, Sprint, sprint_id,
+                                           is_project_member(Sprint.project_id, g.user.user_id), revision)
+            if project_id is None:
+                session_db.rollback()
+                continue
+            if shards.is_frozen(project_id):
+                session_db.rollback()
+                return jsonify({'error': 'Project is being moved, try again later'}), 503
+            session_db.commit()
+            shards.remember_location(Sprint.__tablename__, sprint_id, shard)
+
+        invalidate_reference_data(project_id, SPRINTS)
+        publish_event(project_id, 'sprint.deleted', sprint_id=sprint_id)
         return jsonify({'success': 'Sprint deleted'})
-    return jsonify({'error': 'Sprint not found'}), 404
+
+    return jsonify({'error': 'User does not have access to this sprint operation'}), 403
 
 
 @sprints.route('/by_project/<int:project_id>', methods=['GET'])
@@ -56,11 +110,41 @@ def get_sprints_by_project(project_id: int) -> Tuple[Dict[str, str], int]:
     :param project_id: The ID of the project.
     :return: A JSON response with a list of sprints for the specified project.
     """
-    sprints = g.session.query(Sprint).filter(Sprint.project_id == project_id).all()
-    return jsonify([{
-        'sprint_id': sprint.sprint_id,
-        'name': sprint.name,
-        'start_date': sprint.start_date.isoformat() if sprint.start_date else None,
-        'end_date': sprint.end_date.isoformat() if sprint.end_date else None,
-        'project_id': sprint.project_id
-    } for sprint in sprints])
+    return jsonify(get_reference_data(g.session, project_id, SPRINTS))
+
+
+@sprints.route('/<int:sprint_id>/burndown', methods=['GET'])
+@require_sprint_access('sprint_id')
+def get_sprint_burndown(sprint_id: int) -> Tuple[Dict[str, Any], int]:
+    """
+    Get the burndown of a sprint: daily scope and remaining tasks, cumulative flow per status
+    and cycle-time percentiles in days, computed from the task status history.
+
+    :param sprint_id: The ID of the sprint.
+    :return: A JSON response with the burndown data,
+             otherwise an error message with a 400 status code if the sprint has no dates.
+    """
+    sprint = g.resource
+    if not sprint.start_date or not sprint.end_date or sprint.end_date < sprint.start_date:
+        return jsonify({'error': 'Sprint must have a valid start and end date'}), 400
+
+    return jsonify({'sprint_id': sprint_id, **sprint_burndown(g.session, sprint)}), 200
+
+
+@sprints.route('/<int:sprint_id>/critical_path', methods=['GET'])
+@require_sprint_access('sprint_id')
+def get_sprint_critical_path(sprint_id: int) -> Tuple[Dict[str, Any], int]:
+    """
+    Get the critical path of a sprint: the longest chain of unfinished tasks blocking one another,
+    with the earliest start and the slack of every task of the sprint.
+
+    :param sprint_id: The ID of the sprint.
+    :return: A JSON response with the critical path,
+             otherwise an error message with a 409 status code if the dependencies contain a cycle.
+    """
+    try:
+        critical_path = sprint_critical_path(g.session, sprint_id)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 409
+
+    return jsonify({'sprint_id': sprint_id, **critical_path}), 200
@@ -0,0 +1,45 @@
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import insert
+from sqlalchemy.orm import Session as DBSession
+
+from database.map_db import Task, TaskStatusChange
+
+
+def record_transition(session: DBSession, task: Task, from_status: Optional[str], to_status: Optional[str],
+                      changed_by: Optional[int]) -> None:
+    """
+    Append a status transition of a task within the session's transaction. The caller commits.
+
+    :param session: The current database session.
+    :param task: The task after the change (its project and sprint are recorded).
+    :param from_status: The status before the change, None for a new task.
+    :param to_status: The status after the change, None for a deleted task.
+    :param changed_by: The ID of the user making the change.
+    """
+    session.add(TaskStatusChange(
+        task_id=task.task_id,
+        project_id=task.project_id,
+        sprint_id=task.sprint_id,
+        from_status=from_status,
+        to_status=to_status,
+        changed_by=changed_by,
+        changed_at=datetime.utcnow()
+    ))
+
+
+def record_transitions(session: DBSession, transitions: List[Dict[str, Any]]) -> None:
+    """
+    Append many status transitions with one multi-row INSERT. The caller commits.
+
+    Each transition is a dict with 'task_id', 'project_id', 'sprint_id', 'from_status', 'to_status'
+    and 'changed_by'; 'changed_at' defaults to the current time.
+
+    :param session: The current database session.
+    :param transitions: The transitions to record.
+    """
+    if not transitions:
+        return
+    now = datetime.utcnow()
+    session.execute(insert(TaskStatusChange), [{'changed_at': now, **transition} for transition in transitions])
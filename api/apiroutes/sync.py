@@ -0,0 +1,111 @@
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy.orm import Query, Session as DBSession
+
+from .syncwatermark import sync_watermark
+from database.map_db import Label, Project, ProjectMember, Sprint, Task, TaskDependency, TaskLabel, Tombstone
+
+MAX_CHANGES_PER_TABLE = 1000
+
+SYNCED_TABLES = {
+    'projects': Project,
+    'sprints': Sprint,
+    'tasks': Task,
+    'labels': Label,
+    'task_labels': TaskLabel,
+    'members': ProjectMember,
+    'task_dependencies': TaskDependency,
+    'deleted': Tombstone
+}
+
+
+def row_to_dict(row: Any) -> Dict[str, Any]:
+    """
+    Serialize the column attributes of an ORM object, with dates in ISO format.
+
+    :param row: The ORM object.
+    :return: A dict keyed by attribute name.
+    """
+    data = {}
+    for attribute in row.__mapper__.column_attrs:
+        if attribute.key.startswith('_'):
+            continue
+        value = getattr(row, attribute.key)
+        data[attribute.key] = value.isoformat() if isinstance(value, (date, datetime)) else value
+    return data
+
+
+def project_rows_query(session: DBSession, model: Any, project_ids: List[int]) -> Query:
+    """
+    Query the rows of a synced table belonging to the given projects.
+
+    :param session: The current database session.
+    :param model: The model of the table.
+    :param project_ids: IDs of the projects.
+    :return: The query.
+    """
+    if model is TaskLabel:
+        return session.query(model).join(Task, Task.task_id == TaskLabel.task_id).filter(
+            Task.project_id.in_(project_ids))
+    return session.query(model).filter(model.project_id.in_(project_ids))
+
+
+def _changes_query(session: DBSession, model: Any, project_id: int, since: int, until: Optional[int]) -> Query:
+    query = project_rows_query(session, model, [project_id]).filter(model.revision > since)
+    if until is not None:
+        query = query.filter(model.revision <= until)
+    return query.order_by(model.revision)
+
+
+def collect_changes(session: DBSession, project_id: int, since: int,
+                    limit: int = MAX_CHANGES_PER_TABLE) -> Dict[str, Any]:
+    """
+    Collect the rows of a project changed or deleted after a revision.
+
+    At most 'limit' rows are read per table. When a table has more, the response is cut at the
+    highest revision that is complete in every table and 'has_more' is set, so the client can
+    continue from the returned 'revision'. Rows of a single revision are never split.
+
+    Only rows up to the sync watermark are returned, so rows of transactions still open, which
+    may commit with lower revisions than rows already visible, are never skipped; see
+    apiroutes/syncwatermark.py. Read through the write engine: a read engine may not have the
+    rows below the watermark yet.
+
+    :param session: The current database session.
+    :param project_id: The ID of the project.
+    :param since: The last revision the client has seen.
+    :param limit: Maximum number of rows per table.
+    :return: A dict with the changed rows per table, 'deleted' tombstones, 'revision' and 'has_more'.
+    """
+    watermark = sync_watermark()
+    queries = {name: _changes_query(session, model, project_id, since, watermark)
+               for name, model in SYNCED_TABLES.items()}
+    rows: Dict[str, List[Any]] = {name: query.limit(limit + 1).all() for name, query in queries.items()}
+
+    cutoff: Optional[int] = None
+    for name, table_rows in rows.items():
+        if len(table_rows) > limit:
+            first_excluded = table_rows[limit].revision
+            table_cutoff = first_excluded - 1 if first_excluded - 1 > since else first_excluded
+            cutoff = table_cutoff if cutoff is None else min(cutoff, table_cutoff)
+
+    if cutoff is not None:
+        for name, table_rows in rows.items():
+            if len(table_rows) > limit and table_rows[limit].revision <= cutoff:
+                # A single revision larger than the limit is returned whole.
+                rows[name] = queries[name].filter(SYNCED_TABLES[name].revision <= cutoff).all()
+            else:
+                rows[name] = [row for row in table_rows if row.revision <= cutoff]
+
+    revision = max((row.revision for table_rows in rows.values() for row in table_rows), default=since)
+    if watermark is not None:
+        # Every row up to the watermark has been returned.
+        revision = max(revision, watermark)
+    result: Dict[str, Any] = {
+        name: [row_to_dict(row) for row in table_rows] for name, table_rows in rows.items() if name != 'deleted'
+    }
+    result['deleted'] = [{'table': row.table_name, 'row_id': row.row_id} for row in rows['deleted']]
+    result['revision'] = cutoff if cutoff is not None else revision
+    result['has_more'] = cutoff is not None
+    return result
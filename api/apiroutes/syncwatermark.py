@@ -0,0 +1,136 @@
+"""
+Watermark up to which every drawn revision is committed, so delta sync never skips rows.
+
+Revisions are drawn at flush time but become visible at commit, so a transaction that commits late
+can add rows below a revision a client has already synced past. Before a transaction draws its
+first revision, its session reserves it in Redis, scored with the highest committed revision at
+that moment; every revision the transaction draws is higher. After the commit, the reservation is
+released and the transaction's highest revision raises the committed revision; a rollback only
+releases it. The watermark is the committed revision, or the lowest reservation if that is lower:
+no transaction still open holds a revision at or below it. This assumes revision_seq hands out
+increasing values, as a sequence drawn one value at a time does.
+
+Reservations older than RESERVATION_TTL_SECONDS are dropped when the watermark is read, so a
+process dying mid-transaction holds the watermark back for that long at most.
+
+Keys:
+    sync:reservations           sorted set of transaction tokens scored by their reserved revision
+    sync:reservation_expiry     sorted set of the same tokens scored by their expiry in milliseconds
+    sync:committed              highest revision of a committed transaction
+"""
+import logging
+import time
+import uuid
+from typing import Any, Optional
+
+import redis
+from sqlalchemy import event
+from sqlalchemy.orm import Session as DBSession, sessionmaker
+
+from .redisclient import redis_client
+from database.revisions import LAST_DRAWN_INFO
+
+RESERVATIONS_KEY = 'sync:reservations'
+EXPIRY_KEY = 'sync:reservation_expiry'
+COMMITTED_KEY = 'sync:committed'
+RESERVATION_TTL_SECONDS = 300
+TOKEN_INFO = 'sync_reservation'
+
+logger = logging.getLogger(__name__)
+
+# Reserves a transaction at the highest committed revision.
+_reserve = redis_client.register_script("""
+redis.call('ZADD', KEYS[1], redis.call('GET', KEYS[3]) or 0, ARGV[1])
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+""")
+
+# Releases a reservation and raises the committed revision to the transaction's highest revision.
+_release = redis_client.register_script("""
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+if ARGV[2] ~= '' and tonumber(ARGV[2]) > tonumber(redis.call('GET', KEYS[3]) or 0) then
+    redis.call('SET', KEYS[3], ARGV[2])
+end
+""")
+
+# Drops expired reservations and returns the watermark, or nil before the first tracked commit.
+_watermark = redis_client.register_script("""
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+for _, token in ipairs(expired) do
+    redis.call('ZREM', KEYS[1], token)
+    redis.call('ZREM', KEYS[2], token)
+end
+local committed = redis.call('GET', KEYS[3])
+if not committed then
+    return nil
+end
+local lowest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+if #lowest > 0 and tonumber(lowest[2]) < tonumber(committed) then
+    return lowest[2]
+end
+return committed
+""")
+
+
+def reserve_revisions(session: DBSession) -> None:
+    """
+    Reserve the session's transaction before it draws its first revision; see next_revision.
+
+    :param session: The session about to draw a revision.
+    """
+    if TOKEN_INFO in session.info:
+        return
+    token = uuid.uuid4().hex
+    expires_at = int((time.time() + RESERVATION_TTL_SECONDS) * 1000)
+    try:
+        _reserve(keys=[RESERVATIONS_KEY, EXPIRY_KEY, COMMITTED_KEY], args=[token, expires_at])
+    except redis.RedisError:
+        # Writes go on; a sync racing this transaction may miss its rows.
+        logger.exception('Could not reserve revisions')
+        return
+    session.info[TOKEN_INFO] = token
+
+
+def _release_reservation(session: DBSession, committed: bool) -> None:
+    token = session.info.pop(TOKEN_INFO, None)
+    last_drawn = session.info.pop(LAST_DRAWN_INFO, None)
+    if token is None:
+        return
+    try:
+        _release(keys=[RESERVATIONS_KEY, EXPIRY_KEY, COMMITTED_KEY],
+                 args=[token, last_drawn if committed and last_drawn is not None else ''])
+    except redis.RedisError:
+        # The reservation expires on its own; until then sync lags behind.
+        logger.exception('Could not release the revision reservation %s', token)
+
+
+def release_committed(session: DBSession) -> None:
+    """'after_commit' listener releasing the reservation and raising the committed revision."""
+    _release_reservation(session, True)
+
+
+def release_rolled_back(session: DBSession, *args: Any) -> None:
+    """'after_rollback' listener releasing the reservation."""
+    _release_reservation(session, False)
+
+
+def register_revision_reservations(session_factory: sessionmaker) -> None:
+    """
+    Release the reservations of the sessions created by a factory; the factory's sessions must
+    carry reserve_revisions in info[BEFORE_DRAW_INFO].
+
+    :param session_factory: The sessionmaker to instrument.
+    """
+    event.listen(session_factory, 'after_commit', release_committed)
+    event.listen(session_factory, 'after_rollback', release_rolled_back)
+
+
+def sync_watermark() -> Optional[int]:
+    """
+    Get the revision up to which every drawn revision is committed.
+
+    :return: The watermark, or None if no transaction has committed through a reservation yet.
+    """
+    watermark = _watermark(keys=[RESERVATIONS_KEY, EXPIRY_KEY, COMMITTED_KEY], args=[int(time.time() * 1000)])
+    return int(watermark) if watermark is not None else None
+
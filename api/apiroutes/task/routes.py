@@ -1,14 +1,91 @@
-from typing import Dict, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 from flask import request, jsonify, g
+from sqlalchemy import exists, literal, select
 from sqlalchemy.orm import joinedload
-from database.map_db import Label, Sprint, Task, TaskLabel, User
-from ..utils import require_task_access, require_project_access
+from database.map_db import Project, Sprint, Task, TaskDependency, TaskLabel
+from database.revisions import record_tombstones
+from ..utils import (is_project_member, require_task_access, require_project_access, require_user,
+                     use_read_engines)
 from . import tasks
 from ..commitoperations import add_object, delete_object
+from .. import (archive, assignedtasks, searchindex, shards, statushistory, taskcounters, taskgraph, taskquery, taskranks,
+               writebehind)
+from ..events import publish_event
+from ..refcache import LABELS, MEMBERS, SPRINTS, get_reference_data
+from ..singleflight import single_flight
+from ..taskgraph import TaskGraphConflict, TaskGraphError
+from ..taskquery import TaskQuery, TaskQueryError
+
+
+def serialize_task(task: Task, label_names: List[str], buffered: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Serialize a task for the task list routes.
+
+    :param task: The task.
+    :param label_names: The names of the task's labels.
+    :param buffered: Write-behind changes of the task not yet written to the database.
+    :return: A dict with the task fields and label names.
+    """
+    return {
+        'task_id': task.task_id,
+        'title': task.title,
+        'description': task.description,
+        'status': task.status,
+        'sprint_id': task.sprint_id,
+        'assigned_to': task.assigned_to,
+        'project_id': task.project_id,
+        'parent_id': task.parent_id,
+        'rank': task.rank,
+        **(buffered or {}),
+        'label_names': label_names
+    }
+
+
+def board_fields_error(data: Dict[str, Any]) -> Optional[str]:
+    """
+    Validate the board fields of a request body: status, sprint_id and assigned_to.
+
+    :param data: The request body.
+    :return: An error message, or None if the present fields are valid.
+    """
+    if 'status' in data and not (isinstance(data['status'], str) and data['status']):
+        return 'status must be a non-empty string'
+    if 'status' in data and len(data['status']) > Task.status.type.length:
+        return f'status must be at most {Task.status.type.length} characters'
+    for field in ('sprint_id', 'assigned_to'):
+        value = data.get(field)
+        if value is not None and (not isinstance(value, int) or isinstance(value, bool)):
+            return f'{field} must be an integer or null'
+    return None
+
+
+def buffer_task_update(task: Task, data: Any) -> Tuple[Dict[str, Any], int]:
+    """
+    Accept a change of the status, sprint or assignee of a task and write it later, see
+    apiroutes/writebehind.py.
+
+    :param task: The task.
+    :param data: The new values.
+    :return: A JSON response with the version of the change and a 202 status code,
+             otherwise an error message with a 400 status code.
+    """
+    if not isinstance(data, dict) or not data or not set(data) <= set(writebehind.FIELDS):
+        return jsonify({'error': f'Write-behind updates change only {", ".join(writebehind.FIELDS)}'}), 400
+    error = board_fields_error(data)
+    if error:
+        return jsonify({'error': error}), 400
+    # The flusher writes the change much later; it must not fail then.
+    if data.get('sprint_id') is not None and not g.session.query(exists().where(
+            Sprint.sprint_id == data['sprint_id'], Sprint.project_id == task.project_id)).scalar():
+        return jsonify({'error': 'sprint_id must be a sprint of the task\'s project'}), 400
+
+    version = writebehind.buffer_update(task, data, g.user.user_id)
+    return jsonify({'message': 'Task update accepted', 'version': version}), 202
 
 
 @tasks.route('/<int:task_id>', methods=['GET'])
 @require_task_access('task_id')
+@single_flight()
 def get_task(task_id):
     """
     Retrieve a specific task along with its associated labels.
@@ -24,6 +101,7 @@ def get_task(task_id):
         .all()
     )
     labels = [{'label_id': tl.label.label_id, 'name': tl.label.name, 'project_id': tl.label.project_id} for tl in task_labels]
+    buffered = writebehind.pending_update(task_id)
 
     return jsonify({
         'task_id': task.task_id,
@@ -33,6 +111,9 @@ def get_task(task_id):
         'sprint_id': task.sprint_id,
         'assigned_to': task.assigned_to,
         'project_id': task.project_id,
+        'parent_id': task.parent_id,
+        'rank': task.rank,
+        **(buffered.changes if buffered else {}),
         'labels': labels
     })
 
@@ -60,7 +141,15 @@ def add_task():
         assigned_to=data['assigned_to'],
         project_id=data['project_id']
     )
+    taskcounters.count_change(g.session, None, taskcounters.task_state(task, []))
+    task.rank, = taskranks.append_ranks(g.session, task.project_id, [(task.sprint_id, task.status)])
+    g.session.add(task)
+    g.session.flush()
+    statushistory.record_transition(g.session, task, None, task.status, g.user.user_id)
     add_object(task)
+    taskranks.request_rebalances([(task.project_id, task.sprint_id, task.status, task.rank)])
+    searchindex.index_task(task, [])
+    publish_event(task.project_id, 'task.created', task_id=task.task_id)
 
     return jsonify({'success': 'Task added'}), 201
 
@@ -70,13 +159,35 @@ def add_task():
 def update_task(task_id: int) -> Tuple[Dict[str, str], int]:
     """
     Update a specific task.
+    With 'write_behind=true', only status, sprint_id and assigned_to can be changed and the change
+    is written to the database later; otherwise write-behind changes not yet written are applied too.
 
     :param task_id: The ID of the task to be updated.
     :return: A JSON response with a success message and a 200 status code if successful,
-             otherwise an error message with a 404 status code.
+             a 202 status code for write-behind changes, otherwise an error message with a 400, 403, 404
+             or 503 status code.
     """
     data = request.get_json()
     task = g.resource
+    if request.args.get('write_behind', 'false').lower() == 'true':
+        return buffer_task_update(task, data)
+
+    buffered = writebehind.pending_update(task_id)
+    if buffered is not None:
+        data = {**buffered.changes, **data}
+    old_project_id = task.project_id
+    new_project_id = data.get('project_id', old_project_id)
+    if new_project_id != old_project_id:
+        # The task row stays on its shard, so it can only move to projects held there.
+        if not isinstance(new_project_id, int) or isinstance(new_project_id, bool) or not g.session.query(
+                exists().where(Project.project_id == new_project_id)).scalar():
+            return jsonify({'error': 'project_id must be a project in the same database as the task'}), 400
+        if not g.session.query(is_project_member(new_project_id, g.user.user_id)).scalar():
+            return jsonify({'error': 'User does not have access to this project operation'}), 403
+        if shards.is_frozen(new_project_id):
+            return jsonify({'error': 'Project is being moved, try again later'}), 503
+    old_label_ids = [label_id for label_id, in g.session.query(TaskLabel.label_id).filter(TaskLabel.task_id == task_id)]
+    old_state = taskcounters.task_state(task, old_label_ids)
 
     task.title = data.get('title', task.title)
     task.description = data.get('description', task.description)
@@ -87,21 +198,250 @@ def update_task(task_id: int) -> Tuple[Dict[str, str], int]:
     task.status = data.get('status', task.status)
     task.sprint_id = data.get('sprint_id', task.sprint_id)
     task.assigned_to = data.get('assigned_to', task.assigned_to)
-    task.project_id = data.get('project_id', task.project_id)
+    if new_project_id != old_project_id:
+        # Relations never cross projects.
+        taskgraph.detach_task(g.session, task)
+    task.project_id = new_project_id
 
     # Clear existing task labels
+    if old_label_ids:
+        record_tombstones(g.session, TaskLabel.__tablename__, select(TaskLabel.task_label_id, literal(old_project_id))
+                          .where(TaskLabel.task_id == task_id))
     g.session.query(TaskLabel).filter(TaskLabel.task_id == task_id).delete()
 
     # Add new task labels
+    label_ids = []
     if 'labels' in data:
-        new_labels = [TaskLabel(task_id=task_id, label_id=label['label_id']) for label in data['labels']]
+        label_ids = list(dict.fromkeys(label['label_id'] for label in data['labels']))
+        new_labels = [TaskLabel(task_id=task_id, label_id=label_id) for label_id in label_ids]
         g.session.add_all(new_labels)
 
+    taskcounters.count_change(g.session, old_state, taskcounters.task_state(task, label_ids))
+    if (task.status, task.sprint_id, task.project_id) != (old_state['status'], old_state['sprint_id'], old_project_id):
+        statushistory.record_transition(g.session, task, old_state['status'], task.status, g.user.user_id)
+        # Tasks changing column go to its end.
+        task.rank, = taskranks.append_ranks(g.session, task.project_id, [(task.sprint_id, task.status)])
+    if buffered is not None:
+        buffered = writebehind.claim(buffered)
     add_object(task)
+    if buffered is not None:
+        writebehind.complete(buffered)
+    taskranks.request_rebalances([(task.project_id, task.sprint_id, task.status, task.rank)])
+
+    if old_project_id != task.project_id:
+        searchindex.remove_task(old_project_id, task_id)
+        publish_event(old_project_id, 'task.deleted', task_id=task_id)
+    searchindex.index_task(task, label_ids)
+    publish_event(task.project_id, 'task.updated', task_id=task_id, status=task.status,
+                  sprint_id=task.sprint_id, assigned_to=task.assigned_to)
 
     return jsonify({'message': 'Task updated successfully'}), 200
 
 
+@tasks.route('/<int:task_id>/move', methods=['PUT'])
+@require_task_access('task_id')
+def move_task(task_id: int) -> Tuple[Dict[str, Any], int]:
+    """
+    Place a task between two tasks of a board column, see apiroutes/taskranks.py.
+
+    The body holds 'previous_id' and 'next_id', the tasks above and below the new position (null
+    at the top or the bottom of the column), and optionally 'status' and 'sprint_id' of another
+    column. Within a column only the rank of the task is written.
+
+    :param task_id: The ID of the task to move.
+    :return: A JSON response with the new rank and a 200 status code,
+             otherwise an error message with a 400 or 409 status code.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Request body must be an object'}), 400
+    error = board_fields_error(data)
+    if error:
+        return jsonify({'error': error}), 400
+
+    task = g.resource
+    buffered = writebehind.pending_update(task_id)
+    if buffered is not None:
+        data = {**buffered.changes, **data}
+    old_state = taskcounters.task_state(task, [])
+    task.status = data.get('status', task.status)
+    task.sprint_id = data.get('sprint_id', task.sprint_id)
+    task.assigned_to = data.get('assigned_to', task.assigned_to)
+
+    neighbour_ids = [data.get('previous_id'), data.get('next_id')]
+    neighbours = {neighbour.task_id: neighbour for neighbour in g.session.query(Task).filter(
+        Task.task_id.in_([neighbour_id for neighbour_id in neighbour_ids if neighbour_id is not None]),
+        Task.task_id != task_id,
+        *taskranks.column_conditions(task.project_id, task.sprint_id, task.status))}
+    if any(neighbour_id is not None and neighbour_id not in neighbours for neighbour_id in neighbour_ids):
+        return jsonify({'error': 'previous_id and next_id must be other tasks of the target column'}), 400
+
+    try:
+        task.rank = taskranks.rank_after_move(g.session, task, *(neighbours.get(neighbour_id) for neighbour_id in neighbour_ids))
+    except ValueError:
+        return jsonify({'error': 'previous_id must be above next_id, reload the column'}), 409
+
+    new_state = taskcounters.task_state(task, [])
+    if new_state != old_state:
+        taskcounters.count_change(g.session, old_state, new_state)
+    if (task.status, task.sprint_id) != (old_state['status'], old_state['sprint_id']):
+        statushistory.record_transition(g.session, task, old_state['status'], task.status, g.user.user_id)
+    if buffered is not None:
+        buffered = writebehind.claim(buffered)
+    add_object(task)
+    if buffered is not None:
+        writebehind.complete(buffered)
+
+    if task.status != old_state['status']:
+        searchindex.update_statuses([(task.project_id, task_id, old_state['status'], task.status)])
+    publish_event(task.project_id, 'task.moved', task_id=task_id, rank=task.rank, status=task.status,
+                  sprint_id=task.sprint_id, assigned_to=task.assigned_to)
+    taskranks.request_rebalances([(task.project_id, task.sprint_id, task.status, task.rank)])
+
+    return jsonify({'task_id': task_id, 'rank': task.rank}), 200
+
+
+def related_task(task: Task, data: Any, field: str) -> Tuple[Optional[Task], Optional[str]]:
+    """
+    Load the task of the same project referenced by a field of a request body.
+
+    :param task: The task the request is about.
+    :param data: The request body.
+    :param field: The name of the field holding the ID of the related task.
+    :return: The related task, or None if the field is null, and an error message if it is invalid.
+    """
+    if not isinstance(data, dict) or field not in data:
+        return None, f'{field} is required'
+    related_id = data[field]
+    if related_id is None:
+        return None, None
+    if not isinstance(related_id, int) or isinstance(related_id, bool):
+        return None, f'{field} must be a task ID'
+    related = g.session.get(Task, related_id)
+    if related is None or related.project_id != task.project_id:
+        return None, f'{field} must be a task of the same project'
+    return related, None
+
+
+@tasks.route('/<int:task_id>/parent', methods=['PUT'])
+@require_task_access('task_id')
+def set_task_parent(task_id: int) -> Tuple[Dict[str, Any], int]:
+    """
+    Move a task with its subtasks under another task, see apiroutes/taskgraph.py.
+
+    The body holds 'parent_id', a task of the same project, or null for a top-level task.
+
+    :param task_id: The ID of the task.
+    :return: A JSON response with the new parent and a 200 status code,
+             otherwise an error message with a 400 status code, or 409 if the parent is one of the task's subtasks.
+    """
+    task = g.resource
+    parent, error = related_task(task, request.get_json(silent=True), 'parent_id')
+    if error:
+        return jsonify({'error': error}), 400
+
+    try:
+        taskgraph.set_parent(g.session, task, parent)
+    except TaskGraphConflict as e:
+        return jsonify({'error': str(e)}), 409
+    except TaskGraphError as e:
+        return jsonify({'error': str(e)}), 400
+    add_object(task)
+    publish_event(task.project_id, 'task.reparented', task_id=task_id, parent_id=task.parent_id)
+
+    return jsonify({'task_id': task_id, 'parent_id': task.parent_id}), 200
+
+
+@tasks.route('/<int:task_id>/hierarchy', methods=['GET'])
+@require_task_access('task_id')
+@single_flight()
+def get_task_hierarchy(task_id: int) -> Tuple[Dict[str, Any], int]:
+    """
+    Get the ancestors and the whole subtree of a task, read from the closure table with one query each.
+
+    :param task_id: The ID of the task.
+    :return: A JSON response with the IDs of the ancestors (the parent first) and the descendants
+             with their depth below the task, level by level.
+    """
+    descendants = taskgraph.subtree(g.session, task_id)
+    label_names = taskquery.label_names_by_task(g.session, [task.task_id for task, _ in descendants])
+    buffered = writebehind.pending_changes(g.resource.project_id)
+
+    return jsonify({
+        'task_id': task_id,
+        'ancestor_ids': taskgraph.ancestor_ids(g.session, task_id),
+        'descendants': [{**serialize_task(task, label_names[task.task_id], buffered.get(task.task_id)), 'depth': depth}
+                        for task, depth in descendants]
+    }), 200
+
+
+@tasks.route('/<int:task_id>/dependencies', methods=['GET'])
+@require_task_access('task_id')
+@single_flight()
+def get_task_dependencies(task_id: int) -> Tuple[Dict[str, Any], int]:
+    """
+    Get the tasks blocking a task and the tasks it blocks. With 'transitive=true', tasks blocking
+    or blocked through other tasks are included, read from the closure table.
+
+    :param task_id: The ID of the task.
+    :return: A JSON response with the IDs of the blocking and the blocked tasks.
+    """
+    transitive = request.args.get('transitive', 'false').lower() == 'true'
+    blocked_by, blocks = taskgraph.dependency_ids(g.session, task_id, transitive)
+    return jsonify({'task_id': task_id, 'blocked_by': blocked_by, 'blocks': blocks}), 200
+
+
+@tasks.route('/<int:task_id>/dependencies', methods=['POST'])
+@require_task_access('task_id')
+def add_task_dependency(task_id: int) -> Tuple[Dict[str, Any], int]:
+    """
+    Make a task blocked by another task of its project, given as 'blocked_by_id' in the body.
+
+    :param task_id: The ID of the blocked task.
+    :return: A JSON response with the new dependency and a 201 status code, otherwise an error message
+             with a 400 status code, or 409 if the dependency exists or would close a cycle.
+    """
+    task = g.resource
+    blocker, error = related_task(task, request.get_json(silent=True), 'blocked_by_id')
+    if error or blocker is None:
+        return jsonify({'error': error or 'blocked_by_id is required'}), 400
+
+    try:
+        dependency = taskgraph.add_dependency(g.session, task, blocker)
+    except TaskGraphConflict as e:
+        return jsonify({'error': str(e)}), 409
+    except TaskGraphError as e:
+        return jsonify({'error': str(e)}), 400
+    add_object(dependency)
+    publish_event(task.project_id, 'task.dependency_added', task_id=task_id, blocked_by_id=blocker.task_id)
+
+    return jsonify({'dependency_id': dependency.dependency_id, 'task_id': task_id,
+                    'blocked_by_id': blocker.task_id}), 201
+
+
+@tasks.route('/<int:task_id>/dependencies/<int:blocked_by_id>', methods=['DELETE'])
+@require_task_access('task_id')
+def remove_task_dependency(task_id: int, blocked_by_id: int) -> Tuple[Dict[str, str], int]:
+    """
+    Remove the dependency of a task on another task.
+
+    :param task_id: The ID of the blocked task.
+    :param blocked_by_id: The ID of the blocking task.
+    :return: A JSON response with a success message and a 200 status code,
+             otherwise an error message with a 404 status code.
+    """
+    dependency = g.session.query(TaskDependency).filter(TaskDependency.task_id == task_id,
+                                                        TaskDependency.blocked_by_id == blocked_by_id).one_or_none()
+    if dependency is None:
+        return jsonify({'error': 'Dependency not found'}), 404
+
+    taskgraph.remove_dependency(g.session, dependency)
+    g.session.commit()
+    publish_event(g.resource.project_id, 'task.dependency_removed', task_id=task_id, blocked_by_id=blocked_by_id)
+
+    return jsonify({'message': 'Dependency removed successfully'}), 200
+
+
 @tasks.route('/<int:task_id>', methods=['DELETE'])
 @require_task_access('task_id')
 def delete_task(task_id: int) -> Tuple[Dict[str, str], int]:
@@ -111,43 +451,138 @@ def delete_task(task_id: int) -> Tuple[Dict[str, str], int]:
     :param task_id: The ID of the task to be deleted.
     :return: A JSON response with a success message and a 200 status code if successful.
     """
+    project_id = g.resource.project_id
+    label_ids = [label_id for label_id, in g.session.query(TaskLabel.label_id).filter(TaskLabel.task_id == task_id)]
+    taskcounters.count_change(g.session, taskcounters.task_state(g.resource, label_ids), None)
+    statushistory.record_transition(g.session, g.resource, g.resource.status, None, g.user.user_id)
+    taskgraph.detach_task(g.session, g.resource)
     delete_object(g.resource)
+    searchindex.remove_task(project_id, task_id)
+    publish_event(project_id, 'task.deleted', task_id=task_id)
 
     return jsonify({'message': 'Task deleted successfully'}), 200
 
 
 @tasks.route('/by_project/<int:project_id>', methods=['GET'])
 @require_project_access('project_id')
+@single_flight()
 def get_tasks_by_project(project_id: int) -> Tuple[Dict[str, str], int]:
     """
     Get tasks by project.
+    With 'include_archived=true', archived tasks follow the current ones, marked with 'archived'.
 
     :param project_id: The ID of the project.
     :return: A JSON response with a list of tasks for the specified project.
     """
-    label_id = request.args.get('label_id', None)
-    sprint_id = request.args.get('sprint_id', None)
+    label_id = request.args.get('label_id', type=int)
+    sprint_id = request.args.get('sprint_id', type=int)
+
+    query = TaskQuery(
+        labels_any=(label_id,) if label_id else (),
+        sprint_ids=(sprint_id,) if sprint_id else (),
+        limit=None
+    )
+    tasks, _ = taskquery.query_tasks(g.session, project_id, query)
+    label_names = taskquery.label_names_by_task(g.session, [task.task_id for task in tasks])
+    buffered = writebehind.pending_changes(project_id)
+    task_list = [serialize_task(task, label_names[task.task_id], buffered.get(task.task_id)) for task in tasks]
+
+    if request.args.get('include_archived', 'false').lower() == 'true':
+        task_list = [{**task, 'archived': False} for task in task_list]
+        task_list += archive.archived_tasks(g.session, project_id, sprint_id, label_id)
+    return jsonify(task_list), 200
+
+
+@tasks.route('/query/<int:project_id>', methods=['GET'])
+@require_project_access('project_id')
+@single_flight()
+def query_project_tasks(project_id: int) -> Tuple[Dict[str, Any], int]:
+    """
+    Query the tasks of a project one page at a time.
+
+    Filters: 'labels_all' (tasks having every label), 'labels_any' (tasks having one of the labels),
+    'status', 'assigned_to' and 'sprint_id' (lists, repeated or comma-separated), 'unsprinted=true',
+    'sprint_from' and 'sprint_to' (ISO dates, tasks of sprints overlapping the range)
+    and 'q' (text in the title or description). 'sort' is task_id, title, status, revision or rank
+    (the board order within a column), prefixed with '-' for descending order. 'limit' (default 50, at most 200) sets the page size;
+    the returned 'next_cursor' is passed as 'cursor' to get the next page.
+
+    :param project_id: The ID of the project.
+    :return: A JSON response with the tasks of the page and the next cursor and a 200 status code,
+             otherwise an error message with a 400 status code.
+    """
+    try:
+        query = TaskQuery.from_args(request.args)
+        tasks, next_cursor = taskquery.query_tasks(g.session, project_id, query)
+    except TaskQueryError as e:
+        return jsonify({'error': str(e)}), 400
+
+    label_names = taskquery.label_names_by_task(g.session, [task.task_id for task in tasks])
+    buffered = writebehind.pending_changes(project_id)
+    return jsonify({
+        'tasks': [serialize_task(task, label_names[task.task_id], buffered.get(task.task_id)) for task in tasks],
+        'next_cursor': next_cursor
+    }), 200
 
-    query = g.session.query(Task).filter(Task.project_id == project_id)
 
-    if label_id:
-        query = query.join(TaskLabel).filter(TaskLabel.label_id == label_id)
+@tasks.route('/mine', methods=['GET'])
+@require_user
+def get_my_tasks() -> Tuple[Dict[str, Any], int]:
+    """
+    Query the tasks assigned to the current user across all of the user's projects, one page at a time.
 
-    if sprint_id:
-        query = query.filter(Task.sprint_id == sprint_id)
+    Accepts the filters, 'sort', 'limit' and 'cursor' of '/task/query/<project_id>', e.g. 'status'
+    and 'sprint_from'/'sprint_to' (ISO dates) for tasks of sprints overlapping a date range.
+
+    :return: A JSON response with the tasks of the page and the next cursor and a 200 status code,
+             otherwise an error message with a 400 status code.
+    """
+    try:
+        query = TaskQuery.from_args(request.args)
+        tasks, label_names, next_cursor = assignedtasks.query_assigned_tasks(g.user.user_id, query, g.session,
+                                                                              read=use_read_engines())
+    except TaskQueryError as e:
+        return jsonify({'error': str(e)}), 400
+
+    buffered = writebehind.pending_task_changes([task.task_id for task in tasks])
+    return jsonify({
+        'tasks': [serialize_task(task, label_names[task.task_id], buffered.get(task.task_id)) for task in tasks],
+        'next_cursor': next_cursor
+    }), 200
 
-    tasks = query.all()
 
-    def get_label_names_by_ids(label_ids):
-        """
-        Given a list of label IDs, returns a list of corresponding label names.
+@tasks.route('/search/<int:project_id>', methods=['GET'])
+@require_project_access('project_id')
+@single_flight()
+def search_tasks(project_id: int) -> Tuple[Dict[str, str], int]:
+    """
+    Full-text search over the titles and descriptions of a project's tasks.
+
+    Query parameters: 'q' (required), 'status', 'label_id' and 'limit' (default 20, at most 100).
+
+    :param project_id: The ID of the project.
+    :return: A JSON response with the matching tasks ordered by relevance,
+             otherwise an error message with a 400 status code.
+    """
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'Search query cannot be empty'}), 400
+
+    limit = min(request.args.get('limit', 20, type=int), 100)
+    hits = searchindex.search_tasks(
+        project_id,
+        query,
+        status=request.args.get('status'),
+        label_id=request.args.get('label_id', type=int),
+        limit=limit
+    )
+    if not hits:
+        return jsonify([]), 200
 
-        :param label_ids: List of label IDs
-        :return: List of label names
-        """
-        labels = g.session.query(Label).filter(Label.label_id.in_(label_ids)).all()
-        label_names = [label.name for label in labels]
-        return label_names
+    tasks_by_id = {
+        task.task_id: task
+        for task in g.session.query(Task).filter(Task.task_id.in_([task_id for task_id, _ in hits]))
+    }
 
     return jsonify([{
         'task_id': task.task_id,
@@ -157,14 +592,16 @@ def get_tasks_by_project(project_id: int) -> Tuple[Dict[str, str], int]:
         'sprint_id': task.sprint_id,
         'assigned_to': task.assigned_to,
         'project_id': task.project_id,
-        'label_names': get_label_names_by_ids([tl.label_id for tl in task.task_labels])} for task in tasks]), 200
+        'score': score
+    } for task, score in ((tasks_by_id.get(task_id), score) for task_id, score in hits) if task]), 200
 
 
 @tasks.route('/details/<int:task_id>', methods=['GET'])
 @require_task_access('task_id')
+@single_flight()
 def get_task_details(task_id):
     """
-    Retrieve detailed information about a specific task, including labels, users, sprints, and project labels.
+    Retrieve detailed information about a specific task, including labels, project members, sprints, and project labels.
 
     :param task_id: The ID of the task to retrieve details for.
     :return: A JSON response with detailed task information.
@@ -178,9 +615,10 @@ def get_task_details(task_id):
     )
     labels = [{'label_id': tl.label.label_id, 'name': tl.label.name, 'project_id': tl.label.project_id} for tl in task_labels]
 
-    users = g.session.query(User).all()
-    sprints = g.session.query(Sprint).filter(Sprint.project_id == task.project_id).all()
-    project_labels = g.session.query(Label).filter(Label.project_id == task.project_id).all()
+    buffered = writebehind.pending_update(task_id)
+    users = get_reference_data(g.session, task.project_id, MEMBERS)
+    sprints = get_reference_data(g.session, task.project_id, SPRINTS)
+    project_labels = get_reference_data(g.session, task.project_id, LABELS)
 
     return jsonify({
         'task': {
@@ -191,9 +629,11 @@ def get_task_details(task_id):
             'sprint_id': task.sprint_id,
             'assigned_to': task.assigned_to,
             'project_id': task.project_id,
+            'parent_id': task.parent_id,
+            **(buffered.changes if buffered else {}),
             'labels': labels
         },
-        'users': [{'user_id': user.user_id, 'email': user.email} for user in users],
-        'sprints': [{'sprint_id': sprint.sprint_id, 'name': sprint.name} for sprint in sprints],
-        'project_labels': [{'label_id': label.label_id, 'name': label.name} for label in project_labels]
+        'users': [{'user_id': user['user_id'], 'email': user['email']} for user in users],
+        'sprints': [{'sprint_id': sprint['sprint_id'], 'name': sprint['name']} for sprint in sprints],
+        'project_labels': [{'label_id': label['label_id'], 'name': label['name']} for label in project_labels]
     })
@@ -0,0 +1,236 @@
+"""
+Per-project task counters by status, sprint, assignee and label.
+
+Counters live in the 'task_counters' table and are adjusted by the task routes in the same
+transaction as the task change. A project's counters are authoritative once it has a 'total'
+row, written when the project is created or reconciled; until then counts are computed with
+GROUP BY queries. Readers always SUM counter rows, so duplicate rows created by concurrent
+first increments are harmless and get merged by the next reconciliation.
+"""
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import func, update
+from sqlalchemy.orm import Session as DBSession
+
+from database.map_db import Task, TaskCounter, TaskLabel
+
+TOTAL = 'total'
+STATUS = 'status'
+SPRINT = 'sprint'
+ASSIGNEE = 'assignee'
+LABEL = 'label'
+DIMENSIONS = (STATUS, SPRINT, ASSIGNEE, LABEL)
+
+
+def _key(value: Any) -> str:
+    return '' if value is None else str(value)
+
+
+def task_dimensions(status: Optional[str], sprint_id: Optional[int], assigned_to: Optional[int],
+                    label_ids: Iterable[int]) -> Counter:
+    """
+    Build the counter contributions of a single task.
+
+    :param status: The status of the task.
+    :param sprint_id: The ID of the task's sprint.
+    :param assigned_to: The ID of the assigned user.
+    :param label_ids: IDs of the labels attached to the task.
+    :return: A Counter mapping (dimension, key) pairs to 1.
+    """
+    dimensions = Counter({
+        (TOTAL, ''): 1,
+        (STATUS, _key(status)): 1,
+        (SPRINT, _key(sprint_id)): 1,
+        (ASSIGNEE, _key(assigned_to)): 1
+    })
+    for label_id in set(label_ids):
+        dimensions[(LABEL, _key(label_id))] += 1
+    return dimensions
+
+
+def apply_counter_delta(session: DBSession, project_id: int, delta: Dict[Tuple[str, str], int]) -> None:
+    """
+    Add a delta to a project's counters within the session's transaction. The caller commits.
+
+    :param session: The current database session.
+    :param project_id: The ID of the project.
+    :param delta: Mapping of (dimension, key) pairs to the amount to add.
+    """
+    for (dimension, dimension_key), amount in delta.items():
+        if not amount:
+            continue
+        result = session.execute(
+            update(TaskCounter)
+            .where(TaskCounter.project_id == project_id,
+                   TaskCounter.dimension == dimension,
+                   TaskCounter.dimension_key == dimension_key)
+            .values(task_count=TaskCounter.task_count + amount)
+            .execution_options(synchronize_session=False)
+        )
+        # The 'total' row marks initialized counters and is only created by initialize/reconcile.
+        if result.rowcount == 0 and dimension != TOTAL:
+            session.add(TaskCounter(project_id=project_id, dimension=dimension,
+                                    dimension_key=dimension_key, task_count=amount))
+
+
+def count_change(session: DBSession, old: Optional[Dict[str, Any]], new: Optional[Dict[str, Any]]) -> None:
+    """
+    Apply the counter changes caused by creating, updating or deleting a task.
+
+    Each state is a dict with 'project_id', 'status', 'sprint_id', 'assigned_to' and 'label_ids',
+    or None when the task did not exist before / does not exist after the change.
+
+    :param session: The current database session.
+    :param old: The task state before the change.
+    :param new: The task state after the change.
+    """
+    count_changes(session, [(old, new)])
+
+
+def count_changes(session: DBSession,
+                  changes: Iterable[Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]]) -> None:
+    """
+    Apply the counter changes of many tasks, with one UPDATE per changed counter.
+
+    :param session: The current database session.
+    :param changes: Pairs of task states before and after a change, as for count_change.
+    """
+    deltas: Dict[int, Counter] = {}
+    for old, new in changes:
+        for state, sign in ((old, -1), (new, 1)):
+            if state is None:
+                continue
+            dimensions = task_dimensions(state['status'], state['sprint_id'], state['assigned_to'], state['label_ids'])
+            delta = deltas.setdefault(state['project_id'], Counter())
+            for key, amount in dimensions.items():
+                delta[key] += sign * amount
+
+    for project_id, delta in deltas.items():
+        apply_counter_delta(session, project_id, delta)
+
+
+def task_state(task: Task, label_ids: Iterable[int]) -> Dict[str, Any]:
+    """
+    Capture the counted attributes of a task.
+
+    :param task: The task.
+    :param label_ids: IDs of the labels attached to the task.
+    :return: A dict usable with count_change.
+    """
+    return {
+        'project_id': task.project_id,
+        'status': task.status,
+        'sprint_id': task.sprint_id,
+        'assigned_to': task.assigned_to,
+        'label_ids': list(label_ids)
+    }
+
+
+def initialize_project_counters(session: DBSession, project_id: int) -> None:
+    """
+    Mark the counters of a new, empty project as authoritative. The caller commits.
+
+    :param session: The current database session.
+    :param project_id: The ID of the project.
+    """
+    session.add(TaskCounter(project_id=project_id, dimension=TOTAL, dimension_key='', task_count=0))
+
+
+def _empty_counts() -> Dict[str, Any]:
+    counts: Dict[str, Any] = {dimension: {} for dimension in DIMENSIONS}
+    counts[TOTAL] = 0
+    return counts
+
+
+def _add_count(counts: Dict[str, Any], dimension: str, dimension_key: str, amount: int) -> None:
+    if dimension == TOTAL:
+        counts[TOTAL] += amount
+    elif amount:
+        bucket = counts[dimension]
+        bucket[dimension_key] = bucket.get(dimension_key, 0) + amount
+
+
+def compute_project_counts(session: DBSession, project_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+    """
+    Compute task counts directly from the tasks with GROUP BY queries.
+
+    :param session: The current database session.
+    :param project_ids: IDs of the projects to count.
+    :return: Mapping of project ID to counts per dimension.
+    """
+    counts = {project_id: _empty_counts() for project_id in project_ids}
+    if not project_ids:
+        return counts
+
+    grouped_columns = {STATUS: Task.status, SPRINT: Task.sprint_id, ASSIGNEE: Task.assigned_to}
+    for dimension, column in grouped_columns.items():
+        rows = (
+            session.query(Task.project_id, column, func.count(Task.task_id))
+            .filter(Task.project_id.in_(project_ids))
+            .group_by(Task.project_id, column)
+        )
+        for project_id, value, amount in rows:
+            _add_count(counts[project_id], dimension, _key(value), amount)
+            if dimension == STATUS:
+                _add_count(counts[project_id], TOTAL, '', amount)
+
+    rows = (
+        session.query(Task.project_id, TaskLabel.label_id, func.count(func.distinct(Task.task_id)))
+        .join(TaskLabel, TaskLabel.task_id == Task.task_id)
+        .filter(Task.project_id.in_(project_ids))
+        .group_by(Task.project_id, TaskLabel.label_id)
+    )
+    for project_id, label_id, amount in rows:
+        _add_count(counts[project_id], LABEL, _key(label_id), amount)
+
+    return counts
+
+
+def get_project_counts(session: DBSession, project_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+    """
+    Read task counts for several projects with a single counter query, falling back to
+    GROUP BY computation for projects whose counters are not initialized yet.
+
+    :param session: The current database session.
+    :param project_ids: IDs of the projects.
+    :return: Mapping of project ID to counts per dimension.
+    """
+    counts = {project_id: _empty_counts() for project_id in project_ids}
+    if not project_ids:
+        return counts
+
+    initialized = set()
+    rows = (
+        session.query(TaskCounter.project_id, TaskCounter.dimension, TaskCounter.dimension_key,
+                      func.sum(TaskCounter.task_count))
+        .filter(TaskCounter.project_id.in_(project_ids))
+        .group_by(TaskCounter.project_id, TaskCounter.dimension, TaskCounter.dimension_key)
+    )
+    for project_id, dimension, dimension_key, amount in rows:
+        if dimension == TOTAL:
+            initialized.add(project_id)
+        _add_count(counts[project_id], dimension, dimension_key, int(amount or 0))
+
+    missing = [project_id for project_id in project_ids if project_id not in initialized]
+    counts.update(compute_project_counts(session, missing))
+    return counts
+
+
+def reconcile_project_counters(session: DBSession, project_ids: List[int]) -> None:
+    """
+    Replace the counters of the given projects with freshly computed values and commit.
+
+    :param session: The current database session.
+    :param project_ids: IDs of the projects to reconcile.
+    """
+    computed = compute_project_counts(session, project_ids)
+    session.query(TaskCounter).filter(TaskCounter.project_id.in_(project_ids)).delete(synchronize_session=False)
+    for project_id, counts in computed.items():
+        session.add(TaskCounter(project_id=project_id, dimension=TOTAL, dimension_key='', task_count=counts[TOTAL]))
+        for dimension in DIMENSIONS:
+            session.add_all([
+                TaskCounter(project_id=project_id, dimension=dimension, dimension_key=dimension_key, task_count=amount)
+                for dimension_key, amount in counts[dimension].items()
+            ])
+    session.commit()
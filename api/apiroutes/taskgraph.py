@@ -0,0 +1,246 @@
+"""
+Task hierarchy and dependencies, with closure tables maintained on write.
+
+Tasks form a forest through Task.parent_id (epics and their subtasks). 'task_tree_paths' holds a
+row for every task and each of its ancestors with the number of levels between them, so the
+ancestors or the whole subtree of a task are read with one query. Moving a task under another
+parent replaces the paths from its old ancestors into its subtree with paths from the new ones.
+
+Dependencies ('task A is blocked by task B') form a directed acyclic graph. 'task_dependency_paths'
+holds a row for every task and each task blocking it directly or transitively, with the number of
+distinct dependency chains between them. Adding the dependency of A on B adds c(y, A) * c(B, x)
+chains for every task y blocked by A and every task x blocking B, where c(t, t) = 1; removing it
+subtracts them and drops pairs left without chains, so removals are exact without walking the graph.
+
+Both relations stay within a project and are checked for cycles on insert with one lookup in their
+closure table. Tasks leaving the graph, because they are deleted or move to another project, hand
+their children to their own parent and drop their dependencies.
+"""
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, exists, insert, or_, select, update
+from sqlalchemy.orm import Session as DBSession
+
+from database.map_db import Task, TaskDependency, TaskDependencyPath, TaskTreePath
+from database.revisions import next_revision, record_tombstones
+
+
+class TaskGraphError(ValueError):
+    """Raised for relations between tasks of different projects."""
+
+
+class TaskGraphConflict(TaskGraphError):
+    """Raised for relations that exist already or would close a cycle."""
+
+
+def ancestor_ids(session: DBSession, task_id: int) -> List[int]:
+    """
+    Get the ancestors of a task with one query.
+
+    :param session: The current database session.
+    :param task_id: The ID of the task.
+    :return: The IDs of the ancestors, the parent first.
+    """
+    return list(session.scalars(
+        select(TaskTreePath.ancestor_id).where(TaskTreePath.descendant_id == task_id).order_by(TaskTreePath.depth)
+    ))
+
+
+def subtree(session: DBSession, task_id: int) -> List[Tuple[Task, int]]:
+    """
+    Get the descendants of a task with one query.
+
+    :param session: The current database session.
+    :param task_id: The ID of the task.
+    :return: Pairs of a descendant and its depth below the task, level by level.
+    """
+    rows = session.execute(
+        select(Task, TaskTreePath.depth)
+        .join(TaskTreePath, TaskTreePath.descendant_id == Task.task_id)
+        .where(TaskTreePath.ancestor_id == task_id)
+        .order_by(TaskTreePath.depth, Task.task_id)
+    )
+    return [(task, depth) for task, depth in rows]
+
+
+def set_parent(session: DBSession, task: Task, parent: Optional[Task]) -> None:
+    """
+    Move a task with its subtree under another parent, within the session's transaction. The caller commits.
+
+    :param session: The current database session.
+    :param task: The task.
+    :param parent: The new parent, None to make the task a top-level task.
+    :raises TaskGraphError: If the parent belongs to another project.
+    :raises TaskGraphConflict: If the parent is the task itself or one of its descendants.
+    """
+    parent_id = parent.task_id if parent is not None else None
+    if parent_id == task.parent_id:
+        return
+    if parent is not None:
+        if parent.project_id != task.project_id:
+            raise TaskGraphError('The parent must be a task of the same project')
+        if parent_id == task.task_id or session.query(exists().where(
+                TaskTreePath.ancestor_id == task.task_id, TaskTreePath.descendant_id == parent_id)).scalar():
+            raise TaskGraphConflict(f'Task {parent_id} is a subtask of task {task.task_id}')
+
+    # Depths below the task, the task itself included.
+    moved: Dict[int, int] = {task.task_id: 0, **dict(session.execute(
+        select(TaskTreePath.descendant_id, TaskTreePath.depth).where(TaskTreePath.ancestor_id == task.task_id)
+    ).all())}
+    if task.parent_id is not None:
+        session.execute(delete(TaskTreePath).where(TaskTreePath.ancestor_id.in_(ancestor_ids(session, task.task_id)),
+                                                   TaskTreePath.descendant_id.in_(list(moved))))
+    if parent is not None:
+        # Depths above the new parent, the parent itself included.
+        above: Dict[int, int] = {parent_id: 0, **dict(session.execute(
+            select(TaskTreePath.ancestor_id, TaskTreePath.depth).where(TaskTreePath.descendant_id == parent_id)
+        ).all())}
+        session.execute(insert(TaskTreePath), [
+            {'project_id': task.project_id, 'ancestor_id': ancestor_id, 'descendant_id': descendant_id,
+             'depth': ancestor_depth + 1 + descendant_depth}
+            for ancestor_id, ancestor_depth in above.items() for descendant_id, descendant_depth in moved.items()
+        ])
+    task.parent_id = parent_id
+
+
+def dependency_ids(session: DBSession, task_id: int, transitive: bool = False) -> Tuple[List[int], List[int]]:
+    """
+    Get the tasks blocking a task and the tasks it blocks, with one query each.
+
+    :param session: The current database session.
+    :param task_id: The ID of the task.
+    :param transitive: Include tasks blocking or blocked through other tasks.
+    :return: The IDs of the blocking tasks and of the blocked tasks.
+    """
+    if transitive:
+        model, task_column, blocker_column = TaskDependencyPath, TaskDependencyPath.task_id, TaskDependencyPath.blocker_id
+    else:
+        model, task_column, blocker_column = TaskDependency, TaskDependency.task_id, TaskDependency.blocked_by_id
+    blocked_by = list(session.scalars(select(blocker_column).where(task_column == task_id).order_by(blocker_column)))
+    blocks = list(session.scalars(select(task_column).where(blocker_column == task_id).order_by(task_column)))
+    return blocked_by, blocks
+
+
+def _chains_through(session: DBSession, task_id: int, blocker_id: int) -> Tuple[Dict[int, int], Dict[int, int]]:
+    """Get the chain counts from task_id to the tasks it blocks, and from the tasks blocking blocker_id to it."""
+    downstream = {task_id: 1, **dict(session.execute(
+        select(TaskDependencyPath.task_id, TaskDependencyPath.path_count).where(TaskDependencyPath.blocker_id == task_id)
+    ).all())}
+    upstream = {blocker_id: 1, **dict(session.execute(
+        select(TaskDependencyPath.blocker_id, TaskDependencyPath.path_count).where(TaskDependencyPath.task_id == blocker_id)
+    ).all())}
+    return downstream, upstream
+
+
+def _add_chains(session: DBSession, project_id: int, downstream: Dict[int, int], upstream: Dict[int, int],
+                sign: int) -> None:
+    """Add (sign 1) or remove (sign -1) the chains joining every upstream to every downstream task."""
+    if not downstream or not upstream:
+        return
+    existing = {
+        (task_id, blocker_id): (path_id, path_count)
+        for path_id, task_id, blocker_id, path_count in session.execute(
+            select(TaskDependencyPath.path_id, TaskDependencyPath.task_id, TaskDependencyPath.blocker_id,
+                   TaskDependencyPath.path_count)
+            .where(TaskDependencyPath.task_id.in_(list(downstream)), TaskDependencyPath.blocker_id.in_(list(upstream)))
+        )
+    }
+    inserted, updated, deleted = [], [], []
+    for task_id, task_chains in downstream.items():
+        for blocker_id, blocker_chains in upstream.items():
+            path_id, path_count = existing.get((task_id, blocker_id), (None, 0))
+            path_count += sign * task_chains * blocker_chains
+            if path_id is None:
+                inserted.append({'project_id': project_id, 'task_id': task_id, 'blocker_id': blocker_id,
+                                 'path_count': path_count})
+            elif path_count:
+                updated.append({'path_id': path_id, 'path_count': path_count})
+            else:
+                deleted.append(path_id)
+    if inserted:
+        session.execute(insert(TaskDependencyPath), inserted)
+    if updated:
+        session.execute(update(TaskDependencyPath), updated)
+    if deleted:
+        session.execute(delete(TaskDependencyPath).where(TaskDependencyPath.path_id.in_(deleted)))
+
+
+def add_dependency(session: DBSession, task: Task, blocker: Task) -> TaskDependency:
+    """
+    Make a task blocked by another task, within the session's transaction. The caller commits.
+
+    :param session: The current database session.
+    :param task: The blocked task.
+    :param blocker: The blocking task.
+    :return: The new dependency.
+    :raises TaskGraphError: If the tasks belong to different projects.
+    :raises TaskGraphConflict: If the dependency exists or would close a cycle.
+    """
+    if blocker.project_id != task.project_id:
+        raise TaskGraphError('Dependencies must be between tasks of the same project')
+    if blocker.task_id == task.task_id:
+        raise TaskGraphConflict('A task cannot block itself')
+    if session.query(exists().where(TaskDependency.task_id == task.task_id,
+                                    TaskDependency.blocked_by_id == blocker.task_id)).scalar():
+        raise TaskGraphConflict(f'Task {task.task_id} is already blocked by task {blocker.task_id}')
+    if session.query(exists().where(TaskDependencyPath.task_id == blocker.task_id,
+                                    TaskDependencyPath.blocker_id == task.task_id)).scalar():
+        raise TaskGraphConflict(f'Task {blocker.task_id} is blocked by task {task.task_id}')
+
+    _add_chains(session, task.project_id, *_chains_through(session, task.task_id, blocker.task_id), 1)
+    dependency = TaskDependency(project_id=task.project_id, task_id=task.task_id, blocked_by_id=blocker.task_id)
+    session.add(dependency)
+    return dependency
+
+
+def remove_dependency(session: DBSession, dependency: TaskDependency) -> None:
+    """
+    Remove a dependency, within the session's transaction. The caller commits.
+
+    :param session: The current database session.
+    :param dependency: The dependency.
+    """
+    _add_chains(session, dependency.project_id,
+                *_chains_through(session, dependency.task_id, dependency.blocked_by_id), -1)
+    session.delete(dependency)
+
+
+def detach_task(session: DBSession, task: Task) -> None:
+    """
+    Remove a task from the hierarchy and the dependency graph before it is deleted or moved to
+    another project, within the session's transaction. Its children move up to its parent. The
+    caller commits.
+
+    :param session: The current database session.
+    :param task: The task, still in its project.
+    """
+    task_id = task.task_id
+    descendant_ids = list(session.scalars(select(TaskTreePath.descendant_id).where(TaskTreePath.ancestor_id == task_id)))
+    if descendant_ids:
+        ancestors = ancestor_ids(session, task_id)
+        if ancestors:
+            session.execute(update(TaskTreePath)
+                            .where(TaskTreePath.ancestor_id.in_(ancestors), TaskTreePath.descendant_id.in_(descendant_ids))
+                            .values(depth=TaskTreePath.depth - 1))
+        session.execute(update(Task).where(Task.parent_id == task_id)
+                        .values(parent_id=task.parent_id, revision=next_revision(session)))
+    session.execute(delete(TaskTreePath).where(or_(TaskTreePath.ancestor_id == task_id,
+                                                   TaskTreePath.descendant_id == task_id)))
+    task.parent_id = None
+
+    downstream = dict(session.execute(
+        select(TaskDependencyPath.task_id, TaskDependencyPath.path_count).where(TaskDependencyPath.blocker_id == task_id)
+    ).all())
+    upstream = dict(session.execute(
+        select(TaskDependencyPath.blocker_id, TaskDependencyPath.path_count).where(TaskDependencyPath.task_id == task_id)
+    ).all())
+    if not downstream and not upstream:
+        return
+    # Chains through the task are c(y, task) * c(task, x); the pairs with the task itself go below.
+    _add_chains(session, task.project_id, downstream, upstream, -1)
+    session.execute(delete(TaskDependencyPath).where(or_(TaskDependencyPath.task_id == task_id,
+                                                         TaskDependencyPath.blocker_id == task_id)))
+    dependencies = or_(TaskDependency.task_id == task_id, TaskDependency.blocked_by_id == task_id)
+    record_tombstones(session, TaskDependency.__tablename__,
+                      select(TaskDependency.dependency_id, TaskDependency.project_id).where(dependencies))
+    session.execute(delete(TaskDependency).where(dependencies))
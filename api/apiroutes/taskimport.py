@@ -0,0 +1,370 @@
+"""
+Bulk import of tasks from CSV or NDJSON.
+
+Records are parsed incrementally and handled in batches of IMPORT_BATCH_SIZE. For each batch, sprint
+names, label names and assignees are resolved with one query each, valid rows are inserted with one
+multi-row INSERT per table and the batch is committed; invalid rows are reported with their row
+number and skipped. Counters, status history, revisions and the search index are maintained per
+batch, as the single-task routes do per task.
+
+Record fields: 'title' and 'description' (required), 'status' (default 'todo'), 'sprint' (a sprint
+name) or 'sprint_id', 'assigned_to' (the user ID of a project member) and 'labels' (label names, a
+comma-separated list in CSV).
+
+Large uploads are saved under IMPORT_DIR and imported by the 'import_tasks' job. After every
+committed batch the job saves a checkpoint, and a retried job resumes after the checkpointed row.
+A batch committed just before a worker crashed can therefore be imported twice.
+"""
+import csv
+import io
+import json
+import os
+import uuid
+from collections import Counter
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import insert, or_
+from sqlalchemy.orm import Session as DBSession
+
+from . import searchindex, statushistory, taskcounters
+from .events import publish_event
+from .jobs import ProgressCallback, job, no_progress
+from .redisclient import redis_client
+from .shards import project_shard
+from .taskranks import append_ranks, request_rebalances
+from database.ids import allocate_ids
+from database.map_db import Label, ProjectMember, Sprint, Task, TaskLabel
+from database.revisions import next_revision
+
+IMPORT_DIR = os.path.abspath(os.getenv('IMPORT_DIR', 'imports'))
+IMPORT_BATCH_SIZE = 500
+MAX_REPORTED_ERRORS = 1000
+SYNC_IMPORT_MAX_BYTES = 1024 * 1024
+MAX_IMPORT_SIZE = int(os.getenv('MAX_IMPORT_SIZE', 1024 * 1024 * 1024))
+CHUNK_SIZE = 64 * 1024
+CHECKPOINT_PREFIX = 'import:'
+CHECKPOINT_TTL_SECONDS = 7 * 24 * 3600
+
+CSV = 'csv'
+NDJSON = 'ndjson'
+IMPORT_FORMATS = (CSV, NDJSON)
+DEFAULT_STATUS = 'todo'
+TITLE_MAX_LENGTH = 255
+STATUS_MAX_LENGTH = 50
+
+# (row number, parsed record or None, parse error or None)
+Record = Tuple[int, Optional[Dict[str, Any]], Optional[str]]
+
+
+class ImportTooLargeError(Exception):
+    """Raised when an upload exceeds MAX_IMPORT_SIZE."""
+
+
+def iter_records(stream: BinaryIO, import_format: str) -> Iterator[Record]:
+    """
+    Parse records from a binary stream without reading it whole.
+
+    :param stream: The UTF-8 encoded upload.
+    :param import_format: CSV (with a header row) or NDJSON.
+    :return: An iterator of (row number, record, error) tuples; rows are numbered from 1.
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    try:
+        yield from _parse(text, import_format)
+    finally:
+        # Leave the stream open for its owner.
+        text.detach()
+
+
+def _parse(text: io.TextIOWrapper, import_format: str) -> Iterator[Record]:
+    if import_format == CSV:
+        for row_number, row in enumerate(csv.DictReader(text), start=1):
+            yield row_number, row, None
+        return
+
+    row_number = 0
+    for line in text:
+        if not line.strip():
+            continue
+        row_number += 1
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield row_number, None, f'Invalid JSON: {e}'
+            continue
+        if not isinstance(record, dict):
+            yield row_number, None, 'Row must be a JSON object'
+        else:
+            yield row_number, record, None
+
+
+def _text(value: Any) -> str:
+    return '' if value is None else str(value).strip()
+
+
+def _optional_int(value: Any) -> Optional[int]:
+    if value is None or value == '':
+        return None
+    return int(value)
+
+
+def _label_names(value: Any) -> List[str]:
+    if value is None or value == '':
+        return []
+    if isinstance(value, str):
+        value = value.split(',')
+    if not isinstance(value, list):
+        raise ValueError('labels must be a list')
+    return list(dict.fromkeys(name for name in map(_text, value) if name))
+
+
+def validate_record(record: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """
+    Validate the fields of a record that can be checked without the database.
+
+    :param record: The parsed record.
+    :return: A tuple with the normalized fields, or None and an error message.
+    """
+    title = _text(record.get('title'))
+    description = _text(record.get('description'))
+    if not title or not description:
+        return None, 'Task description and title cannot be empty'
+    if len(title) > TITLE_MAX_LENGTH:
+        return None, f'Title cannot be longer than {TITLE_MAX_LENGTH} characters'
+
+    status = _text(record.get('status')) or DEFAULT_STATUS
+    if len(status) > STATUS_MAX_LENGTH:
+        return None, f'Status cannot be longer than {STATUS_MAX_LENGTH} characters'
+
+    try:
+        sprint_id = _optional_int(record.get('sprint_id'))
+        assigned_to = _optional_int(record.get('assigned_to'))
+        label_names = _label_names(record.get('labels'))
+    except (TypeError, ValueError):
+        return None, 'sprint_id and assigned_to must be integers and labels a list of names'
+
+    return {
+        'title': title,
+        'description': description,
+        'status': status,
+        'sprint_name': _text(record.get('sprint')),
+        'sprint_id': sprint_id,
+        'assigned_to': assigned_to,
+        'label_names': label_names
+    }, None
+
+
+def _import_batch(session: DBSession, project_id: int, user_id: Optional[int],
+                  batch: List[Tuple[int, Dict[str, Any]]],
+                  fail: Callable[[int, str], None]) -> List[Tuple[Task, List[int]]]:
+    """Resolve references of a batch and insert its valid rows. The caller commits."""
+    sprint_names = {fields['sprint_name'] for _, fields in batch if fields['sprint_name']}
+    sprint_ids = {fields['sprint_id'] for _, fields in batch if fields['sprint_id'] is not None}
+    label_names = {name for _, fields in batch for name in fields['label_names']}
+    assignees = {fields['assigned_to'] for _, fields in batch if fields['assigned_to'] is not None}
+
+    sprints_by_name: Dict[str, int] = {}
+    project_sprint_ids = set()
+    if sprint_names or sprint_ids:
+        sprints = session.query(Sprint.sprint_id, Sprint.name).filter(
+            Sprint.project_id == project_id,
+            or_(Sprint.name.in_(sprint_names), Sprint.sprint_id.in_(sprint_ids))
+        ).order_by(Sprint.sprint_id)
+        for sprint_id, name in sprints:
+            sprints_by_name.setdefault(name, sprint_id)
+            project_sprint_ids.add(sprint_id)
+
+    labels_by_name: Dict[str, int] = {}
+    if label_names:
+        labels = session.query(Label.label_id, Label.name).filter(
+            Label.project_id == project_id, Label.name.in_(label_names)
+        ).order_by(Label.label_id)
+        for label_id, name in labels:
+            labels_by_name.setdefault(name, label_id)
+
+    members = set()
+    if assignees:
+        members = {member_id for member_id, in session.query(ProjectMember.member_id).filter(
+            ProjectMember.project_id == project_id, ProjectMember.member_id.in_(assignees))}
+
+    valid: List[Tuple[Dict[str, Any], Optional[int], List[int]]] = []
+    for row_number, fields in batch:
+        sprint_id = fields['sprint_id']
+        if fields['sprint_name']:
+            sprint_id = sprints_by_name.get(fields['sprint_name'])
+            if sprint_id is None:
+                fail(row_number, f'Sprint "{fields["sprint_name"]}" not found in the project')
+                continue
+        elif sprint_id is not None and sprint_id not in project_sprint_ids:
+            fail(row_number, f'Sprint {sprint_id} not found in the project')
+            continue
+        if fields['assigned_to'] is not None and fields['assigned_to'] not in members:
+            fail(row_number, f'User {fields["assigned_to"]} is not a member of the project')
+            continue
+        missing = [name for name in fields['label_names'] if name not in labels_by_name]
+        if missing:
+            fail(row_number, f'Labels not found in the project: {", ".join(missing)}')
+            continue
+        valid.append((fields, sprint_id, [labels_by_name[name] for name in fields['label_names']]))
+
+    if not valid:
+        return []
+
+    ids = iter(allocate_ids(session, len(valid) + sum(len(label_ids) for _, _, label_ids in valid)))
+    revision = next_revision(session)
+    ranks = append_ranks(session, project_id, [(sprint_id, fields['status']) for fields, sprint_id, _ in valid])
+    task_rows, task_label_rows, entries = [], [], []
+    delta: Counter = Counter()
+    for (fields, sprint_id, label_ids), rank in zip(valid, ranks):
+        task_row = {
+            'task_id': next(ids),
+            'project_id': project_id,
+            'sprint_id': sprint_id,
+            'title': fields['title'],
+            'description': fields['description'],
+            'status': fields['status'],
+            'assigned_to': fields['assigned_to'],
+            'rank': rank,
+            'revision': revision
+        }
+        task_rows.append(task_row)
+        task_label_rows.extend({'task_label_id': next(ids), 'task_id': task_row['task_id'], 'label_id': label_id,
+                                'revision': revision} for label_id in label_ids)
+        delta.update(taskcounters.task_dimensions(fields['status'], sprint_id, fields['assigned_to'], label_ids))
+        entries.append((Task(**task_row), label_ids))
+
+    session.execute(insert(Task).values(task_rows))
+    if task_label_rows:
+        session.execute(insert(TaskLabel).values(task_label_rows))
+    taskcounters.apply_counter_delta(session, project_id, delta)
+    statushistory.record_transitions(session, [{
+        'task_id': row['task_id'],
+        'project_id': project_id,
+        'sprint_id': row['sprint_id'],
+        'from_status': None,
+        'to_status': row['status'],
+        'changed_by': user_id
+    } for row in task_rows])
+    return entries
+
+
+def import_records(session: DBSession, project_id: int, user_id: Optional[int], records: Iterable[Record],
+                   checkpoint: Optional[Dict[str, Any]] = None,
+                   on_batch: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+    """
+    Import records into a project, committing after every batch.
+
+    :param session: The database session to import with.
+    :param project_id: The ID of the project.
+    :param user_id: The ID of the importing user, recorded in the status history.
+    :param records: Records as produced by iter_records.
+    :param checkpoint: A result saved by on_batch; rows up to its 'rows' are skipped.
+    :param on_batch: Called with the result so far after every committed batch.
+    :return: A dict with the last processed row ('rows'), the 'imported' and 'failed' counts, up to
+             MAX_REPORTED_ERRORS '{"row", "error"}' entries and, if the file could not be parsed to
+             the end, an 'aborted' message.
+    """
+    result: Dict[str, Any] = {'rows': 0, 'imported': 0, 'failed': 0, 'errors': []}
+    if checkpoint:
+        result.update(checkpoint)
+    skip_rows = last_row = result['rows']
+    batch: List[Tuple[int, Dict[str, Any]]] = []
+
+    def fail(row_number: int, error: str) -> None:
+        result['failed'] += 1
+        if len(result['errors']) < MAX_REPORTED_ERRORS:
+            result['errors'].append({'row': row_number, 'error': error})
+
+    def flush() -> None:
+        if batch:
+            entries = _import_batch(session, project_id, user_id, batch, fail)
+            session.commit()
+            batch.clear()
+            if entries:
+                request_rebalances((task.project_id, task.sprint_id, task.status, task.rank) for task, _ in entries)
+                searchindex.index_new_tasks(entries)
+                publish_event(project_id, 'tasks.imported', count=len(entries))
+                result['imported'] += len(entries)
+        result['rows'] = last_row
+        if on_batch:
+            on_batch(result)
+
+    try:
+        for row_number, record, error in records:
+            if row_number <= skip_rows:
+                continue
+            last_row = row_number
+            if error is None:
+                fields, error = validate_record(record)
+            if error is not None:
+                fail(row_number, error)
+                continue
+            batch.append((row_number, fields))
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                flush()
+    except (UnicodeDecodeError, csv.Error) as e:
+        result['aborted'] = f'The file could not be parsed after row {last_row}: {e}'
+
+    flush()
+    return result
+
+
+def upload_path(import_id: str) -> str:
+    return os.path.join(IMPORT_DIR, import_id)
+
+
+def save_upload(stream: BinaryIO, max_size: int = MAX_IMPORT_SIZE) -> str:
+    """
+    Save an upload in chunks for a background import.
+
+    :param stream: The upload.
+    :param max_size: Maximum number of bytes accepted.
+    :return: The ID of the saved upload.
+    :raises ImportTooLargeError: If the upload is longer than max_size.
+    """
+    os.makedirs(IMPORT_DIR, exist_ok=True)
+    import_id = uuid.uuid4().hex
+    path = upload_path(import_id)
+    size = 0
+    try:
+        with open(path, 'wb') as upload:
+            while chunk := stream.read(CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_size:
+                    raise ImportTooLargeError(f'Import exceeds {max_size} bytes')
+                upload.write(chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    return import_id
+
+
+@job('import_tasks')
+def import_tasks(import_id: str, project_id: int, import_format: str, imported_by: Optional[int] = None,
+                 progress: ProgressCallback = no_progress) -> Dict[str, Any]:
+    """
+    Import a saved upload, resuming from the last checkpoint, and remove the upload when done.
+
+    :param import_id: The ID returned by save_upload.
+    :param project_id: The ID of the project.
+    :param import_format: CSV or NDJSON.
+    :param imported_by: The ID of the importing user.
+    :param progress: Called with the number of read and total bytes after every batch.
+    :return: The import result, see import_records.
+    """
+    path = upload_path(import_id)
+    checkpoint_key = f'{CHECKPOINT_PREFIX}{import_id}'
+    saved = redis_client.get(checkpoint_key)
+    total = os.path.getsize(path)
+
+    with open(path, 'rb') as upload, project_shard(project_id).session() as session:
+        def save_checkpoint(result: Dict[str, Any]) -> None:
+            redis_client.set(checkpoint_key, json.dumps(result), ex=CHECKPOINT_TTL_SECONDS)
+            progress(upload.tell(), total, f'{result["rows"]} rows processed')
+
+        result = import_records(session, project_id, imported_by, iter_records(upload, import_format),
+                                checkpoint=json.loads(saved) if saved else None, on_batch=save_checkpoint)
+
+    os.remove(path)
+    redis_client.delete(checkpoint_key)
+    return result
@@ -0,0 +1,303 @@
+"""
+Composable filters, sort keys and keyset pagination over the tasks of a project, or over the tasks
+assigned to a user across all of the user's projects (see apiroutes/assignedtasks.py).
+
+A TaskQuery compiles to one SELECT on tasks. Label conditions are semi-joins on task_labels
+(EXISTS for any of a set of labels, an IN over tasks having every label of a set), so a task is
+returned once however many of its labels match. Pages are selected with a keyset condition on the
+sort key and task_id, carried between requests in an opaque cursor, instead of an OFFSET.
+"""
+import base64
+import binascii
+import json
+from datetime import date
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import and_, distinct, exists, func, or_, select
+from sqlalchemy.orm import Session as DBSession
+from sqlalchemy.sql import ColumnElement, Select
+from werkzeug.datastructures import MultiDict
+
+from database.map_db import Label, Sprint, Task, TaskLabel
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+MAX_FILTER_VALUES = 100
+
+# Sort keys are non-null expressions, so that the keyset condition compares them exactly.
+SORT_KEYS: Dict[str, ColumnElement] = {
+    'task_id': Task.task_id,
+    'title': Task.title,
+    'status': func.coalesce(Task.status, ''),
+    'revision': func.coalesce(Task.revision, 0),
+    'rank': func.coalesce(Task.rank, '')
+}
+
+
+class TaskQueryError(ValueError):
+    """Raised for invalid task query parameters."""
+
+
+class TaskQuery(NamedTuple):
+    """
+    Filters and ordering of a task query. Filters are combined with AND; the values of one filter
+    with OR, except labels_all, which requires every label.
+    """
+    labels_all: Tuple[int, ...] = ()
+    labels_any: Tuple[int, ...] = ()
+    statuses: Tuple[str, ...] = ()
+    assignees: Tuple[int, ...] = ()
+    sprint_ids: Tuple[int, ...] = ()
+    unsprinted: bool = False
+    sprint_from: Optional[date] = None
+    sprint_to: Optional[date] = None
+    text: Optional[str] = None
+    sort: str = 'task_id'
+    descending: bool = False
+    limit: Optional[int] = DEFAULT_PAGE_SIZE
+    cursor: Optional[str] = None
+
+    @classmethod
+    def from_args(cls, args: MultiDict) -> 'TaskQuery':
+        """
+        Parse a task query from request arguments. List filters accept repeated arguments and
+        comma-separated values: 'labels_all', 'labels_any', 'status', 'assigned_to', 'sprint_id'.
+        Further arguments: 'unsprinted', 'sprint_from' and 'sprint_to' (ISO dates; tasks of sprints
+        overlapping the range), 'q', 'sort' (a sort key, prefixed with '-' for descending order),
+        'limit' and 'cursor'.
+
+        :param args: The request arguments.
+        :return: The task query.
+        :raises TaskQueryError: If an argument is invalid.
+        """
+        sort = args.get('sort', 'task_id')
+        descending = sort.startswith('-')
+        if descending:
+            sort = sort[1:]
+        if sort not in SORT_KEYS:
+            raise TaskQueryError(f'sort must be one of {", ".join(SORT_KEYS)}, optionally prefixed with -')
+
+        try:
+            limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+        except ValueError:
+            raise TaskQueryError('limit must be an integer')
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            raise TaskQueryError(f'limit must be between 1 and {MAX_PAGE_SIZE}')
+
+        query = cls(
+            labels_all=_int_values(args, 'labels_all'),
+            labels_any=_int_values(args, 'labels_any'),
+            statuses=_values(args, 'status'),
+            assignees=_int_values(args, 'assigned_to'),
+            sprint_ids=_int_values(args, 'sprint_id'),
+            unsprinted=args.get('unsprinted', 'false').lower() == 'true',
+            sprint_from=_date_value(args, 'sprint_from'),
+            sprint_to=_date_value(args, 'sprint_to'),
+            text=args.get('q', '').strip() or None,
+            sort=sort,
+            descending=descending,
+            limit=limit,
+            cursor=args.get('cursor') or None
+        )
+        if query.unsprinted and (query.sprint_ids or query.sprint_from or query.sprint_to):
+            raise TaskQueryError('unsprinted cannot be combined with sprint_id, sprint_from or sprint_to')
+        if query.sprint_from and query.sprint_to and query.sprint_from > query.sprint_to:
+            raise TaskQueryError('sprint_from must not be after sprint_to')
+        return query
+
+
+def _values(args: MultiDict, name: str) -> Tuple[str, ...]:
+    values = tuple(value.strip() for arg in args.getlist(name) for value in arg.split(',') if value.strip())
+    if len(values) > MAX_FILTER_VALUES:
+        raise TaskQueryError(f'{name} accepts at most {MAX_FILTER_VALUES} values')
+    return values
+
+
+def _int_values(args: MultiDict, name: str) -> Tuple[int, ...]:
+    try:
+        return tuple(int(value) for value in _values(args, name))
+    except ValueError:
+        raise TaskQueryError(f'{name} must be a list of integers')
+
+
+def _date_value(args: MultiDict, name: str) -> Optional[date]:
+    value = args.get(name)
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise TaskQueryError(f'{name} must be a date in YYYY-MM-DD format')
+
+
+def _escape_like(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def task_conditions(project_id: int, query: TaskQuery) -> List[ColumnElement]:
+    """
+    Build the WHERE conditions of a task query.
+
+    :param project_id: The ID of the project.
+    :param query: The task query.
+    :return: The conditions, to be combined with AND.
+    """
+    return [Task.project_id == project_id, *filter_conditions(query)]
+
+
+def filter_conditions(query: TaskQuery) -> List[ColumnElement]:
+    """
+    Build the WHERE conditions of the filters of a task query, without restricting the project.
+
+    :param query: The task query.
+    :return: The conditions, to be combined with AND.
+    """
+    conditions = []
+    if query.labels_all:
+        label_ids = set(query.labels_all)
+        conditions.append(Task.task_id.in_(
+            select(TaskLabel.task_id)
+            .where(TaskLabel.label_id.in_(label_ids))
+            .group_by(TaskLabel.task_id)
+            .having(func.count(distinct(TaskLabel.label_id)) == len(label_ids))
+        ))
+    if query.labels_any:
+        conditions.append(exists().where(TaskLabel.task_id == Task.task_id,
+                                         TaskLabel.label_id.in_(query.labels_any)))
+    if query.statuses:
+        conditions.append(Task.status.in_(query.statuses))
+    if query.assignees:
+        conditions.append(Task.assigned_to.in_(query.assignees))
+    if query.unsprinted:
+        conditions.append(Task.sprint_id.is_(None))
+    elif query.sprint_ids:
+        conditions.append(Task.sprint_id.in_(query.sprint_ids))
+    if query.sprint_from or query.sprint_to:
+        sprint_conditions = []
+        if query.sprint_from:
+            sprint_conditions.append(Sprint.end_date >= query.sprint_from)
+        if query.sprint_to:
+            sprint_conditions.append(Sprint.start_date <= query.sprint_to)
+        conditions.append(Task.sprint_id.in_(select(Sprint.sprint_id).where(*sprint_conditions)))
+    if query.text:
+        pattern = f'%{_escape_like(query.text)}%'
+        conditions.append(or_(Task.title.ilike(pattern, escape='\\'),
+                              Task.description.ilike(pattern, escape='\\')))
+    return conditions
+
+
+def encode_cursor(query: TaskQuery, sort_value: Any, task_id: int) -> str:
+    payload = json.dumps([query.sort, query.descending, sort_value, task_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(query: TaskQuery) -> Tuple[Any, int]:
+    """
+    Decode the cursor of a task query.
+
+    :param query: The task query.
+    :return: The sort value and task ID of the last task of the previous page.
+    :raises TaskQueryError: If the cursor is malformed or was issued for another sort order.
+    """
+    try:
+        padded = query.cursor + '=' * (-len(query.cursor) % 4)
+        sort, descending, sort_value, task_id = json.loads(base64.urlsafe_b64decode(padded))
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+        raise TaskQueryError('Invalid cursor')
+    if sort != query.sort or descending != query.descending or not isinstance(task_id, int):
+        raise TaskQueryError('The cursor belongs to a query with another sort order')
+    return sort_value, task_id
+
+
+def build_statement(project_id: int, query: TaskQuery) -> Select:
+    """
+    Compile a task query to a SELECT of (Task, sort value) rows, without a limit.
+
+    :param project_id: The ID of the project.
+    :param query: The task query.
+    :return: The statement.
+    """
+    return keyset_statement(query, task_conditions(project_id, query))
+
+
+def keyset_statement(query: TaskQuery, conditions: List[ColumnElement]) -> Select:
+    """
+    Compile the order and cursor of a task query with the given conditions to a SELECT of
+    (Task, sort value) rows, without a limit.
+
+    :param query: The task query.
+    :param conditions: The WHERE conditions.
+    :return: The statement.
+    """
+    sort_key = SORT_KEYS[query.sort]
+    conditions = list(conditions)
+
+    if query.cursor:
+        sort_value, task_id = decode_cursor(query)
+        after = (lambda column, value: column < value) if query.descending else (lambda column, value: column > value)
+        if query.sort == 'task_id':
+            conditions.append(after(Task.task_id, task_id))
+        else:
+            conditions.append(or_(after(sort_key, sort_value),
+                                  and_(sort_key == sort_value, after(Task.task_id, task_id))))
+
+    order_by = (sort_key.desc(), Task.task_id.desc()) if query.descending else (sort_key, Task.task_id)
+    return select(Task, sort_key.label('sort_value')).where(*conditions).order_by(*order_by)
+
+
+def _page(query: TaskQuery, rows: List[Any]) -> Tuple[List[Task], Optional[str]]:
+    if len(rows) <= query.limit:
+        return [task for task, _ in rows], None
+    last_task, last_sort_value = rows[query.limit - 1]
+    return [task for task, _ in rows[:query.limit]], encode_cursor(query, last_sort_value, last_task.task_id)
+
+
+def query_tasks(session: DBSession, project_id: int, query: TaskQuery) -> Tuple[List[Task], Optional[str]]:
+    """
+    Run a task query and return one page of tasks.
+
+    :param session: The database session.
+    :param project_id: The ID of the project.
+    :param query: The task query.
+    :return: The tasks of the page and the cursor of the next page, or None on the last page.
+    :raises TaskQueryError: If the cursor is invalid.
+    """
+    statement = build_statement(project_id, query)
+    if query.limit is None:
+        return [task for task, _ in session.execute(statement)], None
+    return _page(query, session.execute(statement.limit(query.limit + 1)).all())
+
+
+def merge_pages(query: TaskQuery, rows: List[Tuple[Task, Any]]) -> Tuple[List[Task], Optional[str]]:
+    """
+    Merge pages of the same task query run on several databases into one page, in the sort order of
+    the query, which assumes the databases compare strings by code point.
+
+    :param query: The task query, with a limit.
+    :param rows: The (Task, sort value) rows of every page, each page with up to limit + 1 rows.
+    :return: The tasks of the merged page and the cursor of the next page, or None on the last page.
+    """
+    rows = sorted(rows, key=lambda row: (row[1], row[0].task_id), reverse=query.descending)
+    return _page(query, rows)
+
+
+def label_names_by_task(session: DBSession, task_ids: List[int]) -> Dict[int, List[str]]:
+    """
+    Get the label names of tasks in one query.
+
+    :param session: The database session.
+    :param task_ids: The IDs of the tasks.
+    :return: A dict mapping every task ID to the names of its labels.
+    """
+    names: Dict[int, List[str]] = {task_id: [] for task_id in task_ids}
+    if not task_ids:
+        return names
+    rows = session.execute(
+        select(TaskLabel.task_id, Label.name)
+        .join(Label, Label.label_id == TaskLabel.label_id)
+        .where(TaskLabel.task_id.in_(task_ids))
+        .order_by(TaskLabel.task_id, Label.name)
+    )
+    for task_id, name in rows:
+        names[task_id].append(name)
+    return names
@@ -0,0 +1,187 @@
+"""
+Ordering of tasks within board columns with fractional ranks (see database/ranks.py).
+
+A column holds the tasks of a project with one sprint and status, ordered by rank and task ID
+through the (project_id, sprint_id, status, rank) index. New tasks are appended to their column.
+Moving a task between two neighbours writes only the task's rank. Once a move or an append produces
+a rank longer than MAX_RANK_LENGTH, a job ranks the column anew with evenly spaced keys; the same happens
+synchronously when the neighbours of a move have no rank or share one, which tasks changing
+column through other updates can cause.
+
+Keys:
+    ranks:rebalancing:<project_id>:<sprint_id>:<status>    set while a rebalancing job is queued
+"""
+import json
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import and_, func, or_, select, update
+from sqlalchemy.orm import Session as DBSession
+from sqlalchemy.sql import ColumnElement
+
+from .events import publish_event
+from .jobs import ProgressCallback, enqueue, job, no_progress
+from .redisclient import redis_client
+from .shards import project_shard
+from database.map_db import Task
+from database.ranks import rank_between, ranks_after, ranks_between
+from database.revisions import next_revision
+
+MAX_RANK_LENGTH = 32
+REBALANCING_PREFIX = 'ranks:rebalancing:'
+REBALANCING_TTL_SECONDS = 600
+
+
+def column_conditions(project_id: int, sprint_id: Optional[int], status: Optional[str]) -> List[ColumnElement]:
+    """
+    Build the conditions selecting the tasks of a column.
+
+    :param project_id: The ID of the project.
+    :param sprint_id: The ID of the sprint, None for tasks without a sprint.
+    :param status: The status.
+    :return: The conditions, to be combined with AND.
+    """
+    return [
+        Task.project_id == project_id,
+        Task.sprint_id.is_(None) if sprint_id is None else Task.sprint_id == sprint_id,
+        Task.status.is_(None) if status is None else Task.status == status
+    ]
+
+
+def last_ranks(session: DBSession, project_id: int,
+               columns: Iterable[Tuple[Optional[int], Optional[str]]]) -> Dict[Tuple[Optional[int], Optional[str]], Optional[str]]:
+    """
+    Get the greatest rank of columns of a project, to append tasks to them.
+
+    :param session: The current database session.
+    :param project_id: The ID of the project.
+    :param columns: Pairs of a sprint ID and a status.
+    :return: Mapping of every column to its greatest rank, None for empty or unranked columns.
+    """
+    columns = set(columns)
+    last: Dict[Tuple[Optional[int], Optional[str]], Optional[str]] = dict.fromkeys(columns)
+    if not columns:
+        return last
+    rows = session.execute(
+        select(Task.sprint_id, Task.status, func.max(Task.rank))
+        .where(or_(*(and_(*column_conditions(project_id, sprint_id, status)) for sprint_id, status in columns)))
+        .group_by(Task.sprint_id, Task.status)
+    )
+    for sprint_id, status, rank in rows:
+        last[(sprint_id, status)] = rank
+    return last
+
+
+def append_ranks(session: DBSession, project_id: int,
+                 columns: List[Tuple[Optional[int], Optional[str]]]) -> List[str]:
+    """
+    Get the ranks of new tasks appended to the end of their columns, in the given order.
+
+    :param session: The current database session.
+    :param project_id: The ID of the project of the tasks.
+    :param columns: The column of every new task, as a pair of a sprint ID and a status.
+    :return: The ranks of the tasks.
+    """
+    counts = Counter(columns)
+    new_ranks = {column: iter(ranks_after(rank, counts[column]))
+                 for column, rank in last_ranks(session, project_id, counts).items()}
+    return [next(new_ranks[column]) for column in columns]
+
+
+def rank_column(session: DBSession, project_id: int, sprint_id: Optional[int], status: Optional[str]) -> int:
+    """
+    Give the tasks of a column evenly spaced ranks, keeping their order; unranked tasks come first,
+    by task ID. The caller commits.
+
+    :param session: The current database session.
+    :param project_id: The ID of the project.
+    :param sprint_id: The ID of the sprint, None for tasks without a sprint.
+    :param status: The status.
+    :return: The number of ranked tasks.
+    """
+    task_ids = list(session.scalars(
+        select(Task.task_id).where(*column_conditions(project_id, sprint_id, status))
+        .order_by(func.coalesce(Task.rank, ''), Task.task_id)
+    ))
+    if not task_ids:
+        return 0
+    revision = next_revision(session)
+    session.execute(update(Task), [
+        {'task_id': task_id, 'rank': rank, 'revision': revision}
+        for task_id, rank in zip(task_ids, ranks_between(None, None, len(task_ids)))
+    ])
+    return len(task_ids)
+
+
+def rank_after_move(session: DBSession, task: Task, before: Optional[Task], after: Optional[Task]) -> str:
+    """
+    Get the rank placing a task between two tasks of its column, ranking the column first if the
+    neighbours have no distinct ranks.
+
+    :param session: The current database session.
+    :param task: The moved task, already in its target column.
+    :param before: The task to follow, None for the top of the column.
+    :param after: The task to precede, None for the bottom of the column.
+    :return: The new rank of the task.
+    :raises ValueError: If before does not precede after.
+    """
+    neighbours = [neighbour for neighbour in (before, after) if neighbour is not None]
+    ranks = [neighbour.rank for neighbour in neighbours]
+    if None in ranks or (len(ranks) == 2 and ranks[0] >= ranks[1]):
+        rank_column(session, task.project_id, task.sprint_id, task.status)
+        for neighbour in neighbours:
+            session.refresh(neighbour, ['rank'])
+    return rank_between(before.rank if before else None, after.rank if after else None)
+
+
+def _rebalancing_key(project_id: int, sprint_id: Optional[int], status: Optional[str]) -> str:
+    return f'{REBALANCING_PREFIX}{project_id}:{json.dumps(sprint_id)}:{json.dumps(status)}'
+
+
+def request_rebalance(project_id: int, sprint_id: Optional[int], status: Optional[str]) -> None:
+    """
+    Queue a job ranking a column anew, unless one is queued already.
+
+    :param project_id: The ID of the project.
+    :param sprint_id: The ID of the sprint, None for tasks without a sprint.
+    :param status: The status.
+    """
+    if redis_client.set(_rebalancing_key(project_id, sprint_id, status), 1, nx=True, ex=REBALANCING_TTL_SECONDS):
+        enqueue('rebalance_ranks', project_id=project_id, sprint_id=sprint_id, status=status)
+
+
+def request_rebalances(tasks: Iterable[Tuple[int, Optional[int], Optional[str], Optional[str]]]) -> None:
+    """
+    Queue jobs ranking anew the columns of tasks whose rank is longer than MAX_RANK_LENGTH. Call after committing.
+
+    :param tasks: The project ID, sprint ID, status and rank of every written task.
+    """
+    for project_id, sprint_id, status in {(project_id, sprint_id, status) for project_id, sprint_id, status, rank in tasks
+                                          if rank is not None and len(rank) > MAX_RANK_LENGTH}:
+        request_rebalance(project_id, sprint_id, status)
+
+
+@job('rebalance_ranks')
+def rebalance_ranks(project_id: int, sprint_id: Optional[int], status: Optional[str],
+                    progress: ProgressCallback = no_progress) -> int:
+    """
+    Rank a column anew if one of its ranks is longer than MAX_RANK_LENGTH.
+
+    :param project_id: The ID of the project.
+    :param sprint_id: The ID of the sprint, None for tasks without a sprint.
+    :param status: The status.
+    :param progress: Progress callback of the job.
+    :return: The number of ranked tasks.
+    """
+    redis_client.delete(_rebalancing_key(project_id, sprint_id, status))
+    with project_shard(project_id).session() as session_db:
+        longest = session_db.execute(
+            select(func.max(func.length(Task.rank))).where(*column_conditions(project_id, sprint_id, status))
+        ).scalar()
+        if not longest or longest <= MAX_RANK_LENGTH:
+            return 0
+        ranked = rank_column(session_db, project_id, sprint_id, status)
+        session_db.commit()
+    progress(ranked, ranked)
+    publish_event(project_id, 'tasks.reranked', sprint_id=sprint_id, status=status)
+    return ranked
@@ -1,13 +1,16 @@
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 from flask import request, jsonify, session as flask_session, g
 from sqlalchemy import or_
 import re
 
 from . import users
 from ..session import Session
-from ..utils import require_user
-from database.map_db import User, UserSettings
-from ..commitoperations import add_object, delete_object
+from ..utils import note_write, require_user, shard_session
+from database.map_db import ProjectMember, User, UserSettings
+from ..commitoperations import add_object
+from .. import cascade, jobs, searchindex, shards, userindex
+from ..events import publish_event
+from ..refcache import MEMBERS, invalidate_reference_data
 
 
 def validate_password(password: str) -> Optional[str]:
@@ -22,18 +25,72 @@ def validate_password(password: str) -> Optional[str]:
     return None
 
 
+def get_member_project_ids(user_id: int) -> List[int]:
+    """
+    Get the IDs of the projects a user is a member of, on every shard.
+
+    :param user_id: The ID of the user.
+    :return: The IDs of the projects.
+    """
+    return shards.scatter(lambda session_db: [project_id for project_id, in session_db.query(
+        ProjectMember.project_id).filter(ProjectMember.member_id == user_id)], g.session)
+
+
 @users.route('', methods=['DELETE'])
 @require_user
 def delete_user() -> Tuple[Dict[str, str], int]:
     """
-    Delete the current user from the database.
+    Delete the current user from the database. Owned projects are handed over to another member
+    or deleted when the user is their only member, and assigned tasks become unassigned.
+    The project data of every shard is released before the user is deleted from the main shard.
 
     :return: A JSON response with a success message and a 200 status code.
     """
-    delete_object(g.user)
+    user_id = g.user.user_id
+    member_project_ids = get_member_project_ids(user_id)
+
+    deleted_project_ids = []
+    pending_purges = []
+    for shard in reversed(shards.SHARDS):
+        with shard_session(shard) as session_db:
+            delete = cascade.delete_user if shard is shards.MAIN else cascade.release_user
+            deleted, pending = delete(session_db, user_id)
+            session_db.commit()
+        deleted_project_ids += deleted
+        pending_purges += [(project_id, shard.name) for project_id in pending]
+    userindex.remove_user(user_id)
+
+    for project_id in member_project_ids:
+        invalidate_reference_data(project_id, MEMBERS)
+
+    for project_id in deleted_project_ids:
+        searchindex.drop_project_index(project_id)
+        publish_event(project_id, 'project.deleted')
+    for project_id, shard_name in pending_purges:
+        jobs.enqueue('purge_project', project_id=project_id, shard=shard_name)
+
+    flask_session.pop('authenticated', None)
+    flask_session.pop('user_id', None)
     return jsonify({'message': 'User deleted successfully'}), 200
 
 
+@users.route('/search', methods=['GET'])
+@require_user
+def search_users() -> Tuple[Any, int]:
+    """
+    Find users whose username or email starts with 'q', for autocompletion.
+    'limit' sets the number of results (default 10, at most 50).
+
+    :return: A JSON response with a list of matching users and a 200 status code,
+             otherwise an error message with a 400 status code.
+    """
+    limit = request.args.get('limit', userindex.DEFAULT_SEARCH_LIMIT, type=int)
+    if not 0 < limit <= userindex.MAX_SEARCH_LIMIT:
+        return jsonify({'error': f'limit must be between 1 and {userindex.MAX_SEARCH_LIMIT}'}), 400
+
+    return jsonify(userindex.search_users(request.args.get('q', ''), limit)), 200
+
+
 @users.route('/login', methods=['POST'])
 def login() -> Tuple[Dict[str, str], int]:
     """
@@ -109,12 +166,17 @@ def update_current_user() -> Tuple[Dict[str, str], int]:
     else:
         user.password_hash = data.get('password_hash', user._password_hash)
 
+    username_changed = data.get('username', user.username) != user.username
     user.username = data.get('username', user.username)
     user.company = data.get('company', user.company)
     user.phone = data.get('phone', user.phone)
     user.sex = data.get('sex', user.sex)
 
     add_object(user)
+    if username_changed:
+        userindex.index_user(user)
+        for project_id in get_member_project_ids(user.user_id):
+            invalidate_reference_data(project_id, MEMBERS)
 
     return jsonify({'message': 'User updated successfully'}), 200
 
@@ -177,5 +239,8 @@ def create_user() -> Tuple[Dict[str, str], int]:
         )
         session.add(new_settings)
         session.commit()
+        userindex.index_user(new_user)
+        # The user logs in next, which the read engines may not see yet.
+        note_write()
 
         return jsonify({'message': 'User created successfully'}), 201
@@ -0,0 +1,164 @@
+"""
+Prefix index over the usernames and emails of all users, kept in Redis.
+
+Keys:
+    users:prefix    sorted set (score 0) of '<lowercase username or email>\\0<user_id>' members,
+                    searched with ZRANGEBYLEX
+    users:names     hash of user ID to a JSON object with the username, email and indexed terms
+
+A search is one ZRANGEBYLEX and one HMGET inside a script, O(log N + k) in the number of users.
+Users are indexed when they are created or updated and removed when they are deleted;
+rebuild_user_index restores the index from the database.
+"""
+import json
+from typing import Any, Dict, List
+
+from sqlalchemy.orm import Session as DBSession
+
+from .redisclient import redis_client
+from database.map_db import User
+
+PREFIX_KEY = 'users:prefix'
+NAMES_KEY = 'users:names'
+DEFAULT_SEARCH_LIMIT = 10
+MAX_SEARCH_LIMIT = 50
+REBUILD_BATCH_SIZE = 1000
+
+# Replaces the terms of a user with ARGV[3..] and stores its names, or removes it if ARGV[2] is empty.
+_index_user = redis_client.register_script("""
+local previous = redis.call('HGET', KEYS[2], ARGV[1])
+if previous then
+    for _, term in ipairs(cjson.decode(previous)['terms']) do
+        redis.call('ZREM', KEYS[1], term .. '\\0' .. ARGV[1])
+    end
+end
+if ARGV[2] == '' then
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    return
+end
+for i = 3, #ARGV do
+    redis.call('ZADD', KEYS[1], 0, ARGV[i] .. '\\0' .. ARGV[1])
+end
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+""")
+
+# Returns the names of the first ARGV[3] distinct users with a term in [ARGV[1], ARGV[2]].
+_search = redis_client.register_script("""
+local limit = tonumber(ARGV[3])
+local seen = {}
+local user_ids = {}
+local offset = 0
+while #user_ids < limit do
+    local members = redis.call('ZRANGEBYLEX', KEYS[1], ARGV[1], ARGV[2], 'LIMIT', offset, limit * 2)
+    if #members == 0 then
+        break
+    end
+    for _, member in ipairs(members) do
+        local user_id = string.match(member, '(%d+)$')
+        if user_id and not seen[user_id] and #user_ids < limit then
+            seen[user_id] = true
+            user_ids[#user_ids + 1] = user_id
+        end
+    end
+    offset = offset + #members
+end
+if #user_ids == 0 then
+    return {}
+end
+local names = redis.call('HMGET', KEYS[2], unpack(user_ids))
+local result = {}
+for i, user_id in ipairs(user_ids) do
+    if names[i] then
+        result[#result + 1] = user_id
+        result[#result + 1] = names[i]
+    end
+end
+return result
+""")
+
+
+def _entry(username: str, email: str) -> Dict[str, Any]:
+    return {'username': username, 'email': email, 'terms': sorted({username.lower(), email.lower()})}
+
+
+def index_user(user: User) -> None:
+    """
+    Add a user to the index or update its names.
+
+    :param user: The user, after the change has been committed.
+    """
+    entry = _entry(user.username, user.email)
+    _index_user(keys=[PREFIX_KEY, NAMES_KEY], args=[user.user_id, json.dumps(entry), *entry['terms']])
+
+
+def remove_user(user_id: int) -> None:
+    """
+    Remove a deleted user from the index.
+
+    :param user_id: The ID of the user.
+    """
+    _index_user(keys=[PREFIX_KEY, NAMES_KEY], args=[user_id, ''])
+
+
+def search_users(prefix: str, limit: int = DEFAULT_SEARCH_LIMIT) -> List[Dict[str, Any]]:
+    """
+    Find users whose username or email starts with a prefix, case-insensitively.
+
+    :param prefix: The prefix; an empty prefix matches nobody.
+    :param limit: The maximum number of users returned.
+    :return: Dicts with the user ID, username and email of the matching users, in the order of
+             their first matching name.
+    """
+    prefix = prefix.strip().lower()
+    if not prefix:
+        return []
+    # U+10FFFF encodes to bytes greater than those of any other character, closing the range.
+    result = _search(keys=[PREFIX_KEY, NAMES_KEY], args=[f'[{prefix}', f'[{prefix}\U0010ffff', limit])
+    users = []
+    for user_id, entry in zip(result[::2], result[1::2]):
+        entry = json.loads(entry)
+        users.append({'user_id': int(user_id), 'username': entry['username'], 'email': entry['email']})
+    return users
+
+
+def match_prefix(rows: List[Dict[str, Any]], prefix: str, limit: int = DEFAULT_SEARCH_LIMIT) -> List[Dict[str, Any]]:
+    """
+    Filter user rows, such as the cached members of a project, to those whose username or email
+    starts with a prefix, case-insensitively.
+
+    :param rows: Dicts with 'username' and 'email' keys.
+    :param prefix: The prefix; an empty prefix matches nobody.
+    :param limit: The maximum number of rows returned.
+    :return: The matching rows, ordered by their first matching name.
+    """
+    prefix = prefix.strip().lower()
+    if not prefix:
+        return []
+    matches = []
+    for row in rows:
+        names = [name.lower() for name in (row['username'], row['email']) if name.lower().startswith(prefix)]
+        if names:
+            matches.append((min(names), row))
+    matches.sort(key=lambda match: match[0])
+    return [row for _, row in matches[:limit]]
+
+
+def rebuild_user_index(session: DBSession) -> int:
+    """
+    Rebuild the index from the users table.
+
+    :param session: The database session.
+    :return: The number of indexed users.
+    """
+    redis_client.delete(PREFIX_KEY, NAMES_KEY)
+    count = 0
+    query = session.query(User.user_id, User.username, User.email).order_by(User.user_id)
+    for rows in query.yield_per(REBUILD_BATCH_SIZE).partitions():
+        pipe = redis_client.pipeline(transaction=False)
+        for user_id, username, email in rows:
+            entry = _entry(username, email)
+            pipe.zadd(PREFIX_KEY, {f'{term}\0{user_id}': 0 for term in entry['terms']})
+            pipe.hset(NAMES_KEY, user_id, json.dumps(entry))
+        pipe.execute()
+        count += len(rows)
+    return count
@@ -1,25 +1,106 @@
-from typing import Any, Optional, Tuple, Type, Callable
+import time
+from contextlib import ExitStack, contextmanager
+from typing import Any, Dict, Iterator, NamedTuple, Optional, Tuple, Type, Callable
 from flask import request, jsonify, session as flask_session, g
+from sqlalchemy import delete, exists, select, update
 from sqlalchemy.orm import Session as DBSession
+from sqlalchemy.sql import ColumnElement
 from functools import partial, wraps
 
-from .session import Session
-from database.map_db import Label, Project, ProjectMember, Sprint, Task, User
+from . import shards
+from .session import READ_YOUR_WRITES_SECONDS, ReadSession, Session, committed_write
+from database.map_db import Label, Project, ProjectMember, Sprint, Task, Tombstone, User
+from database.revisions import next_revision, record_tombstones
+
+READ_METHODS = ('GET', 'HEAD')
+LAST_WRITE_KEY = 'last_write_at'
+
+
+class BatchScope(NamedTuple):
+    """
+    State shared by the sub-requests of a batch request, stored in g.batch: the authenticated user,
+    the database session of the main shard, the sessions of the other shards, opened on first use,
+    the results of access checks, keyed by checker, resource type and ID, and whether the sessions
+    use the read engines.
+    """
+    user: User
+    session: DBSession
+    shard_sessions: Dict[str, DBSession]
+    access: Dict[Tuple[str, str, Any], Tuple[bool, Optional[Any], shards.Shard]]
+    read: bool = False
+
+    def shard_session(self, shard: shards.Shard) -> DBSession:
+        """
+        Get the batch session of a shard.
+
+        :param shard: The shard.
+        :return: The session.
+        """
+        if shard is shards.MAIN:
+            return self.session
+        if shard.name not in self.shard_sessions:
+            self.shard_sessions[shard.name] = shard.session_factory(self.read)()
+        return self.shard_sessions[shard.name]
+
+    def close(self) -> None:
+        """
+        Close the sessions of the shards other than the main shard.
+        """
+        for session_db in self.shard_sessions.values():
+            session_db.close()
+        self.shard_sessions.clear()
+
+
+def note_write() -> None:
+    """
+    Record in the Flask session that the user has just written, so their reads go to the write
+    engines for READ_YOUR_WRITES_SECONDS.
+    """
+    flask_session[LAST_WRITE_KEY] = time.time()
+
+
+def recently_wrote() -> bool:
+    """
+    Check whether the user has written within READ_YOUR_WRITES_SECONDS, so the read engines may
+    not show their writes yet.
+
+    :return: True if the user wrote recently.
+    """
+    return time.time() - flask_session.get(LAST_WRITE_KEY, 0) < READ_YOUR_WRITES_SECONDS
+
+
+def use_read_engines() -> bool:
+    """
+    Check whether the current request is served by the read engines: GET requests of users who
+    have not written recently.
+
+    :return: True if the request should read through the read engines.
+    """
+    return request.method in READ_METHODS and not recently_wrote()
 
 
 def require_user(func):
     """
     Decorator that ensures the user is authenticated.
+    GET requests run in a session of the read engine unless the user wrote recently; other requests
+    run in a session of the write engine and are recorded with note_write if they committed a write.
+    Within a batch request, the user and session of the batch are used.
 
     :param func: The view function to decorate.
     :return: The decorated view function.
     """
     @wraps(func)
     def decorated_view(*args, **kwargs):
+        batch = g.get('batch')
         try:
+            if batch is not None:
+                g.user = batch.user
+                g.session = batch.session
+                return func(*args, **kwargs)
             if 'user_id' in flask_session:
                 user_id = flask_session['user_id']
-                with Session() as session_db:
+                read = use_read_engines()
+                with (ReadSession if read else Session)() as session_db:
                     user = session_db.query(User).filter(User.user_id == user_id).first()
                     if user:
                         g.user = user 
@@ -30,53 +111,72 @@ def require_user(func):
             else:
                 return jsonify({'error': 'Not authenticated'}), 401
         finally:
+            # Writes of batch sub-requests are recorded by the batch request.
+            if batch is None and 'user_id' in flask_session and committed_write():
+                note_write()
             g.pop('user', None)
             g.pop('session', None)
 
     return decorated_view
 
 
+@contextmanager
+def shard_session(shard: shards.Shard) -> Iterator[DBSession]:
+    """
+    Provide a session of a shard to a route that only knows the shard of its data after require_user:
+    g.session for the main shard, the batch session of the shard within a batch request, otherwise
+    a new session of the engine require_user chose, closed on exit.
+
+    :param shard: The shard.
+    :return: A context manager yielding the session.
+    """
+    batch = g.get('batch')
+    if shard is shards.MAIN:
+        yield g.session
+    elif batch is not None:
+        yield batch.shard_session(shard)
+    else:
+        with shard.session_factory(use_read_engines())() as session_db:
+            yield session_db
+
+
+def is_project_member(project_id: Any, user_id: int) -> ColumnElement:
+    """
+    Condition that a user is a member of a project, to authorize a statement within the statement itself.
+
+    :param project_id: The project ID column of the resource, or a project ID.
+    :param user_id: The ID of the user.
+    :return: An EXISTS condition on the project members.
+    """
+    return exists().where(ProjectMember.project_id == project_id, ProjectMember.member_id == user_id)
+
+
 def user_has_access_to_task(user_id: int, task_id: int, session: DBSession) -> Tuple[bool, Optional[Task]]:
     """
-    Check if the user has access to the task.
+    Check if the user has access to the task, loading the task and checking the membership in one query.
 
     :param user_id: The ID of the user.
     :param task_id: The ID of the task.
     :param session: The current database session.
-    :return: A tuple containing a boolean indicating if the user has access and the task if found.
+    :return: A tuple containing a boolean indicating if the user has access and the task if accessible.
     """
-    task = session.query(Task).filter(Task.task_id == task_id).first()
-    if not task:
-        return False, None
-
-    project_member = session.query(ProjectMember).filter(
-        ProjectMember.project_id == task.project_id,
-        ProjectMember.member_id == user_id
-    ).first()
-
-    return project_member is not None, task
+    task = session.query(Task).filter(Task.task_id == task_id, is_project_member(Task.project_id, user_id)).first()
+    return task is not None, task
 
 
 def user_has_access_to_resource(user_id: int, resource_id: int, resource_type: Type, session: DBSession) -> Tuple[bool, Optional[Any]]:
     """
-    Check if the user has access to the resource.
+    Check if the user has access to the resource, loading the resource and checking the membership in one query.
 
     :param user_id: The ID of the user.
     :param resource_id: The ID of the resource.
     :param resource_type: The type of the resource class.
     :param session: The current database session.
-    :return: A tuple containing a boolean indicating if the user has access and the resource if found.
+    :return: A tuple containing a boolean indicating if the user has access and the resource if accessible.
     """
-    resource = session.query(resource_type).filter_by(**{f"{resource_type.__name__.lower()}_id": resource_id}).first()
-    if not resource:
-        return False, None
-
-    project_member = session.query(ProjectMember).filter(
-        ProjectMember.project_id == resource.project_id,
-        ProjectMember.member_id == user_id
-    ).first()
-
-    return project_member is not None, resource
+    resource = session.query(resource_type).filter_by(**{f"{resource_type.__name__.lower()}_id": resource_id}).filter(
+        is_project_member(resource_type.project_id, user_id)).first()
+    return resource is not None, resource
 
 
 def check_project_owner(user_id: int, resource_id: int, resource_type: Type, session: DBSession) -> Tuple[bool, Optional[Any]]:
@@ -96,9 +196,85 @@ def check_project_owner(user_id: int, resource_id: int, resource_type: Type, ses
     return project.created_by == user_id, project
 
 
+def authorized_update(session: DBSession, resource_type: Type, resource_id: int, condition: ColumnElement,
+                      **values: Any) -> bool:
+    """
+    Update a resource with a single UPDATE that only applies if the user is authorized, instead of
+    loading the resource and checking the access first. Revisioned resources get a new revision.
+
+    :param session: The current database session.
+    :param resource_type: The type of the resource class.
+    :param resource_id: The ID of the resource.
+    :param condition: The authorization condition, e.g. is_project_member or an ownership check.
+    :param values: The new column values.
+    :return: True if the resource was updated, False if it does not exist or the user has no access.
+    """
+    primary_key = getattr(resource_type, f"{resource_type.__name__.lower()}_id")
+    if 'revision' in resource_type.__table__.c:
+        values['revision'] = next_revision(session)
+    result = session.execute(
+        update(resource_type).where(primary_key == resource_id, condition).values(**values),
+        execution_options={'synchronize_session': False}
+    )
+    return result.rowcount > 0
+
+
+def authorized_delete(session: DBSession, resource_type: Type, resource_id: int, condition: ColumnElement,
+                      revision: Optional[int] = None) -> Optional[int]:
+    """
+    Delete a revisioned resource with a single DELETE that only applies if the user is authorized,
+    instead of loading the resource and checking the access first. Its tombstone is written before,
+    by an INSERT ... SELECT on the same condition, and tells the project of the deleted resource.
+
+    :param session: The current database session.
+    :param resource_type: The type of the resource class.
+    :param resource_id: The ID of the resource.
+    :param condition: The authorization condition, e.g. is_project_member.
+    :param revision: The revision of the tombstone; a new one is drawn when omitted.
+    :return: The ID of the resource's project, or None if it does not exist or the user has no access.
+    """
+    primary_key = getattr(resource_type, f"{resource_type.__name__.lower()}_id")
+    table = resource_type.__tablename__
+    revision = record_tombstones(session, table, select(primary_key, resource_type.project_id).where(
+        primary_key == resource_id, condition), revision)
+    result = session.execute(
+        delete(resource_type).where(primary_key == resource_id, condition),
+        execution_options={'synchronize_session': False}
+    )
+    if result.rowcount == 0:
+        return None
+    return session.query(Tombstone.project_id).filter(
+        Tombstone.table_name == table, Tombstone.row_id == resource_id, Tombstone.revision == revision).scalar()
+
+
+def check_on_shards(resource_checker: Callable[[int, int, Type, DBSession], Tuple[bool, Optional[Any]]],
+                    resource_type: Type, resource_id: Any,
+                    open_session: Callable[[shards.Shard], DBSession]) -> Tuple[bool, Optional[Any], shards.Shard]:
+    """
+    Run an access check on the shards that may hold a resource, most likely first, until one finds it.
+
+    :param resource_checker: Function to check the user's access to the resource.
+    :param resource_type: The type of the resource class.
+    :param resource_id: The ID of the resource.
+    :param open_session: Returns the session to use for a shard.
+    :return: The result of the check and the shard holding the resource, or the last shard tried.
+    """
+    table = resource_type.__tablename__
+    for shard in shards.candidate_shards(table, resource_id):
+        has_access, resource = resource_checker(g.user.user_id, resource_id, resource_type, open_session(shard))
+        if resource is not None:
+            shards.remember_location(table, resource_id, shard)
+            return has_access, resource, shard
+    return False, None, shard
+
+
 def require_resource_access(resource_checker: Callable[[int, int, Type, DBSession], Tuple[bool, Optional[Any]]], resource_type: Type, resource_id_param: str):
     """
     Decorator that ensures the user has access to a specific resource.
+    The resource is looked up on the shards that may hold it and the view runs in a session of the
+    shard holding it, available as g.shard, using the read engines like require_user. Writes to
+    projects being moved to another shard are refused.
+    Within a batch request, the check runs in the batch sessions and its result is reused.
 
     :param resource_checker: Function to check the user's access to the resource.
     :param resource_type: The type of the resource class.
@@ -110,25 +286,49 @@ def require_resource_access(resource_checker: Callable[[int, int, Type, DBSessio
         @wraps(f)
         def decorated_function(*args, **kwargs):
             try:
-                if request.method == 'POST':
+                resource_id = kwargs.get(resource_id_param)
+                if resource_id is None and request.method == 'POST':
                     resource_id = request.json.get(resource_id_param)
-                else:
-                    resource_id = kwargs.get(resource_id_param)
 
                 if not resource_id:
                     return jsonify({'error': f'{resource_type.__name__} ID not provided'}), 400
 
-                with Session() as session_db:
-                    has_access, resource = resource_checker(g.user.user_id, resource_id, resource_type, session_db)
+                def call_with_access(has_access, resource, shard, session_db):
                     if not has_access:
                         return jsonify({'error': f'User does not have access to this {resource_type.__name__.lower()} operation'}), 403
+                    if request.method != 'GET' and shards.is_frozen(resource.project_id):
+                        return jsonify({'error': 'Project is being moved, try again later'}), 503
 
                     g.resource = resource
                     g.session = session_db
+                    g.shard = shard
                     return f(*args, **kwargs)
+
+                batch = g.get('batch')
+                if batch is not None:
+                    key = (resource_checker.__name__, resource_type.__name__, resource_id)
+                    if key not in batch.access:
+                        batch.access[key] = check_on_shards(resource_checker, resource_type, resource_id,
+                                                            batch.shard_session)
+                    has_access, resource, shard = batch.access[key]
+                    return call_with_access(has_access, resource, shard, batch.shard_session(shard))
+
+                with ExitStack() as stack:
+                    sessions = {}
+                    read = use_read_engines()
+
+                    def open_session(shard):
+                        if shard.name not in sessions:
+                            sessions[shard.name] = stack.enter_context(shard.session_factory(read)())
+                        return sessions[shard.name]
+
+                    has_access, resource, shard = check_on_shards(resource_checker, resource_type, resource_id,
+                                                                  open_session)
+                    return call_with_access(has_access, resource, shard, open_session(shard))
             finally:
                 g.pop('resource', None)
                 g.pop('session', None)
+                g.pop('shard', None)
 
         return decorated_function
     return decorator
@@ -0,0 +1,427 @@
+"""
+Write-behind buffering of task status, sprint and assignee changes.
+
+Clients moving cards on a board opt in with 'PUT /task/<task_id>?write_behind=true'. The change is
+acknowledged once it is stored in Redis and written to the database later by the flusher that
+worker.py runs next to the job workers. Redis must persist with 'appendonly yes' for acknowledged
+changes to survive a restart.
+
+Keys:
+    writebehind:task:<task_id>          hash with the buffered fields of a task ('field:<name>', JSON),
+                                        its project, the last user changing it and the version
+    writebehind:project:<project_id>    set of the IDs of a project's tasks with buffered changes
+    writebehind:dirty                   sorted set of task IDs with buffered changes, scored by the
+                                        time of their first buffered change in milliseconds
+    writebehind:version                 counter drawing the version of every buffered change
+    writebehind:flusher                 lock held by the flusher writing to the database
+    writebehind:dead:<task_id>          buffered changes of a task the flusher gave up on, as the task hash
+    writebehind:dead                    set of the IDs of tasks with changes in a dead letter
+
+Changes to the same task are coalesced field by field, the last one winning, and every change
+draws a new version. Every FLUSH_INTERVAL_MS the flusher writes up to FLUSH_BATCH_SIZE tasks per
+shard with one multi-row UPDATE, along with their counters, status history and search index, and
+removes a buffered task only if its version has not changed meanwhile. Changes to projects being
+moved to another shard stay buffered until the move is done. Flushing compares the buffered fields
+with the rows, so a flush repeated after a crash changes nothing. If a batch fails, its tasks are
+written one by one; a task failing MAX_FLUSH_ATTEMPTS times is moved to a dead letter, so it never
+holds up the others.
+
+Task routes overlay buffered changes on the rows they return, so clients see their writes before
+they are flushed. A synchronous update of a task applies its buffered changes and discards them. It
+claims them before committing, giving them a new version, so the flusher does not write them over
+the update: the flusher checks the versions after reading the rows and only updates rows whose
+revision is still the one it read, retrying the others on the next flush.
+"""
+import json
+import logging
+import os
+import time
+import uuid
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+import redis
+from sqlalchemy import case, exc, select, update
+from sqlalchemy.orm import Session as DBSession
+
+from . import searchindex, shards, statushistory, taskcounters, taskranks
+from .events import publish_event
+from .redisclient import redis_client
+from .resultcache import tag_rows
+from database.map_db import Task
+from database.revisions import next_revision
+
+FIELDS = ('status', 'sprint_id', 'assigned_to')
+FLUSH_INTERVAL_MS = int(os.getenv('WRITE_BEHIND_FLUSH_MS', 200))
+FLUSH_BATCH_SIZE = 500
+TASK_PREFIX = 'writebehind:task:'
+PROJECT_PREFIX = 'writebehind:project:'
+DIRTY_KEY = 'writebehind:dirty'
+VERSION_KEY = 'writebehind:version'
+LOCK_KEY = 'writebehind:flusher'
+LOCK_TTL_MILLISECONDS = 10000
+FIELD_PREFIX = 'field:'
+DEAD_LETTER_PREFIX = 'writebehind:dead:'
+DEAD_LETTER_KEY = 'writebehind:dead'
+MAX_FLUSH_ATTEMPTS = 5
+
+logger = logging.getLogger(__name__)
+
+# Merges a change into the buffer of a task and returns its version.
+_buffer = redis_client.register_script("""
+local version = redis.call('INCR', KEYS[4])
+redis.call('HSET', KEYS[1], 'version', version, 'project_id', ARGV[2], 'changed_by', ARGV[3])
+for i = 5, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('ZADD', KEYS[2], 'NX', ARGV[4], ARGV[1])
+redis.call('SADD', KEYS[3], ARGV[1])
+return version
+""")
+
+# Removes the buffer of a task if it still holds the given version.
+_complete = redis_client.register_script("""
+if redis.call('HGET', KEYS[1], 'version') ~= ARGV[2] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('SREM', KEYS[3], ARGV[1])
+return 1
+""")
+
+# Gives the buffer of a task a new version if it still holds the given one, and returns it.
+_claim = redis_client.register_script("""
+if redis.call('HGET', KEYS[1], 'version') ~= ARGV[1] then
+    return false
+end
+local version = redis.call('INCR', KEYS[2])
+redis.call('HSET', KEYS[1], 'version', version)
+return version
+""")
+
+# Counts a failed write of the buffer of a task if it still holds the given version, requeueing it
+# behind the other buffered tasks, or moving it to a dead letter after ARGV[3] attempts.
+_fail = redis_client.register_script("""
+if redis.call('HGET', KEYS[1], 'version') ~= ARGV[2] then
+    return 0
+end
+if redis.call('HINCRBY', KEYS[1], 'attempts', 1) < tonumber(ARGV[3]) then
+    redis.call('ZADD', KEYS[2], 'XX', ARGV[4], ARGV[1])
+    return 1
+end
+redis.call('RENAME', KEYS[1], KEYS[4])
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('SREM', KEYS[3], ARGV[1])
+redis.call('SADD', KEYS[5], ARGV[1])
+return 2
+""")
+
+# Takes or extends the flusher lock.
+_hold_lock = redis_client.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) and 1 or 0
+""")
+
+
+class WriteConflict(Exception):
+    """Raised when tasks changed between the flusher reading and updating them."""
+
+
+class PendingUpdate(NamedTuple):
+    """The buffered changes of a task, with the version of the last one."""
+    task_id: int
+    project_id: int
+    version: str
+    changed_by: Optional[int]
+    changes: Dict[str, Any]
+
+
+def _task_key(task_id: int) -> str:
+    return f'{TASK_PREFIX}{task_id}'
+
+
+def _project_key(project_id: int) -> str:
+    return f'{PROJECT_PREFIX}{project_id}'
+
+
+def _parse(task_id: int, data: Dict[str, str]) -> Optional[PendingUpdate]:
+    if not data:
+        return None
+    return PendingUpdate(
+        task_id=task_id,
+        project_id=int(data['project_id']),
+        version=data['version'],
+        changed_by=int(data['changed_by']) if data.get('changed_by') else None,
+        changes={name[len(FIELD_PREFIX):]: json.loads(value)
+                 for name, value in data.items() if name.startswith(FIELD_PREFIX)}
+    )
+
+
+def buffer_update(task: Task, changes: Dict[str, Any], changed_by: int) -> int:
+    """
+    Store changes of a task in Redis, to be written to the database by the flusher.
+
+    :param task: The task.
+    :param changes: New values of fields in FIELDS.
+    :param changed_by: The ID of the user making the change.
+    :return: The version of the change.
+    """
+    args = [task.task_id, task.project_id, changed_by, int(time.time() * 1000)]
+    for field, value in changes.items():
+        args += [f'{FIELD_PREFIX}{field}', json.dumps(value)]
+    return _buffer(keys=[_task_key(task.task_id), DIRTY_KEY, _project_key(task.project_id), VERSION_KEY], args=args)
+
+
+def pending_update(task_id: int) -> Optional[PendingUpdate]:
+    """
+    Get the buffered changes of a task.
+
+    :param task_id: The ID of the task.
+    :return: The buffered changes, or None if there are none.
+    """
+    return _parse(task_id, redis_client.hgetall(_task_key(task_id)))
+
+
+def pending_changes(project_id: int) -> Dict[int, Dict[str, Any]]:
+    """
+    Get the buffered changes of the tasks of a project, to overlay them on rows read from the database.
+
+    :param project_id: The ID of the project.
+    :return: Mapping of task IDs to their buffered field values.
+    """
+    return pending_task_changes([int(task_id) for task_id in redis_client.smembers(_project_key(project_id))])
+
+
+def pending_task_changes(task_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+    """
+    Get the buffered changes of tasks of any projects with one round trip.
+
+    :param task_ids: The IDs of the tasks.
+    :return: Mapping of the IDs of tasks with buffered changes to their buffered field values.
+    """
+    if not task_ids:
+        return {}
+    pipe = redis_client.pipeline(transaction=False)
+    for task_id in task_ids:
+        pipe.hgetall(_task_key(task_id))
+    updates = [_parse(task_id, data) for task_id, data in zip(task_ids, pipe.execute())]
+    return {pending.task_id: pending.changes for pending in updates if pending is not None}
+
+
+def complete(pending: PendingUpdate, client: Any = None) -> bool:
+    """
+    Remove buffered changes once they are written, unless the task was changed again meanwhile.
+
+    :param pending: The buffered changes that were written.
+    :param client: A pipeline to queue the removal on instead of running it.
+    :return: True if they were removed.
+    """
+    return bool(_complete(keys=[_task_key(pending.task_id), DIRTY_KEY, _project_key(pending.project_id)],
+                          args=[pending.task_id, pending.version], client=redis_client if client is None else client))
+
+
+def claim(pending: PendingUpdate) -> Optional[PendingUpdate]:
+    """
+    Claim buffered changes applied by a synchronous update before committing it, so the flusher
+    does not write them over the update. Complete them with the returned version after committing.
+
+    :param pending: The buffered changes read by the update.
+    :return: The buffered changes with their new version, or None if the task was changed again meanwhile.
+    """
+    version = _claim(keys=[_task_key(pending.task_id), VERSION_KEY], args=[pending.version])
+    return pending._replace(version=str(version)) if version is not None else None
+
+
+def fail(pending: PendingUpdate, client: Any = None) -> None:
+    """
+    Count a failed write of buffered changes, moving them to a dead letter after MAX_FLUSH_ATTEMPTS.
+
+    :param pending: The buffered changes that could not be written.
+    :param client: A pipeline to queue the update on instead of running it.
+    """
+    _fail(keys=[_task_key(pending.task_id), DIRTY_KEY, _project_key(pending.project_id),
+                f'{DEAD_LETTER_PREFIX}{pending.task_id}', DEAD_LETTER_KEY],
+          args=[pending.task_id, pending.version, MAX_FLUSH_ATTEMPTS, int(time.time() * 1000)],
+          client=redis_client if client is None else client)
+
+
+def write_updates(session: DBSession, updates: List[PendingUpdate]) -> List[Dict[str, Any]]:
+    """
+    Write buffered changes to the tasks of one shard with a single multi-row UPDATE, adjusting
+    their counters and status history and appending tasks changing column to its end. Tasks that
+    no longer exist, or whose changes were claimed by a synchronous update, are skipped. The caller commits.
+
+    :param session: A session of the shard holding the tasks.
+    :param updates: The buffered changes.
+    :return: The changed tasks, as dicts with 'task_id', 'project_id', the new FIELDS and 'old_status',
+             and the new 'rank' of tasks changing column.
+    :raises WriteConflict: If a task was updated after its row was read; the caller rolls back.
+    """
+    by_task = {pending.task_id: pending for pending in updates}
+    rows = session.execute(
+        select(Task.task_id, Task.project_id, Task.revision, *(getattr(Task, field) for field in FIELDS))
+        .where(Task.task_id.in_(list(by_task)))
+    ).all()
+    # Updates claim the buffer before committing, so a row read after their commit is skipped here.
+    pipe = redis_client.pipeline(transaction=False)
+    for row in rows:
+        pipe.hget(_task_key(row.task_id), 'version')
+    rows = [row for row, version in zip(rows, pipe.execute()) if version == by_task[row.task_id].version]
+
+    changed, counter_changes, transitions = [], [], []
+    read_revisions = {}
+    moved: Dict[int, List[Dict[str, Any]]] = defaultdict(list)
+    for row in rows:
+        pending = by_task[row.task_id]
+        old = {field: getattr(row, field) for field in FIELDS}
+        new = {**old, **pending.changes}
+        if new == old:
+            continue
+        changed.append({'task_id': row.task_id, 'project_id': row.project_id, **new, 'old_status': old['status']})
+        read_revisions[row.task_id] = row.revision
+        counter_changes.append(({'project_id': row.project_id, 'label_ids': [], **old},
+                                {'project_id': row.project_id, 'label_ids': [], **new}))
+        if (new['status'], new['sprint_id']) != (old['status'], old['sprint_id']):
+            moved[row.project_id].append(changed[-1])
+            transitions.append({'task_id': row.task_id, 'project_id': row.project_id, 'sprint_id': new['sprint_id'],
+                                'from_status': old['status'], 'to_status': new['status'],
+                                'changed_by': pending.changed_by})
+    if not changed:
+        return []
+
+    values = {}
+    for field in FIELDS:
+        whens = {task['task_id']: task[field] for task in changed if field in by_task[task['task_id']].changes}
+        if whens:
+            values[field] = case(whens, value=Task.task_id, else_=getattr(Task, field))
+    # Tasks changing column go to its end, like synchronous updates.
+    ranks = {}
+    for project_id, tasks in moved.items():
+        columns = [(task['sprint_id'], task['status']) for task in tasks]
+        for task, rank in zip(tasks, taskranks.append_ranks(session, project_id, columns)):
+            task['rank'] = ranks[task['task_id']] = rank
+    if ranks:
+        values['rank'] = case(ranks, value=Task.task_id, else_=Task.rank)
+    values['revision'] = next_revision(session)
+    # Run outside the ORM so only the changed projects' cached results are invalidated. Rows updated
+    # since they were read are left alone.
+    result = session.connection().execute(
+        update(Task).where(Task.task_id.in_(list(read_revisions)),
+                           Task.revision.is_not_distinct_from(case(read_revisions, value=Task.task_id)))
+        .values(**values))
+    if result.rowcount != len(changed):
+        raise WriteConflict()
+    tag_rows(session, Task.__tablename__, {task['project_id'] for task in changed})
+
+    taskcounters.count_changes(session, counter_changes)
+    statushistory.record_transitions(session, transitions)
+    return changed
+
+
+def _write_shard(shard: shards.Shard, updates: List[PendingUpdate]) -> List[Dict[str, Any]]:
+    with shard.session() as session_db:
+        changed = write_updates(session_db, updates)
+        session_db.commit()
+    return changed
+
+
+def flush(limit: int = FLUSH_BATCH_SIZE) -> int:
+    """
+    Write the oldest buffered changes to the database.
+
+    :param limit: Maximum number of tasks to write.
+    :return: The number of tasks taken from the buffer, not counting tasks of projects being moved,
+             which stay buffered; less than limit once it is drained. Tasks whose write failed are
+             requeued behind the others and counted as well.
+    """
+    task_ids = [int(task_id) for task_id in redis_client.zrange(DIRTY_KEY, 0, limit - 1)]
+    if not task_ids:
+        return 0
+    pipe = redis_client.pipeline(transaction=False)
+    for task_id in task_ids:
+        pipe.hgetall(_task_key(task_id))
+    updates = [_parse(task_id, data) for task_id, data in zip(task_ids, pipe.execute())]
+
+    # Buffers discarded by synchronous updates leave their ID behind.
+    discarded = [task_id for task_id, pending in zip(task_ids, updates) if pending is None]
+    if discarded:
+        redis_client.zrem(DIRTY_KEY, *discarded)
+
+    by_project: Dict[int, List[PendingUpdate]] = defaultdict(list)
+    frozen = {}
+    for pending in updates:
+        if pending is None:
+            continue
+        if shards.is_frozen(pending.project_id):
+            frozen[pending.task_id] = int(time.time() * 1000)
+        else:
+            by_project[pending.project_id].append(pending)
+    if frozen:
+        # Requeue behind the other buffered tasks until the move is done.
+        redis_client.zadd(DIRTY_KEY, frozen, xx=True)
+
+    handled, failed = [], []
+    for shard, project_ids in shards.partition_projects(list(by_project)):
+        shard_updates = [pending for project_id in project_ids for pending in by_project.pop(project_id)]
+        try:
+            changed = _write_shard(shard, shard_updates)
+            handled += shard_updates
+        except (WriteConflict, exc.SQLAlchemyError) as error:
+            if not isinstance(error, WriteConflict):
+                logger.exception('Could not write buffered changes of %s tasks, writing them one by one',
+                                 len(shard_updates))
+            changed = []
+            for pending in shard_updates:
+                try:
+                    changed += _write_shard(shard, [pending])
+                    handled.append(pending)
+                except WriteConflict:
+                    # Stays buffered and is compared with the updated row on the next flush.
+                    continue
+                except exc.SQLAlchemyError as error:
+                    if isinstance(error, exc.DBAPIError) and error.connection_invalidated:
+                        raise
+                    logger.exception('Could not write buffered changes of task %s', pending.task_id)
+                    failed.append(pending)
+
+        taskranks.request_rebalances((task['project_id'], task['sprint_id'], task['status'], task['rank'])
+                                     for task in changed if 'rank' in task)
+        searchindex.update_statuses((task['project_id'], task['task_id'], task['old_status'], task['status'])
+                                    for task in changed)
+        for task in changed:
+            publish_event(task['project_id'], 'task.updated', task_id=task['task_id'], status=task['status'],
+                          sprint_id=task['sprint_id'], assigned_to=task['assigned_to'])
+
+    # Changes to projects no shard holds any more are dropped.
+    handled += [pending for project_updates in by_project.values() for pending in project_updates]
+    pipe = redis_client.pipeline(transaction=False)
+    for pending in handled:
+        complete(pending, pipe)
+    for pending in failed:
+        fail(pending, pipe)
+    pipe.execute()
+    return len(discarded) + len(handled) + len(failed)
+
+
+def run_flusher(should_stop: Callable[[], bool]) -> None:
+    """
+    Flush buffered changes every FLUSH_INTERVAL_MS until should_stop returns True. Only the flusher
+    holding the lock in Redis writes, so every host can run one.
+
+    :param should_stop: Called between flushes; the flusher returns once it is True.
+    """
+    token = uuid.uuid4().hex
+    while not should_stop():
+        started = time.monotonic()
+        try:
+            if _hold_lock(keys=[LOCK_KEY], args=[token, LOCK_TTL_MILLISECONDS]):
+                while flush() >= FLUSH_BATCH_SIZE and not should_stop():
+                    _hold_lock(keys=[LOCK_KEY], args=[token, LOCK_TTL_MILLISECONDS])
+        except redis.RedisError:
+            logger.exception('Could not read buffered task changes')
+        except Exception:
+            logger.exception('Could not write buffered task changes')
+        time.sleep(max(FLUSH_INTERVAL_MS / 1000 - (time.monotonic() - started), 0))
@@ -0,0 +1,161 @@
+"""
+Benchmark of the per-request lookups against the access paths declared in database/map_db.py.
+
+The tables are created from the model in an in-memory SQLite database, filled at several sizes,
+and every hot lookup is timed and explained. With the declared indexes the lookup time must stay
+flat as the tables grow; the script exits with status 1 when it grows more than MAX_GROWTH times
+between the smallest and the largest size, or when a lookup falls back to a full table scan.
+
+Usage:
+    python -m benchmarks.access_paths [--sizes 1000 10000 100000] [--lookups 2000]
+"""
+import argparse
+import random
+import sys
+import time
+from typing import Dict, List, Tuple
+
+from sqlalchemy import create_engine, insert, text
+from sqlalchemy.engine import Connection
+
+import database.map_db as mdp
+
+TASKS_PER_PROJECT = 100
+ROWS_PER_PROJECT = 5
+MAX_GROWTH = 3.0
+
+# Lookups executed by the API routes, parametrized by a project ID and a row number.
+ACCESS_PATHS = [
+    ('project_members(project_id, member_id)',
+     'SELECT * FROM project_members WHERE project_id = :project_id AND member_id = :n'),
+    ('project_members(member_id)', 'SELECT project_id FROM project_members WHERE member_id = :n'),
+    ('tasks(project_id)', 'SELECT * FROM tasks WHERE project_id = :project_id'),
+    ('task_labels(task_id)', 'SELECT * FROM task_labels WHERE task_id = :n'),
+    ('task_labels(label_id)', 'SELECT * FROM task_labels WHERE label_id = :n'),
+    ('sprints(project_id)', 'SELECT * FROM sprints WHERE project_id = :project_id'),
+    ('labels(project_id)', 'SELECT * FROM labels WHERE project_id = :project_id'),
+]
+
+
+def populate(connection: Connection, num_tasks: int) -> Tuple[int, int]:
+    """
+    Insert num_tasks tasks plus proportional projects, members, sprints, labels and task labels.
+
+    Args:
+        connection: The database connection.
+        num_tasks (int): The number of tasks to create.
+
+    Returns:
+        Tuple[int, int]: The number of projects and users.
+    """
+    num_projects = max(num_tasks // TASKS_PER_PROJECT, 1)
+    num_users = num_projects * 2
+    connection.execute(insert(mdp.User), [
+        {'user_id': i, 'username': f'user_{i}', 'password_hash': '-', 'email': f'user_{i}@example.com',
+         'company': '-', 'phone': '-', 'sex': '-'}
+        for i in range(num_users)
+    ])
+    connection.execute(insert(mdp.Project), [
+        {'project_id': i, 'name': f'Project_{i}', 'created_by': i % num_users} for i in range(num_projects)
+    ])
+    connection.execute(insert(mdp.ProjectMember), [
+        {'task_label_id': i * ROWS_PER_PROJECT + j, 'project_id': i, 'member_id': (i + j) % num_users}
+        for i in range(num_projects) for j in range(ROWS_PER_PROJECT)
+    ])
+    connection.execute(insert(mdp.Sprint), [
+        {'sprint_id': i * ROWS_PER_PROJECT + j, 'project_id': i, 'name': f'Sprint_{j}'}
+        for i in range(num_projects) for j in range(ROWS_PER_PROJECT)
+    ])
+    connection.execute(insert(mdp.Label), [
+        {'label_id': i * ROWS_PER_PROJECT + j, 'project_id': i, 'name': f'Label_{j}'}
+        for i in range(num_projects) for j in range(ROWS_PER_PROJECT)
+    ])
+    connection.execute(insert(mdp.Task), [
+        {'task_id': i, 'project_id': i % num_projects, 'sprint_id': (i % num_projects) * ROWS_PER_PROJECT,
+         'title': f'Task_{i}', 'status': 'todo'}
+        for i in range(num_tasks)
+    ])
+    connection.execute(insert(mdp.TaskLabel), [
+        {'task_label_id': i, 'task_id': i, 'label_id': (i % num_projects) * ROWS_PER_PROJECT + i % ROWS_PER_PROJECT}
+        for i in range(num_tasks)
+    ])
+    return num_projects, num_users
+
+
+def full_scans(connection: Connection) -> List[str]:
+    """
+    Return the access paths whose query plan scans a whole table.
+
+    Args:
+        connection: The database connection.
+
+    Returns:
+        List[str]: The access path names with their query plans.
+    """
+    scans = []
+    for name, statement in ACCESS_PATHS:
+        rows = connection.execute(text(f'EXPLAIN QUERY PLAN {statement}'), {'project_id': 1, 'n': 1})
+        plan = ' '.join(row[-1] for row in rows)
+        if 'USING' not in plan:
+            scans.append(f'{name}: {plan}')
+    return scans
+
+
+def measure(num_tasks: int, num_lookups: int) -> Tuple[Dict[str, float], List[str]]:
+    """
+    Populate a fresh database and time every lookup.
+
+    Args:
+        num_tasks (int): The number of tasks to create.
+        num_lookups (int): The number of lookups timed per access path.
+
+    Returns:
+        Tuple[Dict[str, float], List[str]]: Mean microseconds per lookup and detected full scans.
+    """
+    engine = create_engine('sqlite://')
+    mdp.make_tables(engine)
+    with engine.begin() as connection:
+        num_projects, num_users = populate(connection, num_tasks)
+        timings = {}
+        for name, statement in ACCESS_PATHS:
+            statement = text(statement)
+            params = [{'project_id': random.randrange(num_projects), 'n': random.randrange(num_users)}
+                      for _ in range(num_lookups)]
+            start = time.perf_counter()
+            for param in params:
+                connection.execute(statement, param).all()
+            timings[name] = (time.perf_counter() - start) / num_lookups * 1e6
+        return timings, full_scans(connection)
+
+
+def main() -> None:
+    """
+    Main entry point of the benchmark.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark per-request lookups as tables grow.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='Numbers of tasks')
+    parser.add_argument('--lookups', type=int, default=2000, help='Lookups timed per access path and size')
+    args = parser.parse_args()
+
+    results = {}
+    failures = []
+    for size in args.sizes:
+        results[size], scans = measure(size, args.lookups)
+        failures += [f'{size} tasks, full scan of {scan}' for scan in scans]
+
+    names = list(results[args.sizes[0]])
+    print(f"{'access path':<42}" + ''.join(f'{size:>12}' for size in args.sizes) + '     growth')
+    for name in names:
+        timings = [results[size][name] for size in args.sizes]
+        growth = timings[-1] / timings[0]
+        print(f'{name:<42}' + ''.join(f'{timing:>10.1f}us' for timing in timings) + f'{growth:>10.2f}x')
+        if growth > MAX_GROWTH:
+            failures.append(f'{name} grew {growth:.2f}x')
+
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+Benchmark of the task query engine in apiroutes/taskquery.py on large projects.
+
+The tables are created from the model in an in-memory SQLite database with one large project
+among small ones. Representative queries are explained and timed on their first page and on a
+page halfway through the result, reached with a keyset cursor. The script exits with status 1
+when a query scans the whole tasks table, returns a task twice, or when the deep page takes more
+than MAX_DEEP_PAGE_RATIO times as long as the first page.
+
+Usage:
+    python -m benchmarks.task_queries [--sizes 10000 100000] [--repeat 20]
+"""
+import argparse
+import random
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List, Tuple
+
+from sqlalchemy import create_engine, insert, text
+from sqlalchemy.engine import Connection
+
+import database.map_db as mdp
+from apiroutes.taskquery import TaskQuery, build_statement, encode_cursor
+
+SMALL_PROJECTS = 50
+SMALL_PROJECT_TASKS = 100
+LABELS_PER_PROJECT = 10
+SPRINTS_PER_PROJECT = 10
+USERS = 200
+STATUSES = ['todo', 'in progress', 'done']
+MAX_DEEP_PAGE_RATIO = 5.0
+LARGE_PROJECT_ID = 0
+
+QUERIES = {
+    'all tasks': TaskQuery(),
+    'labels any': TaskQuery(labels_any=(1, 2)),
+    'labels all': TaskQuery(labels_all=(1, 2)),
+    'status and assignee': TaskQuery(statuses=('todo', 'in progress'), assignees=(1, 2, 3)),
+    'unsprinted by title': TaskQuery(unsprinted=True, sort='title'),
+    'text match': TaskQuery(text='task_1'),
+    'newest changes': TaskQuery(sort='revision', descending=True),
+}
+
+
+def populate(connection: Connection, num_tasks: int) -> None:
+    """
+    Insert one project with num_tasks tasks and SMALL_PROJECTS projects of SMALL_PROJECT_TASKS tasks,
+    with labels, sprints and up to three labels per task.
+
+    Args:
+        connection: The database connection.
+        num_tasks (int): The number of tasks of the large project.
+    """
+    project_ids = range(SMALL_PROJECTS + 1)
+    connection.execute(insert(mdp.Project), [
+        {'project_id': project_id, 'name': f'Project_{project_id}'} for project_id in project_ids
+    ])
+    connection.execute(insert(mdp.Label), [
+        {'label_id': project_id * LABELS_PER_PROJECT + i, 'project_id': project_id, 'name': f'Label_{i}'}
+        for project_id in project_ids for i in range(LABELS_PER_PROJECT)
+    ])
+    connection.execute(insert(mdp.Sprint), [
+        {'sprint_id': project_id * SPRINTS_PER_PROJECT + i, 'project_id': project_id, 'name': f'Sprint_{i}'}
+        for project_id in project_ids for i in range(SPRINTS_PER_PROJECT)
+    ])
+
+    tasks = []
+    task_labels = []
+    for project_id in project_ids:
+        for _ in range(num_tasks if project_id == LARGE_PROJECT_ID else SMALL_PROJECT_TASKS):
+            task_id = len(tasks)
+            tasks.append({
+                'task_id': task_id, 'project_id': project_id, 'title': f'Task_{task_id}',
+                'description': f'Description of task {task_id}', 'status': random.choice(STATUSES),
+                'assigned_to': random.choice([None, random.randrange(USERS)]), 'revision': task_id,
+                'sprint_id': random.choice([None, project_id * SPRINTS_PER_PROJECT + random.randrange(SPRINTS_PER_PROJECT)])
+            })
+            for label in random.sample(range(LABELS_PER_PROJECT), random.randrange(4)):
+                task_labels.append({'task_label_id': len(task_labels), 'task_id': task_id,
+                                    'label_id': project_id * LABELS_PER_PROJECT + label})
+    connection.execute(insert(mdp.Task), tasks)
+    connection.execute(insert(mdp.TaskLabel), task_labels)
+
+
+def timed(function: Callable[[], List], repeat: int) -> Tuple[float, List]:
+    """
+    Run a function repeatedly.
+
+    Args:
+        function (Callable[[], List]): The function to run.
+        repeat (int): The number of runs.
+
+    Returns:
+        Tuple[float, List]: The median milliseconds per run and the result of the last run.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000, result
+
+
+def measure(num_tasks: int, repeat: int) -> Tuple[Dict[str, Tuple[int, float, float]], List[str]]:
+    """
+    Populate a fresh database and time every query.
+
+    Args:
+        num_tasks (int): The number of tasks of the large project.
+        repeat (int): The number of timed runs per page.
+
+    Returns:
+        Tuple[Dict[str, Tuple[int, float, float]], List[str]]: Per query the number of matching
+            tasks and the milliseconds of the first and the deep page, and the detected failures.
+    """
+    engine = create_engine('sqlite://')
+    mdp.make_tables(engine)
+    results = {}
+    failures = []
+    with engine.begin() as connection:
+        populate(connection, num_tasks)
+        for name, query in QUERIES.items():
+            statement = build_statement(LARGE_PROJECT_ID, query)
+            compiled = str(statement.compile(engine, compile_kwargs={'literal_binds': True}))
+            plan = ' | '.join(row[-1] for row in connection.execute(text(f'EXPLAIN QUERY PLAN {compiled}')))
+            if 'SCAN tasks' in plan:
+                failures.append(f'{name} scans the tasks table: {plan}')
+
+            # Rows hold the task columns, task_id first, followed by the sort value.
+            rows = connection.execute(statement).all()
+            task_ids = [row[0] for row in rows]
+            if len(set(task_ids)) != len(task_ids):
+                failures.append(f'{name} returns duplicate tasks')
+
+            first_page, _ = timed(lambda: connection.execute(statement.limit(query.limit)).all(), repeat)
+            middle = rows[len(rows) // 2] if rows else None
+            deep_query = query._replace(cursor=encode_cursor(query, middle[-1], middle[0])) if middle else query
+            deep_statement = build_statement(LARGE_PROJECT_ID, deep_query).limit(query.limit)
+            deep_page, _ = timed(lambda: connection.execute(deep_statement).all(), repeat)
+            if deep_page > first_page * MAX_DEEP_PAGE_RATIO:
+                failures.append(f'{name}: the deep page took {deep_page / first_page:.1f}x the first page')
+            results[name] = (len(rows), first_page, deep_page)
+    return results, failures
+
+
+def main() -> None:
+    """
+    Main entry point of the benchmark.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark task queries on large projects.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000], help='Tasks of the large project')
+    parser.add_argument('--repeat', type=int, default=20, help='Timed runs per page')
+    args = parser.parse_args()
+
+    random.seed(0)
+    failures = []
+    for size in args.sizes:
+        results, size_failures = measure(size, args.repeat)
+        failures += [f'{size} tasks, {failure}' for failure in size_failures]
+        print(f"\n{size} tasks in the large project")
+        print(f"{'query':<24}{'matches':>10}{'first page':>14}{'deep page':>14}")
+        for name, (matches, first_page, deep_page) in results.items():
+            print(f'{name:<24}{matches:>10}{first_page:>12.2f}ms{deep_page:>12.2f}ms')
+
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
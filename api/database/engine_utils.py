@@ -1,5 +1,7 @@
 import configparser
+from typing import Any, Dict, Optional
 from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
 from snowflake.sqlalchemy import URL
 from functools import partial
 import os
@@ -28,14 +30,92 @@ for config_section, keys in required_keys.items():
             raise ValueError(f"Missing required configuration for '{key}' in section '{config_section}'. Please provide a value for '{key}'.")
 
 
-create_user_engine = partial(create_engine, URL(
-    user=usr_config['user'],
-    password=usr_config['password'],
-    account=usr_config['account'],
-    warehouse=db_config['warehouse'],
-    database=db_config['database'],
-    schema=db_config['schema']
-))
+MAIN_SHARD = 'main'
+SHARD_KEYS = ('user', 'password', 'account', 'warehouse', 'database', 'schema')
+
+_shards_config = _config['shards'] if _config.has_section('shards') else {}
+shard_names = [MAIN_SHARD] + [name.strip() for name in _shards_config.get('names', '').split(',') if name.strip()]
+new_project_shards = [name.strip() for name in _shards_config.get('new_projects', '').split(',') if name.strip()] \
+    or list(shard_names)
+
+for shard_name in shard_names[1:]:
+    if shard_name == MAIN_SHARD or not _config.has_section(f'shard.{shard_name}'):
+        raise ValueError(f"Missing section 'shard.{shard_name}' for the shard '{shard_name}' listed in section 'shards'.")
+for shard_name in new_project_shards:
+    if shard_name not in shard_names:
+        raise ValueError(f"Unknown shard '{shard_name}' in 'new_projects' of section 'shards'.")
+
+
+def shard_config(name: str) -> Dict[str, str]:
+    """
+    Get the connection settings of a shard. The main shard uses the [userdata] and [database]
+    sections; other shards override any of their keys in a [shard.<name>] section.
+
+    Args:
+        name (str): The name of the shard.
+
+    Returns:
+        Dict[str, str]: The user, password, account, warehouse, database and schema of the shard.
+    """
+    settings = {**usr_config, **db_config}
+    if name != MAIN_SHARD:
+        settings.update(_config[f'shard.{name}'])
+    return {key: settings[key] for key in SHARD_KEYS}
+
+
+def create_shard_engine(name: str, **kwargs: Any) -> Engine:
+    """
+    Create an engine connected to a shard.
+
+    Args:
+        name (str): The name of the shard.
+        **kwargs (Any): Further arguments of create_engine.
+
+    Returns:
+        Engine: The engine.
+    """
+    return create_engine(URL(**shard_config(name)), **kwargs)
+
+
+def read_config(name: str) -> Optional[Dict[str, str]]:
+    """
+    Get the connection settings of the engine serving the reads of a shard, configured in a [read]
+    section for the main shard and a [shard.<name>.read] section for other shards. Its keys override
+    those of the shard, e.g. a different warehouse or a replicated database; a 'url' key gives a
+    complete SQLAlchemy URL instead, e.g. of a local cache database.
+
+    Args:
+        name (str): The name of the shard.
+
+    Returns:
+        Optional[Dict[str, str]]: The settings, or None if the shard serves reads with its write engine.
+    """
+    section = 'read' if name == MAIN_SHARD else f'shard.{name}.read'
+    if not _config.has_section(section):
+        return None
+    return {**shard_config(name), **_config[section]}
+
+
+def create_read_engine(name: str, **kwargs: Any) -> Optional[Engine]:
+    """
+    Create the engine serving the reads of a shard.
+
+    Args:
+        name (str): The name of the shard.
+        **kwargs (Any): Further arguments of create_engine.
+
+    Returns:
+        Optional[Engine]: The engine, or None if the shard serves reads with its write engine.
+    """
+    settings = read_config(name)
+    if settings is None:
+        return None
+    if settings.get('url'):
+        return create_engine(settings['url'], **kwargs)
+    return create_engine(URL(**{key: settings[key] for key in SHARD_KEYS}), **kwargs)
+
+
+create_user_engine = partial(create_shard_engine, MAIN_SHARD)
 
 """
 This module handles the creation of a SQLAlchemy engine configured to connect to a Snowflake database
@@ -54,6 +134,25 @@ The setup.cfg file should contain the following sections and keys:
     database=<your_snowflake_database>
     schema=<your_snowflake_schema>
 
+Project data can be spread over further shards (see apiroutes/shards.py). The database above is the
+'main' shard; other shards are listed in an optional [shards] section, in a fixed order (new shards
+are only ever appended, as the position of a shard determines its ID range), and each has a
+[shard.<name>] section overriding any of the userdata and database keys:
+
+    [shards]
+    names=shard1, shard2
+    new_projects=shard1, shard2    (optional; shards receiving new projects, all by default)
+
+    [shard.shard1]
+    schema=<schema_of_the_shard>
+
+GET requests can be served by a separate read engine per shard, e.g. on another warehouse or a
+replica, configured in a [read] section for the main shard and [shard.<name>.read] sections for
+the others, overriding keys of the shard or giving a complete SQLAlchemy 'url':
+
+    [read]
+    warehouse=<warehouse_for_queries>
+
 Attributes:
     _config (ConfigParser): The ConfigParser object used to read the setup.cfg file.
     _current_file_path (str): The absolute path of the current file.
@@ -62,7 +161,13 @@ Attributes:
     usr_config (ConfigParser.SectionProxy): The userdata section from the configuration file.
     db_config (ConfigParser.SectionProxy): The database section from the configuration file.
     create_user_engine (function): A partial function that returns a SQLAlchemy engine configured for Snowflake.
+    shard_names (List[str]): The names of the shards, the main shard first.
+    new_project_shards (List[str]): The names of the shards receiving new projects.
 
 Functions:
     create_user_engine: A partial function that returns a SQLAlchemy engine configured for Snowflake.
+    shard_config: Returns the connection settings of a shard.
+    create_shard_engine: Returns a SQLAlchemy engine connected to a shard.
+    read_config: Returns the connection settings of the read engine of a shard, if configured.
+    create_read_engine: Returns a SQLAlchemy engine serving the reads of a shard, if configured.
 """
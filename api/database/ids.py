@@ -0,0 +1,56 @@
+from typing import List
+
+from sqlalchemy import Sequence, select, text
+from sqlalchemy.orm import Session as DBSession
+
+id_seq = Sequence('id_seq')
+
+# Every shard draws its IDs from its own 'id_seq', starting at its index times the span.
+SHARD_ID_SPAN = 2 ** 40
+
+
+def shard_id_start(shard_index: int) -> int:
+    """
+    Get the first ID drawn from the 'id_seq' of a shard.
+
+    Args:
+        shard_index (int): The position of the shard, 0 for the main shard.
+
+    Returns:
+        int: The start of the sequence.
+    """
+    return shard_index * SHARD_ID_SPAN + 1
+
+
+def shard_index_of(row_id: int) -> int:
+    """
+    Get the position of the shard a row was created on, derived from its ID.
+
+    Args:
+        row_id (int): The primary key of the row.
+
+    Returns:
+        int: The position of the shard.
+    """
+    return row_id // SHARD_ID_SPAN
+
+
+def allocate_ids(session: DBSession, count: int) -> List[int]:
+    """
+    Draw primary keys from 'id_seq' for rows inserted with multi-row statements.
+
+    On Snowflake all values are drawn with a single GENERATOR query; other backends draw them one by one.
+
+    Args:
+        session (DBSession): The current database session.
+        count (int): Number of IDs to draw.
+
+    Returns:
+        List[int]: The allocated IDs.
+    """
+    if count <= 0:
+        return []
+    if session.get_bind().dialect.name == 'snowflake':
+        query = text(f'SELECT id_seq.nextval FROM TABLE(GENERATOR(ROWCOUNT => {int(count)}))')
+        return [row[0] for row in session.execute(query)]
+    return [session.execute(select(id_seq.next_value())).scalar() for _ in range(count)]
@@ -1,10 +1,32 @@
 import bcrypt
-from sqlalchemy import Column, Integer, String, Text, ForeignKey, Date, TIMESTAMP, Sequence, Boolean
+from sqlalchemy import Column, Integer, String, Text, ForeignKey, Date, TIMESTAMP, Sequence, Boolean, Index, UniqueConstraint
 from sqlalchemy.orm import relationship, registry
 
 # SQLAlchemy mapper registry
 mapper_registry = registry()
 
+# Monotonic revision counter shared by all tables that support delta sync
+revision_seq = Sequence('revision_seq', metadata=mapper_registry.metadata)
+
+
+def _is_row_store(ddl, target, bind, dialect, **kwargs) -> bool:
+    """Secondary indexes are only created on row-store backends; Snowflake tables use clustering keys instead."""
+    return dialect.name != 'snowflake'
+
+
+def row_store_index(name: str, *columns: str) -> Index:
+    """
+    Declare a secondary index that is skipped on Snowflake.
+
+    Args:
+        name (str): The name of the index.
+        *columns (str): The indexed column names.
+
+    Returns:
+        Index: The conditional index.
+    """
+    return Index(name, *columns).ddl_if(callable_=_is_row_store)
+
 
 @mapper_registry.mapped
 class User:
@@ -62,6 +84,7 @@ class Project:
         name (str): Name of the project.
         description (str): Description of the project.
         created_by (int): ID of the user who created the project.
+        revision (int): Revision of the last change, used for delta sync.
         creator (User): Relationship to the User who created the project.
     """
     __tablename__ = 'projects'
@@ -69,6 +92,7 @@ class Project:
     name = Column(String(255), nullable=False)
     description = Column(Text)
     created_by = Column(Integer, ForeignKey('users.user_id'))
+    revision = Column(Integer)
     creator = relationship("User", backref="projects")
 
 
@@ -83,14 +107,20 @@ class Sprint:
         name (str): Name of the sprint.
         start_date (Date): Start date of the sprint.
         end_date (Date): End date of the sprint.
+        revision (int): Revision of the last change, used for delta sync.
         project (Project): Relationship to the Project the sprint belongs to.
     """
     __tablename__ = 'sprints'
+    __table_args__ = (
+        row_store_index('ix_sprints_project', 'project_id'),
+        {'snowflake_clusterby': ['project_id']},
+    )
     sprint_id = Column(Integer, Sequence('id_seq'), primary_key=True, autoincrement=True)
     project_id = Column(Integer, ForeignKey('projects.project_id'))
     name = Column(String(255))
     start_date = Column(Date)
     end_date = Column(Date)
+    revision = Column(Integer)
     project = relationship("Project", backref="sprints")
 
 
@@ -107,11 +137,25 @@ class Task:
         description (str): Description of the task.
         status (str): Status of the task.
         assigned_to (int): ID of the user assigned to the task.
+        parent_id (int): ID of the parent task (e.g. the epic of a subtask), None for top-level tasks.
+            Not a foreign key, so the tasks of a project can be copied in any order.
+        rank (str): Fractional key ordering the task within its board column (sprint and status).
+        revision (int): Revision of the last change, used for delta sync.
         sprint (Sprint): Relationship to the Sprint the task belongs to.
         assignee (User): Relationship to the User assigned to the task.
         project (Project): Relationship to the Project the task belongs to.
     """
     __tablename__ = 'tasks'
+    __table_args__ = (
+        row_store_index('ix_tasks_project_sprint', 'project_id', 'sprint_id'),
+        row_store_index('ix_tasks_project_revision', 'project_id', 'revision'),
+        row_store_index('ix_tasks_project_status', 'project_id', 'status'),
+        row_store_index('ix_tasks_project_assignee', 'project_id', 'assigned_to'),
+        row_store_index('ix_tasks_board_rank', 'project_id', 'sprint_id', 'status', 'rank'),
+        row_store_index('ix_tasks_parent', 'parent_id'),
+        row_store_index('ix_tasks_assignee_status', 'assigned_to', 'status'),
+        {'snowflake_clusterby': ['project_id', 'sprint_id']},
+    )
     task_id = Column(Integer, Sequence('id_seq'), primary_key=True, autoincrement=True)
     sprint_id = Column(Integer, ForeignKey('sprints.sprint_id'))
     project_id = Column(Integer, ForeignKey('projects.project_id'))
@@ -119,6 +163,9 @@ class Task:
     description = Column(Text)
     status = Column(String(50), default='todo')
     assigned_to = Column(Integer, ForeignKey('users.user_id'), nullable=True)
+    parent_id = Column(Integer)
+    rank = Column(String(255))
+    revision = Column(Integer)
     sprint = relationship("Sprint", backref="tasks")
     assignee = relationship("User", backref="tasks")
     project = relationship("Project", backref="tasks")
@@ -134,13 +181,26 @@ class Attachment:
         task_id (int): ID of the task the attachment belongs to.
         file_url (str): URL of the attachment file.
         uploaded_at (TIMESTAMP): Upload timestamp of the attachment.
+        file_name (str): Original name of the uploaded file.
+        content_type (str): MIME type of the file.
+        size (int): Size of the file in bytes.
+        content_hash (str): SHA-256 of the file, the key of its blob in the content-addressed store.
         task (Task): Relationship to the Task the attachment belongs to.
     """
     __tablename__ = 'attachments'
+    __table_args__ = (
+        row_store_index('ix_attachments_task', 'task_id'),
+        row_store_index('ix_attachments_content_hash', 'content_hash'),
+        {'snowflake_clusterby': ['task_id']},
+    )
     attachment_id = Column(Integer, Sequence('id_seq'), primary_key=True, autoincrement=True)
     task_id = Column(Integer, ForeignKey('tasks.task_id'))
     file_url = Column(String(255))
     uploaded_at = Column(TIMESTAMP)
+    file_name = Column(String(255))
+    content_type = Column(String(255))
+    size = Column(Integer)
+    content_hash = Column(String(64))
     task = relationship("Task", backref="attachments")
 
 
@@ -153,12 +213,18 @@ class Label:
         label_id (int): Unique identifier for the label.
         name (str): Name of the label.
         project_id (int): ID of the project the label belongs to.
+        revision (int): Revision of the last change, used for delta sync.
         project (Project): Relationship to the Project the label belongs to.
     """
     __tablename__ = 'labels'
+    __table_args__ = (
+        row_store_index('ix_labels_project', 'project_id'),
+        {'snowflake_clusterby': ['project_id']},
+    )
     label_id = Column(Integer, Sequence('id_seq'), primary_key=True, autoincrement=True)
     name = Column(String(255), nullable=False)
     project_id = Column(Integer, ForeignKey('projects.project_id'))
+    revision = Column(Integer)
     project = relationship("Project", backref="labels")
 
 
@@ -171,17 +237,105 @@ class TaskLabel:
         task_label_id (int): Unique identifier for the task label.
         task_id (int): ID of the task the label is associated with.
         label_id (int): ID of the label the task is associated with.
+        revision (int): Revision of the last change, used for delta sync.
         task (Task): Relationship to the Task.
         label (Label): Relationship to the Label.
     """
     __tablename__ = 'task_labels'
+    __table_args__ = (
+        UniqueConstraint('task_id', 'label_id', name='uq_task_labels_task_label'),
+        row_store_index('ix_task_labels_label', 'label_id'),
+        {'snowflake_clusterby': ['task_id']},
+    )
     task_label_id = Column(Integer, Sequence('id_seq'), primary_key=True, autoincrement=True)
     task_id = Column(Integer, ForeignKey('tasks.task_id'))
     label_id = Column(Integer, ForeignKey('labels.label_id'))
+    revision = Column(Integer)
     task = relationship("Task", backref="task_labels")
     label = relationship("Label", backref="task_labels")
 
 
+@mapper_registry.mapped
+class TaskDependency:
+    """
+    Represents the 'task_dependencies' table in the database: a task blocked by another task of
+    the same project.
+
+    Attributes:
+        dependency_id (int): Unique identifier for the dependency.
+        project_id (int): ID of the project both tasks belong to.
+        task_id (int): ID of the blocked task.
+        blocked_by_id (int): ID of the task that has to be finished first.
+        revision (int): Revision of the last change, used for delta sync.
+    """
+    __tablename__ = 'task_dependencies'
+    __table_args__ = (
+        UniqueConstraint('task_id', 'blocked_by_id', name='uq_task_dependencies_task_blocker'),
+        row_store_index('ix_task_dependencies_blocker', 'blocked_by_id'),
+        row_store_index('ix_task_dependencies_project', 'project_id'),
+        {'snowflake_clusterby': ['project_id']},
+    )
+    dependency_id = Column(Integer, Sequence('id_seq'), primary_key=True, autoincrement=True)
+    project_id = Column(Integer, ForeignKey('projects.project_id'))
+    task_id = Column(Integer, ForeignKey('tasks.task_id'), nullable=False)
+    blocked_by_id = Column(Integer, ForeignKey('tasks.task_id'), nullable=False)
+    revision = Column(Integer)
+
+
+@mapper_registry.mapped
+class TaskTreePath:
+    """
+    Represents the 'task_tree_paths' closure table of the task hierarchy: one row for every task
+    and each of its ancestors, derived from Task.parent_id.
+
+    Attributes:
+        path_id (int): Unique identifier for the path.
+        project_id (int): ID of the project of the tasks.
+        ancestor_id (int): ID of the ancestor.
+        descendant_id (int): ID of the descendant.
+        depth (int): Number of levels between them, 1 for a parent and its child.
+    """
+    __tablename__ = 'task_tree_paths'
+    __table_args__ = (
+        UniqueConstraint('ancestor_id', 'descendant_id', name='uq_task_tree_paths_ancestor_descendant'),
+        row_store_index('ix_task_tree_paths_descendant', 'descendant_id', 'depth'),
+        row_store_index('ix_task_tree_paths_project', 'project_id'),
+        {'snowflake_clusterby': ['project_id', 'ancestor_id']},
+    )
+    path_id = Column(Integer, Sequence('id_seq'), primary_key=True, autoincrement=True)
+    project_id = Column(Integer, ForeignKey('projects.project_id'))
+    ancestor_id = Column(Integer, ForeignKey('tasks.task_id'), nullable=False)
+    descendant_id = Column(Integer, ForeignKey('tasks.task_id'), nullable=False)
+    depth = Column(Integer, nullable=False)
+
+
+@mapper_registry.mapped
+class TaskDependencyPath:
+    """
+    Represents the 'task_dependency_paths' closure table of task dependencies: one row for every
+    task and each task blocking it directly or transitively, derived from 'task_dependencies'.
+
+    Attributes:
+        path_id (int): Unique identifier for the path.
+        project_id (int): ID of the project of the tasks.
+        task_id (int): ID of the blocked task.
+        blocker_id (int): ID of the blocking task.
+        path_count (int): Number of distinct dependency chains from the blocking to the blocked task.
+    """
+    __tablename__ = 'task_dependency_paths'
+    __table_args__ = (
+        UniqueConstraint('task_id', 'blocker_id', name='uq_task_dependency_paths_task_blocker'),
+        row_store_index('ix_task_dependency_paths_blocker', 'blocker_id'),
+        row_store_index('ix_task_dependency_paths_project', 'project_id'),
+        {'snowflake_clusterby': ['project_id', 'task_id']},
+    )
+    path_id = Column(Integer, Sequence('id_seq'), primary_key=True, autoincrement=True)
+    project_id = Column(Integer, ForeignKey('projects.project_id'))
+    task_id = Column(Integer, ForeignKey('tasks.task_id'), nullable=False)
+    blocker_id = Column(Integer, ForeignKey('tasks.task_id'), nullable=False)
+    path_count = Column(Integer, nullable=False)
+
+
 @mapper_registry.mapped
 class ProjectMember:
     """
@@ -191,13 +345,20 @@ class ProjectMember:
         task_label_id (int): Unique identifier for the project member.
         project_id (int): ID of the project the member is associated with.
         member_id (int): ID of the user who is a member of the project.
+        revision (int): Revision of the last change, used for delta sync.
         project (Project): Relationship to the Project.
         member (User): Relationship to the User.
     """
     __tablename__ = 'project_members'
+    __table_args__ = (
+        UniqueConstraint('project_id', 'member_id', name='uq_project_members_project_member'),
+        row_store_index('ix_project_members_member', 'member_id', 'project_id'),
+        {'snowflake_clusterby': ['project_id']},
+    )
     task_label_id = Column(Integer, Sequence('id_seq'), primary_key=True, autoincrement=True)
     project_id = Column(Integer, ForeignKey('projects.project_id'))
     member_id = Column(Integer, ForeignKey('users.user_id'))
+    revision = Column(Integer)
     project = relationship("Project", backref="project_members")
     member = relationship("User", backref="project_members")
 
@@ -224,6 +385,151 @@ class UserSettings:
     user = relationship("User", backref="settings")
 
 
+@mapper_registry.mapped
+class TaskCounter:
+    """
+    Represents the 'task_counters' table in the database.
+
+    Attributes:
+        counter_id (int): Unique identifier for the counter.
+        project_id (int): ID of the project the counter belongs to.
+        dimension (str): Counted dimension ('total', 'status', 'sprint', 'assignee' or 'label').
+        dimension_key (str): Value of the dimension, empty for 'total' and unset values.
+        task_count (int): Number of tasks with the given dimension value.
+        project (Project): Relationship to the Project.
+    """
+    __tablename__ = 'task_counters'
+    __table_args__ = (
+        row_store_index('ix_task_counters_project', 'project_id', 'dimension', 'dimension_key'),
+        {'snowflake_clusterby': ['project_id']},
+    )
+    counter_id = Column(Integer, Sequence('id_seq'), primary_key=True, autoincrement=True)
+    project_id = Column(Integer, ForeignKey('projects.project_id'))
+    dimension = Column(String(50), nullable=False)
+    dimension_key = Column(String(255), nullable=False, default='')
+    task_count = Column(Integer, nullable=False, default=0)
+    project = relationship("Project", backref="task_counters")
+
+
+@mapper_registry.mapped
+class TaskStatusChange:
+    """
+    Represents the append-only 'task_status_history' table in the database.
+
+    Rows are never updated and outlive the tasks they describe, so the IDs are not foreign keys.
+
+    Attributes:
+        history_id (int): Unique identifier for the transition.
+        task_id (int): ID of the task.
+        project_id (int): ID of the project the task belonged to.
+        sprint_id (int): ID of the sprint the task belonged to after the transition.
+        from_status (str): Status before the transition, None for a new task.
+        to_status (str): Status after the transition, None for a deleted task.
+        changed_by (int): ID of the user who made the change.
+        changed_at (TIMESTAMP): Time of the transition.
+    """
+    __tablename__ = 'task_status_history'
+    __table_args__ = (
+        row_store_index('ix_task_status_history_task', 'task_id', 'changed_at'),
+        row_store_index('ix_task_status_history_sprint', 'sprint_id'),
+        {'snowflake_clusterby': ['project_id', 'task_id']},
+    )
+    history_id = Column(Integer, Sequence('id_seq'), primary_key=True, autoincrement=True)
+    task_id = Column(Integer, nullable=False)
+    project_id = Column(Integer, nullable=False)
+    sprint_id = Column(Integer)
+    from_status = Column(String(50))
+    to_status = Column(String(50))
+    changed_by = Column(Integer)
+    changed_at = Column(TIMESTAMP, nullable=False)
+
+
+@mapper_registry.mapped
+class ArchivedTask:
+    """
+    Represents the 'archived_tasks' table in the database, holding done tasks of long-finished
+    sprints moved out of 'tasks' with their original IDs.
+
+    Rows outlive the sprints, users and parent tasks they refer to, so the IDs are not foreign keys.
+
+    Attributes:
+        task_id (int): ID the task had in 'tasks'.
+        sprint_id (int): ID of the sprint the task belonged to.
+        project_id (int): ID of the project the task belongs to.
+        title (str): Title of the task.
+        description (str): Description of the task.
+        status (str): Status of the task.
+        assigned_to (int): ID of the user assigned to the task.
+        parent_id (int): ID of the parent task.
+        rank (str): Rank of the task within its board column.
+        revision (int): Revision of the last change before archival.
+        archived_at (TIMESTAMP): Time of the archival.
+    """
+    __tablename__ = 'archived_tasks'
+    __table_args__ = (
+        row_store_index('ix_archived_tasks_project_sprint', 'project_id', 'sprint_id'),
+        {'snowflake_clusterby': ['project_id', 'sprint_id']},
+    )
+    task_id = Column(Integer, primary_key=True, autoincrement=False)
+    sprint_id = Column(Integer)
+    project_id = Column(Integer, nullable=False)
+    title = Column(String(255), nullable=False)
+    description = Column(Text)
+    status = Column(String(50))
+    assigned_to = Column(Integer)
+    parent_id = Column(Integer)
+    rank = Column(String(255))
+    revision = Column(Integer)
+    archived_at = Column(TIMESTAMP, nullable=False)
+
+
+@mapper_registry.mapped
+class ArchivedTaskLabel:
+    """
+    Represents the 'archived_task_labels' table in the database, holding the labels of archived
+    tasks moved out of 'task_labels' with their original IDs.
+
+    Attributes:
+        task_label_id (int): ID the task label had in 'task_labels'.
+        project_id (int): ID of the project of the task.
+        task_id (int): ID of the archived task.
+        label_id (int): ID of the label.
+    """
+    __tablename__ = 'archived_task_labels'
+    __table_args__ = (
+        row_store_index('ix_archived_task_labels_task', 'task_id'),
+        {'snowflake_clusterby': ['project_id', 'task_id']},
+    )
+    task_label_id = Column(Integer, primary_key=True, autoincrement=False)
+    project_id = Column(Integer, nullable=False)
+    task_id = Column(Integer, nullable=False)
+    label_id = Column(Integer, nullable=False)
+
+
+@mapper_registry.mapped
+class Tombstone:
+    """
+    Represents the 'tombstones' table in the database, recording deleted rows for delta sync.
+
+    Attributes:
+        tombstone_id (int): Unique identifier for the tombstone.
+        table_name (str): Name of the table the row was deleted from.
+        row_id (int): Primary key of the deleted row.
+        project_id (int): ID of the project the row belonged to.
+        revision (int): Revision of the deletion.
+    """
+    __tablename__ = 'tombstones'
+    __table_args__ = (
+        row_store_index('ix_tombstones_project_revision', 'project_id', 'revision'),
+        {'snowflake_clusterby': ['project_id', 'revision']},
+    )
+    tombstone_id = Column(Integer, Sequence('id_seq'), primary_key=True, autoincrement=True)
+    table_name = Column(String(50), nullable=False)
+    row_id = Column(Integer, nullable=False)
+    project_id = Column(Integer, nullable=False)
+    revision = Column(Integer, nullable=False)
+
+
 def make_tables(mock_connection):
     """
     Creates all tables in the database.
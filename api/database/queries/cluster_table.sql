@@ -0,0 +1 @@
+ALTER TABLE {table_name} CLUSTER BY ({columns})
\ No newline at end of file
@@ -0,0 +1 @@
+CREATE SEQUENCE IF NOT EXISTS {sequence_name} START = {start} INCREMENT = 1
\ No newline at end of file
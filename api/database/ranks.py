@@ -0,0 +1,113 @@
+"""
+Fractional rank keys ordering the tasks of a board column.
+
+Ranks are strings of base-36 digits (0-9, a-z) compared lexicographically, so a key can always be
+found between two others without changing them. Keys never end with '0', which keeps room below
+every key. Inserting repeatedly at the same place makes keys longer by about one digit every five
+inserts; columns are then ranked anew with evenly spaced keys. Appending to the end of a column
+increments the last key instead of bisecting towards the end, so appends keep the length of the
+last key until all its digits are 'z' and then double it.
+"""
+from typing import List, Optional
+
+RANK_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+RANK_BASE = len(RANK_DIGITS)
+
+
+def _between(before: str, after: Optional[str]) -> str:
+    if after is not None:
+        # Keep the common prefix, reading missing digits of 'before' as 0.
+        prefix = 0
+        while prefix < len(after) and (before[prefix] if prefix < len(before) else '0') == after[prefix]:
+            prefix += 1
+        if prefix:
+            return after[:prefix] + _between(before[prefix:], after[prefix:])
+
+    low = RANK_DIGITS.index(before[0]) if before else 0
+    high = RANK_DIGITS.index(after[0]) if after is not None else RANK_BASE
+    if high - low > 1:
+        return RANK_DIGITS[(low + high) // 2]
+    if after is not None and len(after) > 1:
+        return after[0]
+    return RANK_DIGITS[low] + _between(before[1:], None)
+
+
+def rank_between(before: Optional[str], after: Optional[str]) -> str:
+    """
+    Get a rank between two ranks.
+
+    Args:
+        before (Optional[str]): The rank to follow, None for the start of the column.
+        after (Optional[str]): The rank to precede, None for the end of the column.
+
+    Returns:
+        str: A rank greater than before and less than after.
+
+    Raises:
+        ValueError: If before is not less than after.
+    """
+    if before is not None and after is not None and before >= after:
+        raise ValueError(f'Rank {before!r} is not less than {after!r}')
+    return _between(before or '', after)
+
+
+def rank_after(before: Optional[str]) -> str:
+    """
+    Get a rank to append after a rank, by incrementing it as a number of its length.
+
+    Args:
+        before (Optional[str]): The last rank of the column, None for an empty column.
+
+    Returns:
+        str: A rank greater than before, as long as before unless before is all 'z'.
+    """
+    if not before:
+        return rank_between(None, None)
+    position = len(before) - 1
+    while position >= 0 and before[position] == RANK_DIGITS[-1]:
+        position -= 1
+    if position < 0:
+        return before + RANK_DIGITS[0] * (len(before) - 1) + RANK_DIGITS[1]
+    incremented = before[:position] + RANK_DIGITS[RANK_DIGITS.index(before[position]) + 1]
+    if position == len(before) - 1:
+        return incremented
+    # Digits carried over become zeros; the last one becomes 1 instead, keeping the length.
+    return incremented + RANK_DIGITS[0] * (len(before) - position - 2) + RANK_DIGITS[1]
+
+
+def ranks_after(before: Optional[str], count: int) -> List[str]:
+    """
+    Get ascending ranks to append after a rank, see rank_after.
+
+    Args:
+        before (Optional[str]): The last rank of the column, None for an empty column.
+        count (int): The number of ranks.
+
+    Returns:
+        List[str]: The ranks, in ascending order.
+    """
+    ranks = []
+    for _ in range(count):
+        before = rank_after(before)
+        ranks.append(before)
+    return ranks
+
+
+def ranks_between(before: Optional[str], after: Optional[str], count: int) -> List[str]:
+    """
+    Get ascending ranks between two ranks, spread by bisection so their length grows with the
+    logarithm of their number.
+
+    Args:
+        before (Optional[str]): The rank to follow, None for the start of the column.
+        after (Optional[str]): The rank to precede, None for the end of the column.
+        count (int): The number of ranks.
+
+    Returns:
+        List[str]: The ranks, in ascending order.
+    """
+    if count <= 0:
+        return []
+    middle = rank_between(before, after)
+    half = (count - 1) // 2
+    return ranks_between(before, middle, half) + [middle] + ranks_between(middle, after, count - 1 - half)
@@ -0,0 +1,103 @@
+"""
+Revision stamping for delta sync.
+
+Every flush that inserts, updates or deletes rows of a revisioned table draws one value from
+'revision_seq' and stamps it on the changed rows; deleted rows leave a Tombstone with the same
+revision. Bulk statements bypass the flush, so code issuing them records tombstones with
+record_tombstones and sets the revision column with next_revision.
+
+Revisions are drawn at flush time, not at commit time, so a transaction that commits late can
+make rows visible with a revision lower than one a client has already seen. Sessions may carry a
+callable in info[BEFORE_DRAW_INFO], called before every revision is drawn, and next_revision keeps
+the highest revision drawn in the current transaction in info[LAST_DRAWN_INFO], so that sync can
+tell which revisions may still be committed (see apiroutes/syncwatermark.py).
+"""
+from typing import Any, Optional
+
+from sqlalchemy import event, insert, literal, select
+from sqlalchemy.orm import Session as DBSession, sessionmaker
+from sqlalchemy.sql import Select
+
+from .map_db import Label, Project, ProjectMember, Sprint, Task, TaskDependency, TaskLabel, Tombstone, revision_seq
+
+REVISIONED_MODELS = (Project, Sprint, Task, Label, TaskLabel, ProjectMember, TaskDependency)
+BEFORE_DRAW_INFO = 'revision_before_draw'
+LAST_DRAWN_INFO = 'revision_last_drawn'
+
+
+def next_revision(session: DBSession) -> int:
+    """
+    Draw the next revision.
+
+    :param session: The current database session.
+    :return: The new revision.
+    """
+    before_draw = session.info.get(BEFORE_DRAW_INFO)
+    if before_draw is not None:
+        before_draw(session)
+    revision = session.execute(select(revision_seq.next_value())).scalar()
+    session.info[LAST_DRAWN_INFO] = max(session.info.get(LAST_DRAWN_INFO, revision), revision)
+    return revision
+
+
+def _project_id_of(obj: Any) -> Optional[int]:
+    if isinstance(obj, TaskLabel):
+        return obj.task.project_id if obj.task is not None else None
+    return obj.project_id
+
+
+def _primary_key_of(obj: Any) -> int:
+    return obj.__mapper__.primary_key_from_instance(obj)[0]
+
+
+def stamp_revisions(session: DBSession, flush_context: Any, instances: Any) -> None:
+    """
+    'before_flush' listener stamping changed rows and writing tombstones for deleted rows.
+    """
+    changed = [obj for obj in session.new if isinstance(obj, REVISIONED_MODELS)]
+    changed += [obj for obj in session.dirty
+                if isinstance(obj, REVISIONED_MODELS) and session.is_modified(obj, include_collections=False)]
+    deleted = [obj for obj in session.deleted if isinstance(obj, REVISIONED_MODELS)]
+    if not changed and not deleted:
+        return
+
+    with session.no_autoflush:
+        revision = next_revision(session)
+        for obj in changed:
+            obj.revision = revision
+        for obj in deleted:
+            project_id = _project_id_of(obj)
+            if project_id is not None:
+                session.add(Tombstone(table_name=obj.__tablename__, row_id=_primary_key_of(obj),
+                                      project_id=project_id, revision=revision))
+
+
+def record_tombstones(session: DBSession, table_name: str, rows: Select, revision: Optional[int] = None) -> int:
+    """
+    Write tombstones for rows about to be removed by a bulk DELETE, with one INSERT ... SELECT.
+
+    :param session: The current database session.
+    :param table_name: Name of the table the rows are deleted from.
+    :param rows: A SELECT returning (row_id, project_id) of the rows to be deleted.
+    :param revision: The revision to use; a new one is drawn when omitted.
+    :return: The revision of the tombstones.
+    """
+    if revision is None:
+        revision = next_revision(session)
+    deleted_rows = rows.subquery()
+    session.execute(
+        insert(Tombstone).from_select(
+            ['table_name', 'row_id', 'project_id', 'revision'],
+            select(literal(table_name), *deleted_rows.c, literal(revision))
+        )
+    )
+    return revision
+
+
+def register_revision_events(session_factory: sessionmaker) -> None:
+    """
+    Enable revision stamping for every session created by a factory.
+
+    :param session_factory: The sessionmaker to instrument.
+    """
+    event.listen(session_factory, 'before_flush', stamp_revisions)
@@ -2,4 +2,6 @@
 
 redis-server /etc/redis/redis.conf &
 
+python3 worker.py &
+
 python3 api.py
@@ -1,12 +1,28 @@
 import argparse
+import contextlib
+import os
+import sys
 from datetime import date, timedelta
 import random
-from typing import Dict, List, Union
-
-from sqlalchemy import text, create_engine
+from collections import defaultdict
+from typing import Dict, List, Optional, Union
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session as DBSession
+from apiroutes.archive import ARCHIVE_AFTER_DAYS
+from apiroutes.blobstore import remove_unreferenced
+from apiroutes.export import CSV, EXPORT_FORMATS, EXPORTED_TABLES, NDJSON, export_chunks
+from apiroutes.jobs import enqueue
+from apiroutes.rebalance import move_project, plan_rebalance
 from apiroutes.session import Session
-
-from database.engine_utils import create_user_engine, db_config
+from apiroutes.searchindex import rebuild_project_index
+from apiroutes.shards import SHARDS, SHARDS_BY_NAME, placement_shard, scatter
+from apiroutes.taskcounters import reconcile_project_counters
+from apiroutes.userindex import rebuild_user_index
+
+from database.engine_utils import create_shard_engine, shard_config
+from database.ids import shard_id_start
+from database.ranks import ranks_between
 import database.map_db as mdp
 
 
@@ -15,6 +31,13 @@ DROP = "drop"
 CREATE = "create"
 MOCK = "mock"
 RESET = "reset"
+REINDEX = "reindex"
+RECONCILE = "reconcile"
+INDEX = "index"
+GC = "gc"
+EXPORT = "export"
+REBALANCE = "rebalance"
+ARCHIVE = "archive"
 
 
 class QueryFileManager:
@@ -45,50 +68,105 @@ def execute_query(mock_connection, query: QueryFileManager) -> None:
     mock_connection.execute(text(formatted_query))
 
 
-QUERY_FILES = {
-    INIT: [
-        QueryFileManager('create_warehouse.sql', warehouse_name=db_config["warehouse"]),
-        QueryFileManager('create_database.sql', database_name=db_config["database"]),
-        QueryFileManager('create_schema.sql', schema_name=db_config["schema"]),
-    ],
-    DROP: [
-        QueryFileManager('drop_database.sql', database_name=db_config["database"]),
-        QueryFileManager('drop_warehouse.sql', warehouse_name=db_config["warehouse"]),
-    ]
-}
+def shard_query_files(operation: str, shard_name: str) -> List[QueryFileManager]:
+    """
+    Get the SQL query files of an operation for a shard. All of them are idempotent, so shards
+    sharing a warehouse or database can run them one after another.
+
+    Args:
+        operation (str): The operation, init or drop.
+        shard_name (str): The name of the shard.
+
+    Returns:
+        List[QueryFileManager]: The query files to execute on the shard.
+    """
+    config = shard_config(shard_name)
+    if operation == INIT:
+        return [
+            QueryFileManager('create_warehouse.sql', warehouse_name=config["warehouse"]),
+            QueryFileManager('create_database.sql', database_name=config["database"]),
+            QueryFileManager('create_schema.sql', schema_name=f'{config["database"]}.{config["schema"]}'),
+        ]
+    if operation == DROP:
+        return [
+            QueryFileManager('drop_database.sql', database_name=config["database"]),
+            QueryFileManager('drop_warehouse.sql', warehouse_name=config["warehouse"]),
+        ]
+    return []
 
 
-def mock_data(engine) -> None:
+def create_shard_tables(connection, shard_index: int) -> None:
     """
-    Generate and insert mock data into the database.
+    Create the tables of a shard. On Snowflake, 'id_seq' is created first, starting at the ID range
+    of the shard, so IDs stay unique across shards.
+
+    Args:
+        connection: The database connection of the shard.
+        shard_index (int): The position of the shard, 0 for the main shard.
     """
-    with Session() as session:
-        def random_date(start: date, end: date) -> date:
-            """
-            Generate a random date between start and end dates.
-
-            Args:
-                start (date): The start date.
-                end (date): The end date.
-
-            Returns:
-                date: A random date between start and end.
-            """
-            delta = end - start
-            random_days = random.randrange(delta.days)
-            return start + timedelta(days=random_days)
-
-        def commit_all(data: List[Union[mdp.User, mdp.Project, mdp.Sprint, mdp.Task, mdp.Attachment, mdp.Label, mdp.TaskLabel, mdp.ProjectMember, mdp.UserSettings]]) -> None:
-            """
-            Commit a list of data objects to the session.
-
-            Args:
-                data (List[Union[mdp.User, mdp.Project, mdp.Sprint, mdp.Task, mdp.Attachment, mdp.Label, mdp.TaskLabel, mdp.ProjectMember, mdp.UserSettings]]): A list of ORM objects to commit.
-            """
-            for item in data:
-                session.add(item)
-            session.commit()
+    if connection.dialect.name == 'snowflake':
+        execute_query(connection, QueryFileManager('create_sequence.sql', sequence_name='id_seq',
+                                                   start=shard_id_start(shard_index)))
+    mdp.make_tables(connection)
+
+
+def apply_access_paths(connection) -> None:
+    """
+    Apply the access paths declared in the model to existing tables: clustering keys on Snowflake,
+    secondary indexes on row-store backends. Unique constraints are created together with the tables.
+
+    Args:
+        connection: The database connection to execute the statements on.
+    """
+    for table in mdp.mapper_registry.metadata.sorted_tables:
+        if connection.dialect.name == 'snowflake':
+            cluster_by = table.dialect_kwargs.get('snowflake_clusterby')
+            if cluster_by:
+                execute_query(connection, QueryFileManager('cluster_table.sql', table_name=table.name,
+                                                           columns=', '.join(cluster_by)))
+        else:
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+
+def random_date(start: date, end: date) -> date:
+    """
+    Generate a random date between start and end dates.
+
+    Args:
+        start (date): The start date.
+        end (date): The end date.
+
+    Returns:
+        date: A random date between start and end.
+    """
+    delta = end - start
+    random_days = random.randrange(delta.days)
+    return start + timedelta(days=random_days)
+
 
+def commit_all(session: DBSession, data: List[Union[mdp.User, mdp.Project, mdp.Sprint, mdp.Task, mdp.Attachment, mdp.Label, mdp.TaskLabel, mdp.ProjectMember, mdp.UserSettings]]) -> None:
+    """
+    Commit a list of data objects to the session.
+
+    Args:
+        session (DBSession): The database session.
+        data (List[Union[mdp.User, mdp.Project, mdp.Sprint, mdp.Task, mdp.Attachment, mdp.Label, mdp.TaskLabel, mdp.ProjectMember, mdp.UserSettings]]): A list of ORM objects to commit.
+    """
+    for item in data:
+        session.add(item)
+    session.commit()
+
+
+def mock_data(num_projects: int = 10) -> None:
+    """
+    Generate and insert mock data into the database: users on the main shard, projects with their
+    sprints, tasks, labels and members on the shards receiving new projects.
+
+    Args:
+        num_projects (int): Number of projects to create.
+    """
+    with Session() as session:
         companies = [f"Company {i}" for i in range(1, 11)]
         phones = [f"555-1234{i}" for i in range(100)]
         sexes = ["male", "female", "other"]
@@ -103,7 +181,7 @@ def mock_data(engine) -> None:
             )
             for i in range(5)
         ]
-        commit_all(users)
+        commit_all(session, users)
 
         user_settings = [
             mdp.UserSettings(
@@ -114,88 +192,235 @@ def mock_data(engine) -> None:
             )
             for user in users
         ]
-        commit_all(user_settings)
+        commit_all(session, user_settings)
+        user_ids = [user.user_id for user in users]
 
-        projects = [
-            mdp.Project(name=f"Project_{i}", description=f"Description for project {i}", created_by=random.choice(users).user_id)
-            for i in range(10)
-        ]
-        commit_all(projects)
-
-        sprints = [
-            mdp.Sprint(
-                project_id=project.project_id,
-                name=f"Sprint_{i}",
-                start_date=random_date(date(2021, 1, 1), date(2021, 12, 31)),
-                end_date=random_date(date(2022, 1, 1), date(2022, 12, 31))
-            )
-            for i in range(25)
-            for project in projects
-        ]
-        commit_all(sprints)
-
-        tasks = [
-            mdp.Task(
-                sprint_id=None,
-                project_id=random.choice(projects).project_id,
-                title=f"Task_{i}",
-                description=f"Description for task {i}",
-                status=random.choice(["todo", "in progress", "done"]),
-                assigned_to=random.choice(users).user_id
-            )
-            for i in range(random.randrange(40))
-        ]
-        commit_all(tasks)
+    shard_names = [placement_shard().name for _ in range(num_projects)]
+    for shard_name in sorted(set(shard_names)):
+        with SHARDS_BY_NAME[shard_name].session() as session:
+            mock_projects(session, user_ids, shard_names.count(shard_name))
 
-        labels = [
-            mdp.Label(name=f"Label_{i}", project_id=project.project_id)
-            for i in range(random.randrange(3))
-            for project in projects
-        ]
-        commit_all(labels)
-
-        task_labels = [
-            mdp.TaskLabel(
-                task_id=task.task_id,
-                label_id=random.choice(
-                    [label.label_id for label in labels if label.project_id == task.project_id]
-                )
-            )
-            for task in random.choices(tasks, k = 20)
-        ]
-        commit_all(task_labels)
 
-        project_members = [
-            mdp.ProjectMember(project_id=project.project_id, member_id=random.choice(users).user_id)
-            for project in projects
-            for _ in range(2)
-        ]
-        commit_all(project_members)
+def mock_projects(session: DBSession, user_ids: List[int], num_projects: int) -> None:
+    """
+    Generate and insert mock projects with their sprints, tasks, labels and members into a shard.
+
+    Args:
+        session (DBSession): The database session of the shard.
+        user_ids (List[int]): IDs of the users creating, working on and belonging to the projects.
+        num_projects (int): Number of projects to create.
+    """
+    projects = [
+        mdp.Project(name=f"Project_{i}", description=f"Description for project {i}", created_by=random.choice(user_ids))
+        for i in range(num_projects)
+    ]
+    commit_all(session, projects)
+
+    sprints = [
+        mdp.Sprint(
+            project_id=project.project_id,
+            name=f"Sprint_{i}",
+            start_date=random_date(date(2021, 1, 1), date(2021, 12, 31)),
+            end_date=random_date(date(2022, 1, 1), date(2022, 12, 31))
+        )
+        for i in range(25)
+        for project in projects
+    ]
+    commit_all(session, sprints)
+
+    tasks = [
+        mdp.Task(
+            sprint_id=None,
+            project_id=random.choice(projects).project_id,
+            title=f"Task_{i}",
+            description=f"Description for task {i}",
+            status=random.choice(["todo", "in progress", "done"]),
+            assigned_to=random.choice(user_ids)
+        )
+        for i in range(random.randrange(40))
+    ]
+    columns = defaultdict(list)
+    for task in tasks:
+        columns[(task.project_id, task.sprint_id, task.status)].append(task)
+    for column_tasks in columns.values():
+        for task, rank in zip(column_tasks, ranks_between(None, None, len(column_tasks))):
+            task.rank = rank
+    commit_all(session, tasks)
+
+    labels = [
+        mdp.Label(name=f"Label_{i}", project_id=project.project_id)
+        for i in range(random.randrange(3))
+        for project in projects
+    ]
+    commit_all(session, labels)
+
+    labeled_pairs = {
+        (task.task_id, random.choice(project_labels))
+        for task in random.choices(tasks, k=20)
+        if (project_labels := [label.label_id for label in labels if label.project_id == task.project_id])
+    }
+    task_labels = [mdp.TaskLabel(task_id=task_id, label_id=label_id) for task_id, label_id in labeled_pairs]
+    commit_all(session, task_labels)
+
+    project_members = [
+        mdp.ProjectMember(project_id=project.project_id, member_id=user_id)
+        for project in projects
+        for user_id in random.sample(user_ids, k=2)
+    ]
+    commit_all(session, project_members)
+
+
+def reindex_tasks() -> None:
+    """
+    Rebuild the task search index of every project, on every shard, and the user prefix index.
+    """
+    for shard in SHARDS:
+        with shard.session() as session:
+            project_ids = [project_id for project_id, in session.query(mdp.Project.project_id)]
+            for project_id in project_ids:
+                count = rebuild_project_index(session, project_id)
+                print(f"Project {project_id}: indexed {count} tasks")
+    with Session() as session:
+        print(f"Indexed {rebuild_user_index(session)} users")
+
+
+def reconcile_counters(batch_size: int = 100) -> None:
+    """
+    Recompute the task counters of every project, on every shard, from the tasks.
+
+    Args:
+        batch_size (int): Number of projects reconciled per transaction.
+    """
+    for shard in SHARDS:
+        with shard.session() as session:
+            project_ids = [project_id for project_id, in session.query(mdp.Project.project_id)]
+            for start in range(0, len(project_ids), batch_size):
+                reconcile_project_counters(session, project_ids[start:start + batch_size])
+            print(f"Reconciled task counters of {len(project_ids)} projects on shard {shard.name}")
+
+
+def collect_blobs() -> None:
+    """
+    Remove attachment blobs that are no longer referenced by any attachment on any shard.
+    """
+    referenced = set(scatter(lambda session: [content_hash for content_hash, in
+                                              session.query(mdp.Attachment.content_hash).distinct()]))
+    removed = remove_unreferenced(referenced)
+    print(f"Removed {removed} unreferenced attachment blobs")
+
+
+def export_tenant(user_id: Optional[int], export_format: str, output: Optional[str]) -> None:
+    """
+    Export the projects created by a user, or all projects, streaming rows to files.
+
+    Args:
+        user_id (Optional[int]): ID of the user whose projects are exported; all projects if None.
+        export_format (str): One of ndjson, csv or parquet.
+        output (Optional[str]): For ndjson the output file (stdout if None); for csv and parquet the
+            directory receiving one file per table (the current directory if None).
+    """
+    def load_project_ids(session: DBSession) -> List[int]:
+        query = session.query(mdp.Project.project_id)
+        if user_id is not None:
+            query = query.filter(mdp.Project.created_by == user_id)
+        return [project_id for project_id, in query]
+
+    # Exports read through the read engines, if configured, off the engines serving writes.
+    project_ids = scatter(load_project_ids, read=True)
+
+    if export_format == NDJSON:
+        with open(output, 'w') if output else contextlib.nullcontext(sys.stdout) as stream:
+            stream.writelines(export_chunks(project_ids, export_format, read=True))
+        return
+
+    directory = output or '.'
+    os.makedirs(directory, exist_ok=True)
+    mode = 'w' if export_format == CSV else 'wb'
+    for table in EXPORTED_TABLES:
+        path = os.path.join(directory, f'{table}.{export_format}')
+        with open(path, mode, **({'newline': ''} if mode == 'w' else {})) as stream:
+            stream.writelines(export_chunks(project_ids, export_format, table, read=True))
+        print(f"Exported {table} of {len(project_ids)} projects to {path}", file=sys.stderr)
+
+
+def rebalance_projects(project_id: Optional[int], shard_name: Optional[str], dry_run: bool) -> None:
+    """
+    Move a project to a shard, or even out the number of tasks on the shards receiving new projects.
+
+    Args:
+        project_id (Optional[int]): ID of the project to move; all projects are considered if None.
+        shard_name (Optional[str]): Name of the shard receiving the project, required with project_id.
+        dry_run (bool): Only print the planned moves.
+    """
+    if project_id is not None:
+        moves = [(project_id, SHARDS_BY_NAME[shard_name])]
+    else:
+        moves = []
+        for move in plan_rebalance():
+            print(f"Project {move.project_id}: {move.tasks} tasks from shard {move.source.name} to {move.target.name}")
+            moves.append((move.project_id, move.target))
+        if not moves:
+            print("The shards are balanced")
+
+    if dry_run:
+        return
+    for move_project_id, target in moves:
+        copied = move_project(move_project_id, target)
+        print(f"Project {move_project_id}: moved {copied} rows to shard {target.name}")
+
+
+def queue_archival(days: int) -> None:
+    """
+    Queue an 'archive_tasks' job for every shard, moving the done tasks of sprints that ended more
+    than the given number of days ago to the archive tables.
+
+    Args:
+        days (int): Days since the end of a sprint after which its done tasks are archived.
+    """
+    for shard in SHARDS:
+        job_id = enqueue('archive_tasks', shard=shard.name, days=days)
+        print(f"Queued archival job {job_id} for shard {shard.name}")
 
 
-def manage_database(operation: str, engine: create_engine) -> None:
+def manage_database(operation: str) -> None:
     """
-    Manage database operations such as init, drop, create, mock, and reset.
+    Manage database operations such as init, drop, create, index, mock, reset, reindex, reconcile and gc.
+    Init, drop, create and index apply to every shard.
 
     Args:
-        operation (str): The operation to perform (init, drop, create, mock, reset).
-        engine (create_engine): The SQLAlchemy engine to use for database connections.
+        operation (str): The operation to perform (init, drop, create, index, mock, reset, reindex, reconcile, gc).
     """
     if operation == RESET:
-        for op in (DROP, INIT, CREATE, MOCK):
-            manage_database(op, engine)
+        for op in (DROP, INIT, CREATE, MOCK, REINDEX, RECONCILE):
+            manage_database(op)
         return
 
-    with engine.connect() as connection:
-        if operation in QUERY_FILES:
-            for query_data in QUERY_FILES[operation]:
-                execute_query(connection, query_data)
+    if operation == REINDEX:
+        reindex_tasks()
+        return
 
-        if operation == CREATE:
-            mdp.make_tables(connection)
+    if operation == RECONCILE:
+        reconcile_counters()
+        return
+
+    if operation == GC:
+        collect_blobs()
+        return
 
     if operation == MOCK:
-        mock_data(engine)
+        mock_data()
+        return
+
+    for shard in SHARDS:
+        with create_shard_engine(shard.name).connect() as connection:
+            for query_data in shard_query_files(operation, shard.name):
+                execute_query(connection, query_data)
+
+            if operation == CREATE:
+                create_shard_tables(connection, shard.index)
+
+            if operation == INDEX:
+                apply_access_paths(connection)
 
 
 def setup_argparse() -> argparse.ArgumentParser:
@@ -206,8 +431,20 @@ def setup_argparse() -> argparse.ArgumentParser:
         argparse.ArgumentParser: The configured argument parser.
     """
     parser = argparse.ArgumentParser(description='Manage your Snowflake database resources.')
-    parser.add_argument('operation', choices=[INIT, DROP, CREATE, MOCK, RESET],
-                        help='Operation to perform: initialize, drop, create or mock the database resources')
+    parser.add_argument('operation', choices=[INIT, DROP, CREATE, INDEX, MOCK, RESET, REINDEX, RECONCILE, GC, EXPORT,
+                                              REBALANCE, ARCHIVE],
+                        help='Operation to perform: initialize, drop, create, index or mock the database resources, '
+                             'rebuild the task and user search indexes, reconcile the task counters or remove '
+                             'unreferenced attachment blobs, export projects, move projects between shards, or '
+                             'queue the archival of done tasks of finished sprints')
+    parser.add_argument('--user-id', type=int, help='export: only export projects created by this user')
+    parser.add_argument('--format', choices=EXPORT_FORMATS, default=NDJSON, help='export: output format')
+    parser.add_argument('--output', help='export: output file for ndjson, output directory for csv and parquet')
+    parser.add_argument('--project-id', type=int, help='rebalance: only move this project, to the shard given in --shard')
+    parser.add_argument('--shard', choices=list(SHARDS_BY_NAME), help='rebalance: the shard receiving --project-id')
+    parser.add_argument('--dry-run', action='store_true', help='rebalance: only print the planned moves')
+    parser.add_argument('--days', type=int, default=ARCHIVE_AFTER_DAYS,
+                        help='archive: days since the end of a sprint after which its done tasks are archived')
     return parser
 
 
@@ -217,8 +454,21 @@ def main() -> None:
     """
     parser = setup_argparse()
     args = parser.parse_args()
-    engine = create_user_engine()
-    manage_database(args.operation, engine)
+    if args.operation == EXPORT:
+        export_tenant(args.user_id, args.format, args.output)
+        return
+
+    if args.operation == REBALANCE:
+        if (args.project_id is None) != (args.shard is None):
+            parser.error('--project-id and --shard must be given together')
+        rebalance_projects(args.project_id, args.shard, args.dry_run)
+        return
+
+    if args.operation == ARCHIVE:
+        queue_archival(args.days)
+        return
+
+    manage_database(args.operation)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,55 @@
+import pytest
+
+try:
+    from apiroutes.sprint.criticalpath import compute_critical_path
+except ValueError as error:
+    # Importing the routes needs the database credentials in database/setup.cfg.
+    pytest.skip(str(error), allow_module_level=True)
+
+
+def test_empty_graph():
+    assert compute_critical_path({}, []) == {'length': 0, 'path': [], 'tasks': []}
+
+
+def test_chain():
+    result = compute_critical_path({1: 1, 2: 1, 3: 1}, [(2, 1), (3, 2)])
+    assert result['length'] == 3
+    assert result['path'] == [1, 2, 3]
+    assert [task['slack'] for task in result['tasks']] == [0, 0, 0]
+
+
+def test_diamond_with_a_short_branch():
+    # 1 -> 2 -> 3 -> 5 and 1 -> 4 -> 5
+    result = compute_critical_path({1: 1, 2: 1, 3: 1, 4: 1, 5: 1}, [(2, 1), (3, 2), (5, 3), (4, 1), (5, 4)])
+    tasks = {task['task_id']: task for task in result['tasks']}
+    assert result['length'] == 4
+    assert result['path'] == [1, 2, 3, 5]
+    assert tasks[4]['slack'] == 1
+    assert (tasks[4]['earliest_start'], tasks[4]['earliest_finish']) == (1, 2)
+    assert (tasks[5]['earliest_start'], tasks[5]['earliest_finish']) == (3, 4)
+    assert all(tasks[task_id]['slack'] == 0 for task_id in result['path'])
+
+
+def test_finished_tasks_are_not_on_the_path():
+    result = compute_critical_path({1: 0, 2: 1, 3: 1}, [(2, 1), (3, 2)])
+    assert result['length'] == 2
+    assert result['path'] == [2, 3]
+
+
+def test_independent_tasks():
+    result = compute_critical_path({1: 1, 2: 1, 3: 0}, [])
+    assert result['length'] == 1
+    assert len(result['path']) == 1
+    assert [task['slack'] for task in result['tasks']] == [0, 0, 1]
+
+
+def test_topological_order():
+    result = compute_critical_path({1: 1, 2: 1, 3: 1, 4: 1}, [(1, 2), (1, 3), (2, 4), (3, 4)])
+    order = [task['task_id'] for task in result['tasks']]
+    assert order.index(4) < order.index(2) < order.index(1)
+    assert order.index(3) < order.index(1)
+
+
+def test_cycles_are_rejected():
+    with pytest.raises(ValueError):
+        compute_critical_path({1: 1, 2: 1, 3: 1}, [(2, 1), (3, 2), (1, 3)])
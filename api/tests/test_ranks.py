@@ -0,0 +1,71 @@
+import pytest
+
+from database.ranks import RANK_DIGITS, rank_after, rank_between, ranks_after, ranks_between
+
+
+def assert_valid(ranks):
+    assert all(before < after for before, after in zip(ranks, ranks[1:]))
+    assert not any(rank.endswith(RANK_DIGITS[0]) for rank in ranks)
+
+
+def test_rank_between_bounds():
+    assert rank_between(None, None) == 'i'
+    assert 'a' < rank_between('a', 'b') < 'b'
+    assert rank_between(None, '1') < '1'
+    assert rank_between('z', None) > 'z'
+
+
+def test_rank_between_rejects_unordered_ranks():
+    with pytest.raises(ValueError):
+        rank_between('b', 'a')
+    with pytest.raises(ValueError):
+        rank_between('a', 'a')
+
+
+def test_repeated_bisection_stays_ordered():
+    low, high = 'a', 'b'
+    ranks = [low, high]
+    for _ in range(200):
+        high = rank_between(low, high)
+        ranks.append(high)
+    assert_valid(sorted(ranks))
+    assert len(set(ranks)) == len(ranks)
+    # One digit about every five inserts at the same place.
+    assert len(high) <= 200 // 4
+
+
+def test_bisection_at_the_top_stays_ordered():
+    ranks = ['i']
+    for _ in range(100):
+        ranks.insert(0, rank_between(None, ranks[0]))
+    assert_valid(ranks)
+
+
+def test_ranks_between_grows_with_the_logarithm_of_their_number():
+    ranks = ranks_between('a', 'b', 10000)
+    assert len(ranks) == 10000
+    assert_valid(['a', *ranks, 'b'])
+    assert max(map(len, ranks)) <= 5
+
+
+def test_rank_after_increments():
+    assert rank_after(None) == 'i'
+    assert rank_after('abc') == 'abd'
+    assert rank_after('iz') == 'j1'
+    assert rank_after('zz') == 'zz01'
+
+
+@pytest.mark.parametrize('count, longest', [(100, 4), (1531, 8), (200000, 8)])
+def test_appending_many_times_keeps_ranks_short(count, longest):
+    ranks = ranks_after(None, count)
+    assert_valid(ranks)
+    assert max(map(len, ranks)) <= longest
+
+
+def test_appending_after_a_long_rank_keeps_its_length():
+    last = 'b'
+    while len(last) < 6:
+        last = rank_between('a', last)
+    ranks = ranks_after(last, 1000)
+    assert_valid([last, *ranks])
+    assert max(map(len, ranks)) == len(last)
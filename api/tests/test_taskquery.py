@@ -0,0 +1,79 @@
+import pytest
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import Session
+from werkzeug.datastructures import MultiDict
+
+from apiroutes.taskquery import TaskQuery, TaskQueryError, decode_cursor, encode_cursor, merge_pages, query_tasks
+from database.map_db import Project, Task, make_tables
+
+PROJECT_ID = 1
+
+
+@pytest.fixture
+def session():
+    engine = create_engine('sqlite://')
+    make_tables(engine)
+    with Session(engine) as session:
+        session.execute(insert(Project), [{'project_id': PROJECT_ID, 'name': 'p'}, {'project_id': 2, 'name': 'other'}])
+        session.execute(insert(Task), [
+            {'task_id': task_id, 'project_id': PROJECT_ID, 'title': f'task {task_id % 4}', 'description': 'd',
+             'status': ('todo', 'doing', None)[task_id % 3], 'rank': None if task_id % 5 == 0 else f'r{task_id % 7}'}
+            for task_id in range(1, 24)
+        ] + [{'task_id': 100, 'project_id': 2, 'title': 'task 0', 'description': 'd', 'status': 'todo'}])
+        session.commit()
+        yield session
+
+
+def test_cursor_round_trip():
+    query = TaskQuery(sort='title', descending=True)
+    cursor = encode_cursor(query, 'task 3', 42)
+    assert decode_cursor(query._replace(cursor=cursor)) == ('task 3', 42)
+
+
+@pytest.mark.parametrize('cursor', ['not a cursor', '', 'W10', encode_cursor(TaskQuery(), 1, 'x')])
+def test_malformed_cursors_are_rejected(cursor):
+    with pytest.raises(TaskQueryError):
+        decode_cursor(TaskQuery(cursor=cursor or '='))
+
+
+def test_cursors_of_another_sort_order_are_rejected():
+    cursor = encode_cursor(TaskQuery(sort='title'), 'task 3', 42)
+    with pytest.raises(TaskQueryError):
+        decode_cursor(TaskQuery(sort='title', descending=True, cursor=cursor))
+    with pytest.raises(TaskQueryError):
+        decode_cursor(TaskQuery(sort='status', cursor=cursor))
+
+
+def test_from_args_reads_the_cursor():
+    cursor = encode_cursor(TaskQuery(sort='rank'), 'r1', 7)
+    query = TaskQuery.from_args(MultiDict({'sort': 'rank', 'limit': '5', 'cursor': cursor}))
+    assert (query.sort, query.limit, decode_cursor(query)) == ('rank', 5, ('r1', 7))
+
+
+def page_through(session, query):
+    task_ids, cursor = [], None
+    while True:
+        tasks, cursor = query_tasks(session, PROJECT_ID, query._replace(cursor=cursor))
+        task_ids += [task.task_id for task in tasks]
+        if cursor is None:
+            return task_ids
+
+
+@pytest.mark.parametrize('sort', ['task_id', 'title', 'status', 'revision', 'rank'])
+@pytest.mark.parametrize('descending', [False, True])
+def test_pages_cover_every_task_once_in_order(session, sort, descending):
+    everything, _ = query_tasks(session, PROJECT_ID, TaskQuery(sort=sort, descending=descending, limit=None))
+    assert len(everything) == 23
+    for limit in (1, 4, 23, 50):
+        query = TaskQuery(sort=sort, descending=descending, limit=limit)
+        assert page_through(session, query) == [task.task_id for task in everything]
+
+
+def test_merged_pages_continue_where_they_stopped(session):
+    query = TaskQuery(sort='title', limit=5)
+    rows = [(task, task.title) for task in query_tasks(session, PROJECT_ID, query._replace(limit=None))[0]]
+    half = len(rows) // 2
+    tasks, cursor = merge_pages(query, rows[half:][:query.limit + 1] + rows[:half][:query.limit + 1])
+    assert [task.task_id for task in tasks] == [task.task_id for task, _ in rows[:5]]
+    next_tasks, _ = query_tasks(session, PROJECT_ID, query._replace(cursor=cursor))
+    assert [task.task_id for task in next_tasks] == [task.task_id for task, _ in rows[5:10]]
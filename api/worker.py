@@ -0,0 +1,103 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+from multiprocessing.synchronize import Event
+
+from apiroutes import jobs, writebehind
+
+RESTART_CHECK_SECONDS = 1
+FLUSHER_ID = 'flusher'
+
+
+def work(worker_id: str, stop: Event) -> None:
+    """
+    Run a single worker process until the stop event is set.
+
+    Args:
+        worker_id (str): Stable identifier of the worker.
+        stop (Event): Event set by the supervisor on shutdown.
+    """
+    # The supervisor handles signals; workers finish their current job before exiting.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO)
+    jobs.load_handlers()
+    jobs.run_worker(worker_id, stop.is_set)
+
+
+def flush(stop: Event) -> None:
+    """
+    Run the write-behind flusher until the stop event is set.
+
+    Args:
+        stop (Event): Event set by the supervisor on shutdown.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO)
+    writebehind.run_flusher(stop.is_set)
+
+
+def start_worker(worker_id: str, stop: Event) -> multiprocessing.Process:
+    """
+    Start a worker process, or the write-behind flusher for FLUSHER_ID.
+
+    Args:
+        worker_id (str): Stable identifier of the worker, or FLUSHER_ID.
+        stop (Event): Event set by the supervisor on shutdown.
+
+    Returns:
+        multiprocessing.Process: The started process.
+    """
+    if worker_id == FLUSHER_ID:
+        process = multiprocessing.Process(target=flush, args=(stop,), name=FLUSHER_ID)
+    else:
+        process = multiprocessing.Process(target=work, args=(worker_id, stop), name=f'worker-{worker_id}')
+    process.start()
+    return process
+
+
+def setup_argparse() -> argparse.ArgumentParser:
+    """
+    Set up the argument parser for command-line arguments.
+
+    Returns:
+        argparse.ArgumentParser: The configured argument parser.
+    """
+    parser = argparse.ArgumentParser(description='Run background job workers.')
+    parser.add_argument('--processes', type=int, default=int(os.getenv('JOB_WORKERS', os.cpu_count() or 1)),
+                        help='Number of worker processes (default: JOB_WORKERS or the number of CPUs)')
+    return parser
+
+
+def main() -> None:
+    """
+    Start the worker pool and the write-behind flusher and restart those that exit unexpectedly
+    until SIGINT or SIGTERM.
+    """
+    args = setup_argparse().parse_args()
+    stop = multiprocessing.Event()
+    worker_ids = [f'{socket.gethostname()}:{index}' for index in range(args.processes)] + [FLUSHER_ID]
+    processes = {worker_id: start_worker(worker_id, stop) for worker_id in worker_ids}
+
+    def shutdown(signum, frame) -> None:
+        stop.set()
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    while not stop.wait(RESTART_CHECK_SECONDS):
+        for worker_id, process in processes.items():
+            if not process.is_alive():
+                logging.warning('Worker %s exited with code %s, restarting', worker_id, process.exitcode)
+                processes[worker_id] = start_worker(worker_id, stop)
+
+    for process in processes.values():
+        process.join()
+
+
+if __name__ == '__main__':
+    main()